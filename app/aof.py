@@ -0,0 +1,186 @@
+import os
+import threading
+
+from .encoder import Encoder
+from .logger import logger
+from .store import OBJ_STREAM, OBJ_STRING
+from .stream import format_stream_id
+from .timer import monotonic_millis
+
+DEFAULT_AOF_FILENAME = "appendonly.aof"
+
+FSYNC_ALWAYS = "always"
+FSYNC_EVERYSEC = "everysec"
+FSYNC_NO = "no"
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_EVERYSEC, FSYNC_NO)
+
+
+class InvalidAofFileException(Exception):
+    pass
+
+
+class AppendOnlyFile:
+    """
+    Log of the write commands. Commands are buffered by feed and written
+    with a single write per event loop iteration by flush, before replies
+    are sent. With everysec the fsync runs on a background thread so the
+    event loop never waits for the disk.
+    """
+
+    def __init__(self, path, fsync_policy=FSYNC_EVERYSEC):
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.buffer = bytearray()
+        # Commands fed while a rewrite child runs, appended to its file.
+        self.rewrite_buffer = None
+        self.last_write_ok = True
+        self.unsynced = False
+        self.last_fsync = monotonic_millis()
+        self.fd = self.open()
+        self.fsync_requested = threading.Event()
+        self.fsync_lock = threading.Lock()
+        if fsync_policy == FSYNC_EVERYSEC:
+            thread = threading.Thread(target=self.fsync_loop, name="aof-fsync")
+            thread.daemon = True
+            thread.start()
+
+    def open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def feed(self, message):
+        self.buffer += message
+        if self.rewrite_buffer is not None:
+            self.rewrite_buffer += message
+
+    def flush(self):
+        if self.buffer:
+            self.write_buffer()
+        if self.fsync_policy == FSYNC_ALWAYS and self.unsynced:
+            self.fsync()
+        elif self.fsync_policy == FSYNC_EVERYSEC:
+            self.request_background_fsync()
+
+    def write_buffer(self):
+        view = memoryview(self.buffer)
+        written = 0
+        try:
+            while written < len(view):
+                written += os.write(self.fd, view[written:])
+        except OSError as e:
+            logger.error("Error writing to the AOF: %s", e)
+            self.last_write_ok = False
+        else:
+            self.last_write_ok = True
+        finally:
+            view.release()
+            # Whatever didn't make it is retried on the next flush.
+            del self.buffer[:written]
+        if written:
+            self.unsynced = True
+
+    def fsync(self):
+        self.unsynced = False
+        self.last_fsync = monotonic_millis()
+        with self.fsync_lock:
+            os.fsync(self.fd)
+
+    def request_background_fsync(self):
+        now = monotonic_millis()
+        if self.unsynced and now - self.last_fsync >= 1000:
+            self.unsynced = False
+            self.last_fsync = now
+            self.fsync_requested.set()
+
+    def fsync_loop(self):
+        while True:
+            self.fsync_requested.wait()
+            self.fsync_requested.clear()
+            with self.fsync_lock:
+                try:
+                    os.fsync(self.fd)
+                except OSError as e:
+                    logger.error("Error syncing the AOF: %s", e)
+
+    def get_size(self):
+        try:
+            return os.fstat(self.fd).st_size
+        except OSError:
+            return 0
+
+    def start_rewrite(self):
+        self.rewrite_buffer = bytearray()
+
+    def finish_rewrite(self, temp_path):
+        """
+        Append the commands fed during the rewrite to temp_path, then make it
+        the AOF. Every command fed so far is then in the new file.
+        """
+        self.flush()
+        try:
+            with open(temp_path, "ab") as temp_file:
+                temp_file.write(self.rewrite_buffer)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, self.path)
+        finally:
+            self.rewrite_buffer = None
+        with self.fsync_lock:
+            os.close(self.fd)
+            self.fd = self.open()
+        self.unsynced = False
+
+    def cancel_rewrite(self):
+        self.rewrite_buffer = None
+
+
+def can_rewrite_as_commands(data, expires):
+    """
+    Whether rewrite_commands can rebuild data and expires. Lists, sets,
+    hashes and zsets only come from RDB files and there are no commands
+    creating them, nor one setting the TTL of a stream, so keyspaces holding
+    them need the RDB preamble.
+    """
+    for key, obj in data.items():
+        if obj.type == OBJ_STREAM:
+            if key in expires:
+                return False
+        elif obj.type != OBJ_STRING:
+            return False
+    return True
+
+
+def rewrite_commands(data, expires):
+    """
+    Yield the commands rebuilding the keyspace in data and expires, one
+    RESP array per command. Only strings and streams without a TTL can be
+    rebuilt, see can_rewrite_as_commands.
+    """
+    encoder = Encoder()
+    for key, obj in data.items():
+        if obj.type == OBJ_STRING:
+            command = ["SET", key, obj.get_string()]
+            expiry = expires.get(key)
+            if expiry is not None:
+                command.extend(["PXAT", str(expiry)])
+            yield encoder.generate_array_string(command)
+        else:
+            for stream_id, values in obj.value.range(0, obj.value.last_id):
+                command = ["XADD", key, format_stream_id(stream_id), *values]
+                yield encoder.generate_array_string(command)
+
+
+def write_rewritten_file(path, data, expires, rdb_writer=None):
+    """
+    Write the commands rebuilding data and expires to path. With rdb_writer
+    the keyspace is written as an RDB file instead, commands appended later
+    follow it, like with Redis' aof-use-rdb-preamble.
+    """
+    if rdb_writer:
+        chunks = rdb_writer.generate({0: (data, expires)})
+    else:
+        chunks = rewrite_commands(data, expires)
+    with open(path, "wb") as aof_file:
+        for chunk in chunks:
+            aof_file.write(chunk)
+        aof_file.flush()
+        os.fsync(aof_file.fileno())
@@ -0,0 +1,102 @@
+from collections import deque
+
+DEFAULT_BACKLOG_SIZE = 1024 * 1024
+# Size a block of the replication buffer grows to before a new one starts.
+REPL_BUFFER_BLOCK_SIZE = 16 * 1024
+
+
+class ReplicationBacklog:
+    """
+    Fixed size circular buffer holding the tail of the replication stream,
+    so that a replica reconnecting with a recent offset only needs the bytes
+    it missed.
+
+    Offsets are master replication offsets: end_offset is the offset after
+    the last byte fed, start_offset the one of the oldest byte still kept.
+    """
+
+    def __init__(self, size=DEFAULT_BACKLOG_SIZE, offset=0):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.index = 0
+        self.histlen = 0
+        self.end_offset = offset
+
+    @property
+    def start_offset(self):
+        return self.end_offset - self.histlen
+
+    def feed(self, data):
+        length = len(data)
+        self.end_offset += length
+        if length >= self.size:
+            self.buffer[:] = memoryview(data)[length - self.size :]
+            self.index = 0
+            self.histlen = self.size
+            return
+        first = min(length, self.size - self.index)
+        self.buffer[self.index : self.index + first] = memoryview(data)[:first]
+        if first < length:
+            self.buffer[: length - first] = memoryview(data)[first:]
+        self.index = (self.index + length) % self.size
+        self.histlen = min(self.histlen + length, self.size)
+
+    def can_serve(self, offset):
+        return self.start_offset <= offset <= self.end_offset
+
+    def read_from(self, offset):
+        """
+        Bytes of the replication stream from offset up to end_offset.
+        """
+        if not self.can_serve(offset):
+            raise ValueError(f"Offset {offset} is not in the backlog")
+        length = self.end_offset - offset
+        start = (self.index - length) % self.size
+        if start + length <= self.size:
+            return bytes(self.buffer[start : start + length])
+        return bytes(self.buffer[start:]) + bytes(
+            self.buffer[: length - (self.size - start)]
+        )
+
+
+class ReplicationBuffer:
+    """
+    Replication stream not yet written to every replica. It is shared by all
+    of them instead of copied into each one's reply queue: replicas only
+    keep the offset they have been sent up to, and trim drops the blocks
+    every replica is past.
+    """
+
+    def __init__(self, offset=0):
+        self.blocks = deque()
+        self.start_offset = offset
+        self.end_offset = offset
+
+    def feed(self, data):
+        if not self.blocks or len(self.blocks[-1]) >= REPL_BUFFER_BLOCK_SIZE:
+            self.blocks.append(bytearray())
+        self.blocks[-1] += data
+        self.end_offset += len(data)
+
+    def get_views(self, offset, max_views):
+        """
+        Memoryviews of the stream from offset on, at most max_views of them.
+        They have to be released before the next feed.
+        """
+        views = []
+        position = self.start_offset
+        for block in self.blocks:
+            end = position + len(block)
+            if end > offset:
+                views.append(memoryview(block)[max(offset - position, 0) :])
+                if len(views) >= max_views:
+                    break
+            position = end
+        return views
+
+    def trim(self, offset):
+        while self.blocks and self.start_offset + len(self.blocks[0]) <= offset:
+            self.start_offset += len(self.blocks.popleft())
+
+    def __len__(self):
+        return self.end_offset - self.start_offset
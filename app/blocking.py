@@ -0,0 +1,112 @@
+import heapq
+import itertools
+
+
+class BlockedClient:
+    def __init__(self, sock, stream_ids, count=None):
+        self.sock = sock
+        # Stream key -> packed id, the client wants entries newer than it.
+        self.stream_ids = stream_ids
+        self.count = count
+        self.timer = None
+
+    def __str__(self):
+        return f"<BlockedClient {list(self.stream_ids)}>"
+
+
+class BlockingRegistry:
+    """
+    Clients blocked on stream keys. Every key has its own wait queue, a dict
+    used as an insertion ordered set, so clients are served in the order
+    they blocked and removing one is O(number of keys it waits on).
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.keys = {}
+
+    def add(self, client):
+        self.clients[client.sock] = client
+        for key in client.stream_ids:
+            self.keys.setdefault(key, {})[client.sock] = client
+
+    def remove(self, sock):
+        client = self.clients.pop(sock, None)
+        if client is None:
+            return None
+        for key in client.stream_ids:
+            waiting = self.keys[key]
+            del waiting[sock]
+            if not waiting:
+                del self.keys[key]
+        if client.timer:
+            client.timer.cancel()
+        return client
+
+    def get_clients(self, key):
+        return list(self.keys.get(key, {}).values())
+
+    def is_blocked(self, sock):
+        return sock in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+
+class Waiter:
+    def __init__(self, sock, numreplicas, offset):
+        self.sock = sock
+        self.numreplicas = numreplicas
+        # Replication offset the replicas have to acknowledge.
+        self.offset = offset
+        self.timer = None
+
+    def __str__(self):
+        return f"<Waiter {self.numreplicas} replicas at {self.offset}>"
+
+
+class WaitingClients:
+    """
+    Clients blocked in WAIT. Waiters are grouped by the number of replicas
+    they need, each group is a min-heap on the offset to be acknowledged.
+    A group is satisfied up to the offset acknowledged by its n-th most
+    up to date replica, so resolving waiters never looks at the ones that
+    still have to wait.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.clients = {}
+        self.counter = itertools.count()
+
+    def add(self, waiter):
+        self.clients[waiter.sock] = waiter
+        queue = self.queues.setdefault(waiter.numreplicas, [])
+        heapq.heappush(queue, (waiter.offset, next(self.counter), waiter))
+
+    def remove(self, sock):
+        # The heap entry is dropped lazily once it reaches the top.
+        waiter = self.clients.pop(sock, None)
+        if waiter and waiter.timer:
+            waiter.timer.cancel()
+        return waiter
+
+    def pop_satisfied(self, ack_offsets):
+        acks = sorted(ack_offsets, reverse=True)
+        satisfied = []
+        for numreplicas, queue in list(self.queues.items()):
+            if numreplicas <= len(acks):
+                reached = acks[numreplicas - 1]
+                while queue and queue[0][0] <= reached:
+                    _, _, waiter = heapq.heappop(queue)
+                    if self.clients.get(waiter.sock) is waiter:
+                        self.remove(waiter.sock)
+                        satisfied.append(waiter)
+            while queue and self.clients.get(queue[0][2].sock) is not queue[0][2]:
+                heapq.heappop(queue)
+            if not queue:
+                del self.queues[numreplicas]
+        return satisfied
+
+    def __len__(self):
+        return len(self.clients)
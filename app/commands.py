@@ -0,0 +1,145 @@
+# Command flags, same names as the ones COMMAND INFO reports in Redis.
+CMD_WRITE = "write"
+CMD_READONLY = "readonly"
+CMD_DENYOOM = "denyoom"
+CMD_ADMIN = "admin"
+CMD_NOSCRIPT = "noscript"
+CMD_BLOCKING = "blocking"
+# Served while the dataset is loading.
+CMD_LOADING = "loading"
+# Served by a replica whose link with its master is down for too long.
+CMD_STALE = "stale"
+CMD_FAST = "fast"
+CMD_MOVABLEKEYS = "movablekeys"
+
+
+class RedisCommand:
+    """
+    Entry of the command table. arity counts the command name, a negative
+    one is a minimum. first_key, last_key and key_step are the positions of
+    the keys in the arguments, last_key -1 meaning the last argument, like
+    in Redis' command table. It also holds the stats of the command.
+    """
+
+    def __init__(self, name, arity, flags, first_key=0, last_key=0, key_step=0):
+        self.name = name
+        self.arity = arity
+        self.flags = frozenset(flags)
+        self.first_key = first_key
+        self.last_key = last_key
+        self.key_step = key_step
+        # Method of the command handlers running the command.
+        self.proc_name = f"_handle_{name}_command"
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = 0
+        self.duration_ns = 0
+        self.rejected_calls = 0
+        self.failed_calls = 0
+
+    def is_write(self):
+        return CMD_WRITE in self.flags
+
+    def has_flag(self, flag):
+        return flag in self.flags
+
+    def check_arity(self, argc):
+        if self.arity < 0:
+            return argc >= -self.arity
+        return argc == self.arity
+
+    def record_call(self, duration_ns, response):
+        self.calls += 1
+        self.duration_ns += duration_ns
+        if response and response.startswith(b"-"):
+            self.failed_calls += 1
+
+    def get_info(self):
+        """
+        Reply of COMMAND INFO for this command.
+        """
+        return [
+            self.name,
+            self.arity,
+            sorted(self.flags),
+            self.first_key,
+            self.last_key,
+            self.key_step,
+        ]
+
+    def get_stats_line(self):
+        usec = self.duration_ns // 1000
+        usec_per_call = usec / self.calls if self.calls else 0
+        return (
+            f"cmdstat_{self.name}:calls={self.calls},usec={usec},"
+            f"usec_per_call={usec_per_call:.2f},"
+            f"rejected_calls={self.rejected_calls},failed_calls={self.failed_calls}"
+        )
+
+    def __repr__(self):
+        return f"<RedisCommand {self.name}>"
+
+
+# name, arity, flags, first key, last key, key step.
+COMMAND_TABLE = [
+    ("get", 2, [CMD_READONLY, CMD_FAST], 1, 1, 1),
+    ("set", -3, [CMD_WRITE, CMD_DENYOOM], 1, 1, 1),
+    ("mget", -2, [CMD_READONLY, CMD_FAST], 1, -1, 1),
+    ("mset", -3, [CMD_WRITE, CMD_DENYOOM], 1, -1, 2),
+    ("msetnx", -3, [CMD_WRITE, CMD_DENYOOM], 1, -1, 2),
+    ("del", -2, [CMD_WRITE], 1, -1, 1),
+    ("unlink", -2, [CMD_WRITE, CMD_FAST], 1, -1, 1),
+    ("exists", -2, [CMD_READONLY, CMD_FAST], 1, -1, 1),
+    ("incr", 2, [CMD_WRITE, CMD_DENYOOM, CMD_FAST], 1, 1, 1),
+    ("decr", 2, [CMD_WRITE, CMD_DENYOOM, CMD_FAST], 1, 1, 1),
+    ("incrby", 3, [CMD_WRITE, CMD_DENYOOM, CMD_FAST], 1, 1, 1),
+    ("decrby", 3, [CMD_WRITE, CMD_DENYOOM, CMD_FAST], 1, 1, 1),
+    ("incrbyfloat", 3, [CMD_WRITE, CMD_DENYOOM, CMD_FAST], 1, 1, 1),
+    ("object", -2, [CMD_READONLY], 2, 2, 1),
+    ("keys", 2, [CMD_READONLY], 0, 0, 0),
+    ("ttl", 2, [CMD_READONLY, CMD_FAST], 1, 1, 1),
+    ("pttl", 2, [CMD_READONLY, CMD_FAST], 1, 1, 1),
+    ("persist", 2, [CMD_WRITE, CMD_FAST], 1, 1, 1),
+    ("type", 2, [CMD_READONLY, CMD_FAST], 1, 1, 1),
+    ("xadd", -5, [CMD_WRITE, CMD_DENYOOM, CMD_FAST], 1, 1, 1),
+    ("xrange", -4, [CMD_READONLY], 1, 1, 1),
+    ("xread", -4, [CMD_READONLY, CMD_BLOCKING, CMD_MOVABLEKEYS], 0, 0, 0),
+    ("ping", -1, [CMD_FAST, CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("echo", 2, [CMD_FAST, CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("info", -1, [CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("config", -2, [CMD_ADMIN, CMD_NOSCRIPT, CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("command", -1, [CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("save", 1, [CMD_ADMIN, CMD_NOSCRIPT], 0, 0, 0),
+    ("bgsave", -1, [CMD_ADMIN, CMD_NOSCRIPT], 0, 0, 0),
+    ("bgrewriteaof", 1, [CMD_ADMIN, CMD_NOSCRIPT], 0, 0, 0),
+    ("lastsave", 1, [CMD_FAST, CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("replconf", -1, [CMD_ADMIN, CMD_NOSCRIPT, CMD_LOADING, CMD_STALE], 0, 0, 0),
+    ("psync", -3, [CMD_ADMIN, CMD_NOSCRIPT], 0, 0, 0),
+    ("wait", 3, [CMD_NOSCRIPT], 0, 0, 0),
+]
+
+# Replies read from the master link come out of the parser like commands.
+# They only make sense there, so they aren't in the command table.
+MASTER_REPLIES = [
+    "ok",
+    "pong",
+    "fullresync",
+    "continue",
+    "rdb",
+    "rdbstart",
+    "rdbdata",
+    "rdbend",
+]
+
+
+def populate_command_table():
+    """
+    Fresh command table, name to RedisCommand. Every server has its own so
+    the stats are per server.
+    """
+    return {entry[0]: RedisCommand(*entry) for entry in COMMAND_TABLE}
+
+
+def create_reply_table(names):
+    return {name: RedisCommand(name, -1, []) for name in names}
@@ -1,42 +1,117 @@
+CRLF = b"\r\n"
+
+# Replies shared by every connection instead of built for each reply, like
+# Redis' shared objects.
+OK = b"+OK\r\n"
+PONG = b"+PONG\r\n"
+NULL_BULK = b"$-1\r\n"
+EMPTY_ARRAY = b"*0\r\n"
+SHARED_INTEGERS = 10000
+INTEGERS = [b":%d\r\n" % i for i in range(SHARED_INTEGERS)]
+# Headers of bulk strings and arrays up to this length.
+SHARED_HEADERS = 32
+BULK_HEADERS = [b"$%d\r\n" % i for i in range(SHARED_HEADERS)]
+ARRAY_HEADERS = [b"*%d\r\n" % i for i in range(SHARED_HEADERS)]
+
+
+def to_bytes(value):
+    # Strings decoded from the wire keep undecodable bytes as surrogates.
+    return value.encode("utf-8", "surrogateescape")
+
+
 class Encoder:
-    def _construct_line(self, message):
-        return f"${len(message)}\r\n{message}\r\n"
+    """
+    Encodes replies as RESP. The write_* methods append to a bytearray, so
+    a reply made of many values is built in a single buffer, and the
+    generate_* ones return the encoding of one value.
 
-    def generate_bulkstring(self, message):
-        return self._construct_line(message).encode()
+    Values can be bytes, str (encoded as UTF-8), int, None (the null bulk
+    string) and lists or tuples of them.
+    """
 
-    def generate_simple_strings(self, messages):
-        return "".join([self._construct_line(message) for message in messages]).encode()
+    def write_bulkstring(self, out, value):
+        if isinstance(value, str):
+            value = to_bytes(value)
+        length = len(value)
+        if length < SHARED_HEADERS:
+            out += BULK_HEADERS[length]
+        else:
+            out += b"$%d\r\n" % length
+        out += value
+        out += CRLF
 
-    def generate_array_string(self, messages):
-        if not messages:
-            return b"*0\r\n"
+    def write_integer(self, out, num):
+        if 0 <= num < SHARED_INTEGERS:
+            out += INTEGERS[num]
+        else:
+            out += b":%d\r\n" % num
 
-        return f"*{len(messages)}\r\n{''.join(
-            [self._generate_array_string(message) for message in messages])
-            }".encode()
-    
-    def _generate_array_string(self, message):
-        if isinstance(message, str):
-            return self._construct_line(message)
+    def write_array(self, out, values):
+        length = len(values)
+        if length < SHARED_HEADERS:
+            out += ARRAY_HEADERS[length]
+        else:
+            out += b"*%d\r\n" % length
+        for value in values:
+            # Strings are inlined, they are most of what arrays hold.
+            if type(value) is str:
+                value = value.encode("utf-8", "surrogateescape")
+            if type(value) is bytes:
+                length = len(value)
+                if length < SHARED_HEADERS:
+                    out += BULK_HEADERS[length]
+                else:
+                    out += b"$%d\r\n" % length
+                out += value
+                out += CRLF
+            else:
+                self.write_value(out, value)
+
+    def write_value(self, out, value):
+        if isinstance(value, (str, bytes, bytearray, memoryview)):
+            self.write_bulkstring(out, value)
+        elif isinstance(value, (list, tuple)):
+            self.write_array(out, value)
+        elif value is None:
+            out += NULL_BULK
+        elif isinstance(value, int):
+            self.write_integer(out, value)
         else:
-            return f"*{len(message)}\r\n{''.join(self._generate_array_string(m) for m in message)}"
+            raise TypeError(f"Can't encode {type(value).__name__} as RESP")
+
+    def generate_bulkstring(self, message):
+        if isinstance(message, str):
+            message = to_bytes(message)
+        return b"$%d\r\n%s\r\n" % (len(message), message)
+
+    def generate_array_string(self, messages):
+        if not messages:
+            return EMPTY_ARRAY
+        out = bytearray()
+        self.write_array(out, messages)
+        return bytes(out)
 
     def generate_null_string(self):
-        return b"$-1\r\n"
+        return NULL_BULK
 
     def generate_error_string(self, message):
-        return f"-{message}\r\n".encode()
+        return b"-%s\r\n" % to_bytes(message)
 
     def generate_success_string(self):
-        return self.generate_simple_string("OK")
+        return OK
 
     def generate_simple_string(self, message):
-        return f"+{message}\r\n".encode()
+        if message == "OK":
+            return OK
+        elif message == "PONG":
+            return PONG
+        return b"+%s\r\n" % to_bytes(message)
 
-    def generate_file_string(self, hex_contents):
-        byte_contents = bytes.fromhex(hex_contents)
-        return f"${len(byte_contents)}\r\n".encode() + byte_contents
+    def generate_file_header(self, size):
+        # RDB files are sent like a bulk string without the trailing CRLF.
+        return b"$%d\r\n" % size
 
     def generate_integer_string(self, num):
-        return f":{num}\r\n".encode()
+        if 0 <= num < SHARED_INTEGERS:
+            return INTEGERS[num]
+        return b":%d\r\n" % num
@@ -1,31 +1,67 @@
+import math
 import time
 from enum import Enum
 
-from .parser import RespParser
+from .commands import CMD_LOADING, CMD_STALE, MASTER_REPLIES, create_reply_table
 from .encoder import Encoder
-from .store import ZeroIdentifier
+from .logger import logger
+from .rdb.parser import RdbStreamLoader
+from .store import (
+    LLONG_MIN,
+    InvalidStreamId,
+    InvalidValue,
+    WrongType,
+    ZeroIdentifier,
+    parse_double,
+    parse_long,
+)
+from .stream import MIN_STREAM_ID, parse_stream_id
 
 
 class CommandHandler:
+    # Replies that can come out of the parser, handled like commands.
+    reply_names = ["ok"]
+
     def __init__(self, server, store, connection=None):
         self.server = server
         self.store = store
-        self.parser = RespParser()
         self.connection = connection
         self.encoder = Encoder()
+        self.dispatch_table = self.create_dispatch_table()
+
+    def create_dispatch_table(self):
+        """
+        Map command names, lower and upper case, to the command and the
+        method running it, so dispatching is a dict lookup.
+        """
+        commands = dict(self.server.commands)
+        commands.update(create_reply_table(self.reply_names))
+        table = {}
+        for name, command in commands.items():
+            entry = (command, getattr(self, command.proc_name))
+            table[name] = entry
+            table[name.upper()] = entry
+        return table
 
     def get_set_success_response(self):
         return self.encoder.generate_success_string()
 
     def _handle_config_command(self, data, cmd, sock):
         cmd_data = cmd.get_decoded_data()
-        if cmd_data[0].upper() == "GET":
+        if cmd_data[0].upper() == "RESETSTAT":
+            for command in self.server.commands.values():
+                command.reset_stats()
+            return self.encoder.generate_success_string()
+        if len(cmd_data) > 1 and cmd_data[0].upper() == "GET":
             if cmd_data[1].upper() == "DIR":
                 response = ["dir", self.server.get_rdb_dir()]
                 return self.encoder.generate_array_string(response)
             elif cmd_data[1].upper() == "DBFILENAME":
                 response = ["dbfilename", self.server.get_rdb_filename()]
                 return self.encoder.generate_array_string(response)
+            elif cmd_data[1].upper() == "HZ":
+                response = ["hz", str(self.server.get_hz())]
+                return self.encoder.generate_array_string(response)
         return None
 
     def _handle_keys_command(self, data, cmd, sock):
@@ -33,91 +69,469 @@ class CommandHandler:
             return self.encoder.generate_array_string(self.store.get_keys())
         return None
 
+    def get_expiry_time(self, option, amount):
+        if option == b"EX":
+            return self.store.get_current_millis() + amount * 1000
+        elif option == b"PX":
+            return self.store.get_current_millis() + amount
+        elif option == b"EXAT":
+            return amount * 1000
+        return amount
+
     def _handle_set_command(self, data, cmd, sock):
         key = cmd.data[0]
         value = cmd.data[1]
-        expiry_milliseconds = None
-        if len(cmd.data) > 2:
-            expiry_command = cmd.data[2]
-            if expiry_command.upper() == b"PX":
-                expiry_milliseconds = int(cmd.data[3].decode())
-        self.server.set_data(key.decode(), value.decode(), expiry_milliseconds)
+        expiry_time = None
+        keep_ttl = False
+        options = cmd.data[2:]
+        index = 0
+        while index < len(options):
+            option = options[index].upper()
+            if option == b"KEEPTTL" and expiry_time is None:
+                keep_ttl = True
+                index += 1
+                continue
+            if (
+                option not in (b"EX", b"PX", b"EXAT", b"PXAT")
+                or index + 1 >= len(options)
+                or expiry_time is not None
+                or keep_ttl
+            ):
+                return self.encoder.generate_error_string("ERR syntax error")
+            try:
+                amount = int(options[index + 1].decode())
+            except ValueError:
+                return self.encoder.generate_error_string(
+                    "ERR value is not an integer or out of range"
+                )
+            if amount <= 0:
+                return self.encoder.generate_error_string(
+                    "ERR invalid expire time in 'set' command"
+                )
+            expiry_time = self.get_expiry_time(option, amount)
+            index += 2
+        if keep_ttl:
+            expiry_time = self.store.get_expiry(key)
+        elif expiry_time is not None and option != b"PXAT":
+            # Replicas and the AOF get the absolute time, a relative one
+            # would restart when the AOF is replayed.
+            command = [b"SET", key, value, b"PXAT", b"%d" % expiry_time]
+            cmd.set_raw(self.encoder.generate_array_string(command))
+        self.server.set_data(key, value, expiry_time)
         return self.get_set_success_response()
 
     def _handle_get_command(self, data, cmd, sock):
-        key = cmd.data[0].decode()
-        value = self.server.get_data(key)
+        key = cmd.data[0]
+        try:
+            value = self.server.get_data(key)
+        except WrongType as e:
+            return self.encoder.generate_error_string(str(e))
         print(f"Getting value for key {key}", value)
-        if value:
+        if value is not None:
             response_msg = self.server.encoder.generate_bulkstring(value)
         else:
             response_msg = self.server.encoder.generate_null_string()
         return response_msg
 
+    def _handle_ttl_command(self, data, cmd, sock):
+        ttl = self.store.get_ttl_millis(cmd.data[0])
+        if ttl > 0:
+            ttl = (ttl + 500) // 1000
+        return self.encoder.generate_integer_string(ttl)
+
+    def _handle_pttl_command(self, data, cmd, sock):
+        ttl = self.store.get_ttl_millis(cmd.data[0])
+        return self.encoder.generate_integer_string(ttl)
+
+    def _handle_persist_command(self, data, cmd, sock):
+        persisted = self.store.persist(cmd.data[0])
+        return self.encoder.generate_integer_string(int(persisted))
+
+    def _handle_mget_command(self, data, cmd, sock):
+        return self.encoder.generate_array_string(self.store.get_many(cmd.data))
+
+    def get_pairs(self, cmd):
+        if len(cmd.data) % 2:
+            return None
+        return list(zip(cmd.data[0::2], cmd.data[1::2]))
+
+    def _handle_mset_command(self, data, cmd, sock):
+        pairs = self.get_pairs(cmd)
+        if pairs is None:
+            return self.encoder.generate_error_string(
+                "ERR wrong number of arguments for 'mset' command"
+            )
+        self.store.set_many(pairs)
+        return self.get_set_success_response()
+
+    def _handle_msetnx_command(self, data, cmd, sock):
+        pairs = self.get_pairs(cmd)
+        if pairs is None:
+            return self.encoder.generate_error_string(
+                "ERR wrong number of arguments for 'msetnx' command"
+            )
+        done = self.store.set_many_if_none_exist(pairs)
+        return self.encoder.generate_integer_string(int(done))
+
+    def _handle_del_command(self, data, cmd, sock):
+        deleted = self.store.delete_many(cmd.data)
+        return self.encoder.generate_integer_string(deleted)
+
+    def _handle_unlink_command(self, data, cmd, sock):
+        # Values are freed by the garbage collector either way, so there is
+        # nothing to hand over to a background thread.
+        return self._handle_del_command(data, cmd, sock)
+
+    def _handle_exists_command(self, data, cmd, sock):
+        count = self.store.count_existing(cmd.data)
+        return self.encoder.generate_integer_string(count)
+
+    def increment(self, key, delta):
+        try:
+            value = self.store.increment(key, delta)
+        except (InvalidValue, WrongType) as e:
+            return self.encoder.generate_error_string(str(e))
+        return self.encoder.generate_integer_string(value)
+
+    def _handle_incr_command(self, data, cmd, sock):
+        return self.increment(cmd.data[0], 1)
+
+    def _handle_decr_command(self, data, cmd, sock):
+        return self.increment(cmd.data[0], -1)
+
+    def _handle_incrby_command(self, data, cmd, sock):
+        delta = parse_long(cmd.data[1])
+        if delta is None:
+            return self.encoder.generate_error_string(
+                "ERR value is not an integer or out of range"
+            )
+        return self.increment(cmd.data[0], delta)
+
+    def _handle_decrby_command(self, data, cmd, sock):
+        delta = parse_long(cmd.data[1])
+        if delta is None:
+            return self.encoder.generate_error_string(
+                "ERR value is not an integer or out of range"
+            )
+        if delta == LLONG_MIN:
+            return self.encoder.generate_error_string("ERR decrement would overflow")
+        return self.increment(cmd.data[0], -delta)
+
+    def _handle_incrbyfloat_command(self, data, cmd, sock):
+        key = cmd.data[0]
+        delta = parse_double(cmd.data[1])
+        if delta is None or math.isinf(delta):
+            return self.encoder.generate_error_string("ERR value is not a valid float")
+        try:
+            value = self.store.increment_float(key, delta)
+        except (InvalidValue, WrongType) as e:
+            return self.encoder.generate_error_string(str(e))
+        # Replicas and the AOF get the result, float additions could round
+        # differently there.
+        command = [b"SET", key, value, b"KEEPTTL"]
+        cmd.set_raw(self.encoder.generate_array_string(command))
+        return self.encoder.generate_bulkstring(value)
+
+    def _handle_object_command(self, data, cmd, sock):
+        if cmd.data[0].upper() != b"ENCODING" or len(cmd.data) != 2:
+            return self.encoder.generate_error_string(
+                f"ERR unknown subcommand or wrong number of arguments for "
+                f"'{cmd.data[0].decode(errors='replace')}'. Try OBJECT HELP."
+            )
+        encoding = self.store.get_encoding(cmd.data[1])
+        if encoding is None:
+            return self.encoder.generate_null_string()
+        return self.encoder.generate_bulkstring(encoding)
+
     def handle_replication_command(self, data, cmd, sock):
         server_type = self.server.get_server_type()
         messages = [
             f"role:{server_type.value}",
+            f"connected_slaves:{self.server.get_replica_count()}",
+            f"master_replid:{self.server.get_replid()}",
+            f"master_repl_offset:{self.server.get_repl_offset()}",
         ]
-        if self.server.server_type == self.server.ServerType.MASTER:
+        if self.server.is_replica():
+            messages.extend(self.get_master_link_info())
+        else:
+            messages.extend(self.get_replicas_info())
+        backlog = self.server.repl_backlog
+        if backlog:
             messages.extend(
                 [
-                    f"master_replid:{self.server.get_replid()}",
-                    f"master_repl_offset:{self.server.get_repl_offset()}",
+                    "repl_backlog_active:1",
+                    f"repl_backlog_size:{backlog.size}",
+                    f"repl_backlog_first_byte_offset:{backlog.start_offset + 1}",
+                    f"repl_backlog_histlen:{backlog.histlen}",
                 ]
             )
         response_msg = self.server.encoder.generate_bulkstring("\n".join(messages))
-        self.server.log("Sending replication info", response_msg)
+        self.server.log("Sending replication info %s", response_msg)
         return response_msg
 
+    def get_master_link_info(self):
+        server = self.server
+        synced = server.is_master_link_synced()
+        connection = server.master_connection
+        syncing = connection is not None and connection.is_syncing()
+        messages = [
+            f"master_host:{server.master_server}",
+            f"master_port:{server.master_port}",
+            f"master_link_status:{'up' if synced else 'down'}",
+            f"master_last_io_seconds_ago:{server.get_master_last_io_seconds()}",
+            f"master_sync_in_progress:{int(syncing)}",
+            f"slave_repl_offset:{server.get_repl_offset()}",
+            f"slave_read_only:{int(server.replica_read_only)}",
+            f"slave_max_staleness:{server.replica_max_staleness}",
+        ]
+        if not synced:
+            down = server.get_master_link_down_seconds()
+            messages.append(f"master_link_down_since_seconds:{down}")
+        return messages
+
+    def get_replicas_info(self):
+        messages = []
+        for i, replica in enumerate(self.server.replicas):
+            messages.append(
+                f"slave{i}:ip={replica.addr[0]},port={replica.listening_port},"
+                f"state={replica.state.value},offset={replica.ack_offset},"
+                f"lag={replica.get_lag_seconds()}"
+            )
+        return messages
+
+    def format_status(self, ok):
+        return "ok" if ok else "err"
+
+    def get_loading_info(self):
+        server = self.server
+        total = server.loading_total_bytes
+        loaded = server.loading_loaded_bytes
+        eta = server.get_loading_eta()
+        return [
+            f"loading_start_time:{int(server.loading_start_time)}",
+            f"loading_total_bytes:{total}",
+            f"loading_loaded_bytes:{loaded}",
+            f"loading_loaded_perc:{100 * loaded / total if total else 0:.2f}",
+            f"loading_eta_seconds:{-1 if eta is None else int(eta)}",
+        ]
+
+    def handle_persistence_command(self, data, cmd, sock):
+        server = self.server
+        if server.has_rdb_child():
+            current_save_time = int(time.time() - server.rdb_save_time_start)
+        else:
+            current_save_time = -1
+        messages = [f"loading:{int(server.loading)}"]
+        if server.loading:
+            messages.extend(self.get_loading_info())
+        messages += [
+            f"rdb_changes_since_last_save:{self.store.dirty}",
+            f"rdb_bgsave_in_progress:{int(server.has_rdb_child())}",
+            f"rdb_last_save_time:{server.get_lastsave()}",
+            f"rdb_last_bgsave_status:{self.format_status(server.lastbgsave_ok)}",
+            f"rdb_last_bgsave_time_sec:{server.rdb_save_time_last}",
+            f"rdb_current_bgsave_time_sec:{current_save_time}",
+            f"rdb_saves:{server.stat_rdb_saves}",
+            f"rdb_last_cow_size:{server.stat_rdb_cow_bytes}",
+            f"latest_fork_usec:{server.stat_fork_time_usec}",
+            f"aof_enabled:{int(server.aof is not None)}",
+            f"aof_rewrite_in_progress:{int(server.has_aof_child())}",
+            f"aof_rewrite_scheduled:{int(server.aof_rewrite_scheduled)}",
+            f"aof_last_rewrite_time_sec:{server.aof_rewrite_time_last}",
+            "aof_last_bgrewrite_status:"
+            + self.format_status(server.aof_lastbgrewrite_ok),
+        ]
+        if server.aof:
+            messages.extend(
+                [
+                    "aof_last_write_status:"
+                    + self.format_status(server.aof.last_write_ok),
+                    f"aof_current_size:{server.aof.get_size()}",
+                    f"aof_buffer_length:{len(server.aof.buffer)}",
+                ]
+            )
+        return self.encoder.generate_bulkstring("\n".join(messages))
+
     def _handle_info_command(self, data, cmd, sock):
-        if cmd.data[0].upper() == b"REPLICATION":
+        section = cmd.data[0].upper() if cmd.data else b"DEFAULT"
+        if section == b"REPLICATION":
             response_msg = self.handle_replication_command(data, cmd, sock)
+        elif section == b"PERSISTENCE":
+            response_msg = self.handle_persistence_command(data, cmd, sock)
+        elif section == b"COMMANDSTATS":
+            messages = [
+                command.get_stats_line()
+                for command in self.server.commands.values()
+                if command.calls or command.rejected_calls
+            ]
+            response_msg = self.encoder.generate_bulkstring("\n".join(messages))
         else:
             response_msg = self.server.encoder.generate_bulkstring(
                 "redis_version:0.0.1"
             )
         return response_msg
 
+    def _handle_save_command(self, data, cmd, sock):
+        if self.server.has_rdb_child():
+            return self.encoder.generate_error_string(
+                "ERR Background save already in progress"
+            )
+        if self.server.rdb_save():
+            return self.encoder.generate_success_string()
+        return self.encoder.generate_error_string("ERR")
+
+    def _handle_bgsave_command(self, data, cmd, sock):
+        if self.server.has_rdb_child():
+            return self.encoder.generate_error_string(
+                "ERR Background save already in progress"
+            )
+        if self.server.has_aof_child():
+            return self.encoder.generate_error_string(
+                "ERR Another child process is active (AOF?): can't BGSAVE right now"
+            )
+        if self.server.rdb_background_save():
+            return self.encoder.generate_simple_string("Background saving started")
+        return self.encoder.generate_error_string("ERR")
+
+    def _handle_bgrewriteaof_command(self, data, cmd, sock):
+        if self.server.has_aof_child():
+            return self.encoder.generate_error_string(
+                "ERR Background append only file rewriting already in progress"
+            )
+        if self.server.has_rdb_child():
+            # Started by server_cron once the save is over.
+            self.server.aof_rewrite_scheduled = True
+            return self.encoder.generate_simple_string(
+                "Background append only file rewriting scheduled"
+            )
+        if self.server.rewrite_append_only_file_background():
+            return self.encoder.generate_simple_string(
+                "Background append only file rewriting started"
+            )
+        return self.encoder.generate_error_string("ERR")
+
+    def _handle_lastsave_command(self, data, cmd, sock):
+        return self.encoder.generate_integer_string(self.server.get_lastsave())
+
+    def _handle_command_command(self, data, cmd, sock):
+        commands = self.server.commands
+        if not cmd.data:
+            info = [command.get_info() for command in commands.values()]
+            return self.encoder.generate_array_string(info)
+        subcommand = cmd.data[0].upper()
+        if subcommand == b"COUNT" and len(cmd.data) == 1:
+            return self.encoder.generate_integer_string(len(commands))
+        elif subcommand == b"INFO":
+            if len(cmd.data) == 1:
+                info = [command.get_info() for command in commands.values()]
+            else:
+                names = [i.decode(errors="replace").lower() for i in cmd.data[1:]]
+                info = [
+                    commands[name].get_info() if name in commands else None
+                    for name in names
+                ]
+            return self.encoder.generate_array_string(info)
+        return self.encoder.generate_error_string(
+            f"ERR unknown subcommand '{cmd.data[0].decode(errors='replace')}'."
+        )
+
     def _handle_echo_command(self, data, cmd, sock):
-        echo_message = " ".join([i.decode() for i in cmd.data])
+        echo_message = b" ".join(cmd.data)
         response_msg = self.server.encoder.generate_bulkstring(echo_message)
         return response_msg
 
     def _handle_ping_command(self, data, cmd, sock):
-        return self.server.encoder.generate_bulkstring("PONG")
+        if cmd.data:
+            return self.encoder.generate_bulkstring(cmd.data[0])
+        return self.encoder.generate_simple_string("PONG")
 
     def _handle_replconf_command(self, data, cmd, sock):
+        # Options come in name value pairs.
+        if not cmd.data or len(cmd.data) % 2:
+            return self.encoder.generate_error_string("ERR syntax error")
         if cmd.data[0] == b"ACK":
-            offset_count = int(cmd.data[1].decode())
+            offset_count = parse_long(cmd.data[1])
+            if offset_count is None:
+                return self.encoder.generate_error_string(
+                    "ERR value is not an integer or out of range"
+                )
             self.server.received_replica_offset(offset_count, sock)
             return None
+        if cmd.data[0].lower() == b"listening-port":
+            port = parse_long(cmd.data[1])
+            if port is None:
+                return self.encoder.generate_error_string(
+                    "ERR value is not an integer or out of range"
+                )
+            data.listening_port = port
+        elif cmd.data[0].lower() == b"capa":
+            # REPLCONF capa eof capa psync2, options can be repeated.
+            for option, value in zip(cmd.data[0::2], cmd.data[1::2]):
+                if option.lower() == b"capa":
+                    data.replica_capa.add(value.lower())
         return self.encoder.generate_success_string()
 
     def _handle_psync_command(self, data, cmd, sock):
-        self.server.add_replica(data.addr, cmd.data[0], cmd.data[1], sock)
+        server = self.server
+        if server.server_type == server.ServerType.SLAVE:
+            # Sub-replicas get the dataset and stream of this replica's master.
+            if not server.is_master_link_synced():
+                return self.encoder.generate_error_string(
+                    "NOMASTERLINK Can't SYNC while not connected with my master"
+                )
+        replid, offset = cmd.get_decoded_data()[:2]
+        try:
+            psync_offset = int(offset)
+        except ValueError:
+            return self.encoder.generate_error_string(
+                "ERR value is not an integer or out of range"
+            )
+        missing = self.server.try_partial_resync(replid, psync_offset)
+        if missing is not None:
+            replica = self.server.add_replica(
+                data.addr, replid, psync_offset, sock, ack_offset=psync_offset - 1
+            )
+            replica.listening_port = data.listening_port
+            continue_message = self.encoder.generate_simple_string(
+                f"CONTINUE {self.server.get_replid()}"
+            )
+            return continue_message + missing
+        replica = self.server.add_replica(data.addr, cmd.data[0], cmd.data[1], sock)
+        replica.listening_port = data.listening_port
+        replica.capa_eof = b"eof" in data.replica_capa
         resync_string = (
             f"FULLRESYNC {self.server.get_replid()} {self.server.get_repl_offset()}"
         )
         resync_message = self.server.encoder.generate_simple_string(resync_string)
-        file_message = self.encoder.generate_file_string(
-            self.server.get_rdb_file_contents()
-        )
-        return resync_message + file_message
+        # The RDB file follows once generated.
+        self.server.start_full_resync(replica)
+        return resync_message
 
     def _handle_ok_command(self, data, cmd, sock):
         return None
 
     def _handle_wait_command(self, data, cmd, sock):
-        min_required = int(cmd.data[0].decode())
-        timeout = int(cmd.data[1].decode())
+        if self.server.server_type == self.server.ServerType.SLAVE:
+            # A GETACK would add to the stream relayed from the master.
+            return self.encoder.generate_error_string(
+                "ERR WAIT cannot be used with replica instances"
+            )
+        min_required = parse_long(cmd.data[0])
+        timeout = parse_long(cmd.data[1])
+        if min_required is None or timeout is None:
+            return self.encoder.generate_error_string(
+                "ERR value is not an integer or out of range"
+            )
+        if timeout < 0:
+            return self.encoder.generate_error_string("ERR timeout is negative")
         print("Min required", min_required, "Timeout", timeout)
-        self.server.add_waiter(sock, min_required, timeout)
-        self.server.check_with_replicas()
-        return None
+        acked = self.server.wait_for_replicas(sock, min_required, timeout)
+        if acked is None:
+            return None
+        return self.encoder.generate_integer_string(acked)
 
     def _handle_type_command(self, data, cmd, sock):
-        key = cmd.data[0].decode()
+        key = cmd.data[0]
         type_value = self.store.get_type(key)
         if type_value:
             response_msg = self.encoder.generate_bulkstring(type_value)
@@ -126,76 +540,202 @@ class CommandHandler:
         return response_msg
 
     def _handle_xadd_command(self, data, cmd, sock):
-        key = cmd.data[0].decode()
+        key = cmd.data[0]
         identifier = cmd.data[1].decode()
-        values = [i.decode() for i in cmd.data[2:]]
+        values = cmd.data[2:]
         saved_id = None
         try:
             saved_id, saved_values = self.store.add_stream_data(key, values, identifier)
+        except InvalidStreamId as e:
+            return self.encoder.generate_error_string(str(e))
         except ValueError as e:
             return self.encoder.generate_error_string(
                 "ERR The ID specified in XADD is equal or smaller than the target stream top item"
             )
-        except ZeroIdentifier as e:
+        except (ZeroIdentifier, WrongType) as e:
             return self.encoder.generate_error_string(str(e))
         if saved_id:
-            data = [[key, [[saved_id, saved_values]]]]
-            self.server.send_data_to_stream_clients(key, saved_id, data)
+            if saved_id != identifier:
+                # Replicas and the AOF get the generated id, not the "*".
+                command = [b"XADD", key, saved_id, *values]
+                cmd.set_raw(self.encoder.generate_array_string(command))
+            self.server.signal_key_as_ready(key)
         return self.encoder.generate_simple_string(saved_id)
 
+    def parse_count(self, value):
+        count = int(value.decode())
+        if count < 0:
+            raise ValueError("Negative count")
+        return count
+
     def _handle_xrange_command(self, data, cmd, sock):
-        key = cmd.data[0].decode()
+        key = cmd.data[0]
         start = cmd.data[1].decode()
         end = cmd.data[2].decode()
-        messages = self.store.get_stream_range(key, start, end)
+        count = None
+        if len(cmd.data) > 3:
+            if len(cmd.data) != 5 or cmd.data[3].upper() != b"COUNT":
+                return self.encoder.generate_error_string("ERR syntax error")
+            try:
+                count = self.parse_count(cmd.data[4])
+            except ValueError:
+                return self.encoder.generate_error_string(
+                    "ERR value is not an integer or out of range"
+                )
+            if count == 0:
+                return self.encoder.generate_array_string([])
+        try:
+            messages = self.store.get_stream_range(key, start, end, count)
+        except ValueError:
+            return self.encoder.generate_error_string(
+                "ERR Invalid stream ID specified as stream command argument"
+            )
         return self.encoder.generate_array_string(messages)
 
     def _handle_xread_command(self, data, cmd, sock):
-        type_value = cmd.data[0].decode()
-        if type_value == "streams":
-            messages = []
-            stream_data = cmd.data[1:]
-            length = len(stream_data)
-            print("Stream data", stream_data)
-            for key, identifier in list(
-                zip(stream_data[: length // 2], stream_data[length // 2 :])
-            ):
-                print(f"key: {key}, identifier: {identifier}")
-                message = self.store.get_stream_read(key.decode(), identifier.decode())
-                if message:
-                    messages.append(message)
+        count = None
+        timeout = None
+        index = 0
+        try:
+            while index < len(cmd.data) and cmd.data[index].upper() != b"STREAMS":
+                option = cmd.data[index].upper()
+                if option == b"COUNT" and index + 1 < len(cmd.data):
+                    count = self.parse_count(cmd.data[index + 1])
+                elif option == b"BLOCK" and index + 1 < len(cmd.data):
+                    timeout = self.parse_count(cmd.data[index + 1])
+                else:
+                    return self.encoder.generate_error_string("ERR syntax error")
+                index += 2
+        except ValueError:
+            return self.encoder.generate_error_string(
+                "ERR value is not an integer or out of range"
+            )
+        stream_data = cmd.data[index + 1 :]
+        length = len(stream_data)
+        if index >= len(cmd.data) or length == 0:
+            return self.encoder.generate_error_string("ERR syntax error")
+        if length % 2:
+            return self.encoder.generate_error_string(
+                "ERR Unbalanced 'xread' list of streams: for each stream key "
+                "an ID or '$' must be specified."
+            )
+        keys = stream_data[: length // 2]
+        identifiers = [i.decode() for i in stream_data[length // 2 :]]
+        messages = []
+        stream_ids = {}
+        for key, identifier in zip(keys, identifiers):
+            # "$" means entries added after this command, so there is
+            # nothing to read right now.
+            if identifier == "$":
+                stream = self.store.get_stream(key)
+                stream_ids[key] = stream.last_id if stream else MIN_STREAM_ID
+                continue
+            try:
+                stream_ids[key] = parse_stream_id(identifier)
+                message = self.store.get_stream_read(key, identifier, count)
+            except ValueError:
+                return self.encoder.generate_error_string(
+                    "ERR Invalid stream ID specified as stream command argument"
+                )
+            if message:
+                messages.append(message)
+        if messages or timeout is None:
             return self.encoder.generate_array_string(messages)
-        elif type_value == "block":
-            timeout = int(cmd.data[1].decode())
-            key = cmd.data[3].decode()
-            identifier = cmd.data[4].decode()
-            self.server.add_stream_blocking_client(sock, key, identifier, timeout)
+        self.server.block_client_on_streams(sock, stream_ids, count, timeout)
         return None
 
-    def parse_message(self, message):
-        commands = self.parser.parse(message)
+    def parse_message(self, data):
+        # Every connection owns a parser so that a frame split across reads
+        # is kept until the rest of it arrives.
+        commands = data.parser.parse(data.inb)
         return commands
 
-    def handle_single_command(self, data, command, sock):
-        handler_func = getattr(self, f"_handle_{command.command.lower()}_command", None)
-        if not handler_func:
-            response_msg = self.encoder.generate_bulkstring("Unknown command")
-        else:
-            response_msg = handler_func(data, command, sock)
-        return response_msg
+    def lookup_command(self, name):
+        entry = self.dispatch_table.get(name)
+        if entry is None:
+            entry = self.dispatch_table.get(name.upper())
+        return entry
+
+    def get_unknown_command_error(self, command):
+        args = " ".join(f"'{i.decode(errors='replace')[:128]}'" for i in command.data)
+        return self.encoder.generate_error_string(
+            f"ERR unknown command '{command.command[:128]}', "
+            f"with args beginning with: {args}"
+        )
 
-    def replicate_if_required(self, command):
-        if self.server.is_write_command(command):
-            for replica in self.server.replicas:
-                replica.send_write_command(command.get_raw())
+    def get_arity_error(self, cmd, command):
+        if cmd.check_arity(len(command.data) + 1):
+            return None
+        return f"ERR wrong number of arguments for '{cmd.name}' command"
+
+    def get_rejection_error(self, cmd, command):
+        """
+        Why command can't run now, None if it can.
+        """
+        error = self.get_arity_error(cmd, command)
+        if error:
+            return error
+        server = self.server
+        if server.loading and not cmd.has_flag(CMD_LOADING):
+            return "LOADING Redis is loading the dataset in memory"
+        if server.is_replica():
+            if cmd.is_write() and server.replica_read_only:
+                return "READONLY You can't write against a read only replica."
+            if not cmd.has_flag(CMD_STALE) and server.is_replica_data_stale():
+                return (
+                    "MASTERDOWN Link with MASTER is down or idle for more than "
+                    "replica-max-staleness seconds"
+                )
+        return None
+
+    def handle_single_command(self, data, command, sock):
+        """
+        Run command without stats nor propagation, as when replaying the AOF.
+        """
+        entry = self.lookup_command(command.command)
+        if entry is None:
+            return self.get_unknown_command_error(command)
+        cmd, proc = entry
+        error = self.get_arity_error(cmd, command)
+        if error:
+            return self.encoder.generate_error_string(error)
+        return proc(data, command, sock)
+
+    def call(self, cmd, proc, data, command, sock):
+        start = time.perf_counter_ns()
+        try:
+            response = proc(data, command, sock)
+        except Exception:
+            # A bug in one command shouldn't take down the server and the
+            # connections of every other client.
+            logger.exception("Error running %r", command)
+            response = self.encoder.generate_error_string(
+                f"ERR internal error running '{cmd.name}'"
+            )
+        cmd.record_call(time.perf_counter_ns() - start, response)
+        return response
 
     def handle_message(self, data, sock):
-        commands = self.parse_message(data.outb)
+        commands = self.parse_message(data)
         print("Commands found in handler", commands)
-        response_msg = b""
+        # Replies of a pipeline are appended to one buffer, not concatenated.
+        response_msg = bytearray()
         for command in commands:
-            self.replicate_if_required(command)
-            response = self.handle_single_command(data, command, sock)
+            entry = self.lookup_command(command.command)
+            if entry is None:
+                response_msg += self.get_unknown_command_error(command)
+                continue
+            cmd, proc = entry
+            error = self.get_rejection_error(cmd, command)
+            if error:
+                cmd.rejected_calls += 1
+                response_msg += self.encoder.generate_error_string(error)
+                continue
+            dirty = self.store.dirty
+            response = self.call(cmd, proc, data, command, sock)
+            # Like in Redis, only writes that changed the dataset propagate.
+            if cmd.is_write() and self.store.dirty != dirty:
+                self.server.propagate(command.get_raw())
             if response:
                 response_msg += response
         return response_msg
@@ -210,10 +750,11 @@ class ClientCommandHandler(CommandHandler):
         WAITING_FOR_FULLRESYNC = 5
         WAITING_FOR_FILE = 6
         READY = 7
-        RECORD_OFFSET = 8
 
     state = State.WAITING_FOR_PONG
     offset_count = 0
+    rdb_loader = None
+    reply_names = MASTER_REPLIES
 
     def _handle_ping_command(self, data, cmd, sock):
         return None
@@ -233,15 +774,17 @@ class ClientCommandHandler(CommandHandler):
     def _handle_ok_command(self, data, cmd, sock):
         if self.state == self.State.WAITING_FOR_PORT_RESPONSE:
             self.state = self.State.WAITING_FOR_CAPA_RESPONSE
-            return self.encoder.generate_array_string(["REPLCONF", "capa", "psync2"])
+            return self.encoder.generate_array_string(
+                ["REPLCONF", "capa", "eof", "capa", "psync2"]
+            )
         elif self.state == self.State.WAITING_FOR_CAPA_RESPONSE:
             self.state = self.State.WAITING_FOR_FULLRESYNC
+            # After a reconnect, ask for the bytes following the ones
+            # already processed.
+            replid = self.connection.get_replica_id()
+            psync_offset = -1 if replid == "?" else self.offset_count + 1
             return self.encoder.generate_array_string(
-                [
-                    "PSYNC",
-                    str(self.connection.get_replica_id()),
-                    str(-1),
-                ]
+                ["PSYNC", str(replid), str(psync_offset)]
             )
         return super()._handle_ok_command(data, cmd, sock)
 
@@ -249,44 +792,129 @@ class ClientCommandHandler(CommandHandler):
         if self.state == self.State.WAITING_FOR_FULLRESYNC:
             replica_id, offset = cmd.data
             self.connection.set_offset_and_replica(offset.decode(), replica_id.decode())
+            # The replication offset continues from where the master's
+            # snapshot was taken.
+            self.offset_count = int(offset.decode())
+            self.server.reset_replication_stream(replica_id.decode(), self.offset_count)
             self.state = self.State.WAITING_FOR_FILE
         return None
 
+    def _handle_continue_command(self, data, cmd, sock):
+        if self.state == self.State.WAITING_FOR_FULLRESYNC:
+            # The master may have a new replid, the offset carries on.
+            if cmd.data:
+                replid = cmd.data[0].decode()
+                self.connection.set_offset_and_replica(self.offset_count, replid)
+                self.server.repl_id = replid
+            self.state = self.State.READY
+        return None
+
+    def _handle_rdbstart_command(self, data, cmd, sock):
+        # No length when the file is ended by a mark instead.
+        length = int(cmd.data[0]) if cmd.data else None
+        size = "an unknown number of" if length is None else length
+        self.server.log("Receiving RDB file of %s bytes", size)
+        self.start_rdb_loading(length)
+        if length == 0:
+            self.load_rdb_data(b"")
+        return None
+
+    def _handle_rdbdata_command(self, data, cmd, sock):
+        self.load_rdb_data(cmd.data[0])
+        return None
+
+    def _handle_rdbend_command(self, data, cmd, sock):
+        self.rdb_loader.feed_eof()
+        self.finish_rdb_loading()
+        return None
+
     def _handle_rdb_command(self, data, cmd, sock):
-        print("Received RDB file", cmd.data[0])
-        self.state = self.State.READY
+        # The whole file at once, from a parser not streaming it.
+        self.start_rdb_loading(len(cmd.data[0]))
+        self.load_rdb_data(cmd.data[0])
         return None
 
+    def start_rdb_loading(self, length):
+        # A full resync replaces whatever an earlier sync left behind.
+        self.store.flush()
+        parser = self.server.get_rdb_parser()
+        self.rdb_loader = RdbStreamLoader(parser, self.store, length)
+        self.server.start_sync_loading(length)
+
+    def load_rdb_data(self, chunk):
+        """
+        Load a chunk of the RDB file, the command stream starts once all of
+        it got loaded. Raises InvalidRdbFileException if the file is corrupt.
+        """
+        loader = self.rdb_loader
+        loader.feed(chunk)
+        self.server.loading_loaded_bytes = loader.get_loaded_bytes()
+        if loader.finished:
+            self.finish_rdb_loading()
+
+    def finish_rdb_loading(self):
+        self.rdb_loader = None
+        self.server.finish_sync_loading()
+        self.state = self.State.READY
+
+    def cancel_rdb_loading(self):
+        # Keys of a partly loaded file are no consistent dataset.
+        if self.rdb_loader is not None:
+            self.rdb_loader = None
+            self.store.flush()
+            self.server.loading = False
+
     def _handle_replconf_command(self, data, cmd, sock):
         print("Received replconf command", cmd)
         # Possible commads: listening-port, capa during handshake
         # GETACK periodically.
-        if cmd.data[0] == b"GETACK":
-            if self.state == self.State.READY:
-                self.state = self.State.RECORD_OFFSET
+        if cmd.data and cmd.data[0].upper() == b"GETACK":
             print("Sending offset count", self.offset_count)
-            return self.encoder.generate_array_string(
-                ["REPLCONF", "ACK", str(self.offset_count)]
-            )
+            return self.get_ack_message()
         return super()._handle_replconf_command(data, cmd, sock)
 
+    def get_ack_message(self):
+        return self.encoder.generate_array_string(
+            ["REPLCONF", "ACK", str(self.offset_count)]
+        )
+
     def get_set_success_response(self):
         return None
 
     def increment_offset(self, command):
-        if self.state == self.State.RECORD_OFFSET:
+        # Everything the master sends after the RDB file is part of the
+        # replication stream, including PINGs and GETACKs. It is relayed as
+        # is to sub-replicas, so their offsets match the master's.
+        if self.state == self.State.READY:
             self.offset_count += command.get_size()
+            self.server.feed_replicas(command.get_raw())
             print(
                 f"Incremented offset count to {self.offset_count} Last message: ${command}, length: {command.get_size()}"
             )
 
     def handle_message(self, data, sock):
-        commands = self.parse_message(data.outb)
+        commands = self.parse_message(data)
         print("Commands found in handler", commands)
-        response_msg = b""
+        response_msg = bytearray()
         for command in commands:
-            response = self.handle_single_command(data, command, sock)
+            entry = self.lookup_command(command.command)
+            cmd = None
+            if entry is None:
+                response = self.get_unknown_command_error(command)
+            else:
+                cmd, proc = entry
+                error = self.get_arity_error(cmd, command)
+                if error:
+                    response = self.encoder.generate_error_string(error)
+                else:
+                    response = self.call(cmd, proc, data, command, sock)
+            # Once synced, the master only gets replies to REPLCONF GETACK.
+            is_synced = self.state == self.State.READY
+            if is_synced and command.command.upper() != "REPLCONF":
+                response = None
             if response:
                 response_msg += response
+            if is_synced and cmd is not None and cmd.is_write():
+                self.server.feed_append_only_file(command.get_raw())
             self.increment_offset(command)
         return response_msg
@@ -1,9 +1,50 @@
 import argparse
-from .server import RedisServer
+from .server import (
+    DEFAULT_REPL_PING_REPLICA_PERIOD,
+    DEFAULT_REPLICA_OUTPUT_LIMITS,
+    RedisServer,
+)
+from .backlog import DEFAULT_BACKLOG_SIZE
+from .aof import DEFAULT_AOF_FILENAME, FSYNC_EVERYSEC, FSYNC_POLICIES
 
 DEFAULT_PORT = 6379
 
 
+def parse_save_params(value):
+    # "<seconds> <changes> [<seconds> <changes> ...]", empty disables saving.
+    numbers = [int(i) for i in value.split()]
+    if len(numbers) % 2:
+        raise argparse.ArgumentTypeError("save needs <seconds> <changes> pairs")
+    return list(zip(numbers[0::2], numbers[1::2]))
+
+
+def parse_memory(value):
+    # "<number>[k|kb|m|mb|g|gb]", as in redis.conf.
+    units = {
+        "k": 1000,
+        "kb": 1024,
+        "m": 1000**2,
+        "mb": 1024**2,
+        "g": 1000**3,
+        "gb": 1024**3,
+    }
+    number = value.lower().rstrip("kmgb")
+    unit = value.lower()[len(number) :]
+    if not number.isdigit() or (unit and unit not in units):
+        raise argparse.ArgumentTypeError(f"Invalid memory amount: {value}")
+    return int(number) * units.get(unit, 1)
+
+
+def parse_output_buffer_limit(value):
+    # "replica <hard> <soft> <soft seconds>", the only class with a limit here.
+    parts = value.split()
+    if len(parts) != 4 or parts[0].lower() not in ("replica", "slave"):
+        raise argparse.ArgumentTypeError(
+            "client-output-buffer-limit needs replica <hard> <soft> <seconds>"
+        )
+    return parse_memory(parts[1]), parse_memory(parts[2]), int(parts[3])
+
+
 def main():
     print("Logs from your program will appear here!")
 
@@ -15,6 +56,82 @@ def main():
     )
     parser.add_argument("--dir", type=str, help="Directory where rdb file is stored.")
     parser.add_argument("--dbfilename", type=str, help="Name of the rdb file.")
+    parser.add_argument(
+        "--hz", type=int, default=10, help="Frequency of the server cron job."
+    )
+    parser.add_argument(
+        "--repl-backlog-size",
+        type=int,
+        default=DEFAULT_BACKLOG_SIZE,
+        help="Size of the replication backlog in bytes.",
+    )
+    parser.add_argument(
+        "--client-output-buffer-limit",
+        type=parse_output_buffer_limit,
+        default=DEFAULT_REPLICA_OUTPUT_LIMITS,
+        help='Replica lag limits as "replica <hard> <soft> <seconds>".',
+    )
+    parser.add_argument(
+        "--replica-read-only",
+        choices=["yes", "no"],
+        default="yes",
+        help="Refuse writes from clients when running as a replica.",
+    )
+    parser.add_argument(
+        "--replica-max-staleness",
+        type=int,
+        default=0,
+        help="Seconds without news from the master before a replica refuses "
+        "reads, 0 never refuses them.",
+    )
+    parser.add_argument(
+        "--repl-ping-replica-period",
+        type=int,
+        default=DEFAULT_REPL_PING_REPLICA_PERIOD,
+        help="Seconds between the PINGs a master sends to its replicas.",
+    )
+    parser.add_argument(
+        "--save",
+        type=parse_save_params,
+        default=None,
+        help='Snapshot policies as "<seconds> <changes> ...", "" disables them.',
+    )
+    parser.add_argument(
+        "--appendonly",
+        choices=["yes", "no"],
+        default="no",
+        help="Log every write command to the append only file.",
+    )
+    parser.add_argument(
+        "--appendfilename",
+        type=str,
+        default=DEFAULT_AOF_FILENAME,
+        help="Name of the append only file, stored in --dir.",
+    )
+    parser.add_argument(
+        "--appendfsync",
+        choices=FSYNC_POLICIES,
+        default=FSYNC_EVERYSEC,
+        help="When the append only file is synced to disk.",
+    )
+    parser.add_argument(
+        "--aof-use-rdb-preamble",
+        choices=["yes", "no"],
+        default="yes",
+        help=(
+            "Start rewritten append only files with an RDB snapshot. It is "
+            "used regardless when the keyspace holds lists, sets, hashes, "
+            "sorted sets or streams with a TTL."
+        ),
+    )
+    parser.add_argument(
+        "--rdbchecksum",
+        choices=["yes", "no"],
+        default="yes",
+        help="Write and verify the CRC64 checksum of RDB files. Without the crcmod "
+        "C extension the checksum is computed in Python at about 6 MB/s, making "
+        "saves several times slower, and loaded files are not verified.",
+    )
     args = parser.parse_args()
     replicate_server = args.replicaof.split(" ") if args.replicaof else []
     print("Replicate server", replicate_server)
@@ -27,6 +144,18 @@ def main():
         debug=True,
         rdb_dir=args.dir,
         rdb_filename=args.dbfilename,
+        hz=args.hz,
+        repl_backlog_size=args.repl_backlog_size,
+        replica_output_limits=args.client_output_buffer_limit,
+        replica_read_only=args.replica_read_only == "yes",
+        replica_max_staleness=args.replica_max_staleness,
+        repl_ping_replica_period=args.repl_ping_replica_period,
+        save_params=args.save,
+        appendonly=args.appendonly == "yes",
+        appendfilename=args.appendfilename,
+        appendfsync=args.appendfsync,
+        rdbchecksum=args.rdbchecksum == "yes",
+        aof_use_rdb_preamble=args.aof_use_rdb_preamble == "yes",
         *replicate_server,
     )
     server.run()
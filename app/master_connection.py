@@ -1,7 +1,8 @@
 import selectors
 from .handler import ClientCommandHandler
 from .encoder import Encoder
-from .parser import RespParser
+from .rdb.parser import InvalidRdbFileException
+from .timer import monotonic_millis
 
 
 class MasterConnection:
@@ -18,34 +19,61 @@ class MasterConnection:
         self.listening_port = listening_port
         self.socket = socket
         self.encoder = Encoder()
-        self.parser = RespParser()
         self.command_handler = ClientCommandHandler(server, server.store, self)
 
     def service_connection(self, key, mask):
         sock = key.fileobj
         data = key.data
         if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(1024)
-            if recv_data:
-                data.outb += recv_data
-                self.log("Received", repr(recv_data), "from", data.addr)
-            else:
-                self.log("Closing connection to", data.addr)
-                self.server.close_connection(sock)
-        if mask & selectors.EVENT_WRITE:
+            if not self.server.read_from_client(sock, data):
+                return
+            self.server.master_last_io = monotonic_millis()
             self.handle_incoming_data(data, sock)
-            data.outb = b""
+        if mask & selectors.EVENT_WRITE:
+            self.server.write_to_client(sock, data)
+
+    def reconnected(self, socket):
+        # The cached replid and offset are kept so the handshake can ask
+        # for a partial resync.
+        self.socket = socket
+        self.command_handler.state = self.command_handler.State.WAITING_FOR_PONG
+
+    def connection_lost(self):
+        self.log("Lost connection to master")
+        self.command_handler.cancel_rdb_loading()
+        self.command_handler.state = self.command_handler.State.INIT
+
+    def is_synced(self):
+        return self.command_handler.state == self.command_handler.State.READY
+
+    def is_syncing(self):
+        return self.command_handler.state == self.command_handler.State.WAITING_FOR_FILE
+
+    def send_ping(self):
+        print("Sending ping to master")
+        ping_message = self.encoder.generate_array_string(["PING"])
+        self.server.add_reply(ping_message, self.socket)
+        self.sent_ping = True
+
+    def send_ack(self):
+        if self.command_handler.state == self.command_handler.State.READY:
+            ack_message = self.command_handler.get_ack_message()
+            self.server.add_reply(ack_message, self.socket)
 
     def handle_incoming_data(self, data, sock):
-        if not self.sent_ping:
-            print("Sending ping to master")
-            sock.sendall(self.encoder.generate_array_string(["PING"]))
-            self.sent_ping = True
-        if data.outb:
-            response = self.command_handler.handle_message(data, sock)
+        if data.inb:
+            try:
+                response = self.command_handler.handle_message(data, sock)
+            except InvalidRdbFileException as e:
+                # Sync again from scratch on a new connection.
+                self.log("Failed loading the RDB file from master:", e)
+                self.server.close_connection(sock)
+                return
+            finally:
+                data.inb = b""
             print("Sending response from slave:", response)
             if response:
-                sock.sendall(response)
+                self.server.add_reply(response, sock)
 
     def log(self, message, *args):
         print("Replica: ", message, *args)
@@ -1,91 +1,191 @@
-import sys
-
 from enum import Enum
 
+# Same as Redis' PROTO_IOBUF_LEN, the amount read from a socket at a time.
+READ_BUFFER_SIZE = 16 * 1024
+# Largest bulk string and array accepted, Redis' proto-max-bulk-len default
+# and its multibulk length limit.
+PROTO_MAX_BULK_LEN = 512 * 1024 * 1024
+PROTO_MAX_MULTIBULK_LEN = (1 << 31) - 1
+# Length of the mark ending an RDB payload sent as $EOF:<mark>.
+RDB_EOF_MARK_SIZE = 40
+
+
+class ProtocolError(Exception):
+    pass
+
 
 class RespParser:
-    class State:
-        START = 0
-        COMMAND = 1
-        DATA = 2
-        DONE = 3
-
-    def __init__(self) -> None:
-        self.state = self.State.START
-
-    def read_number(self, message, cursor):
-        number = 0
-        while message[cursor] != b"\r":
-            number = number * 10 + int(message[cursor])
-            cursor += 1
-        return cursor, number
-
-    def skip_newline(self, message, cursor):
-        while message[cursor] in [b"\n", b"\r"]:
-            cursor += 1
-        return cursor
-
-    def read_command(self, message, cursor, part_length):
-        while message[cursor] != b"$":
-            cursor += 1
-
-        cursor, command_length = self.read_number(message, cursor + 1)
-        cursor = self.skip_newline(message, cursor)
-        command_string = b"".join(message[cursor : cursor + command_length])
-        cursor += command_length
-        command = Command(command_string.decode(), [])
-        part_length -= 1
-        while part_length > 0:
-            while message[cursor] != b"$":
-                cursor += 1
-            cursor, data_length = self.read_number(message, cursor + 1)
-            cursor = self.skip_newline(message, cursor)
-            data = b"".join(message[cursor : cursor + data_length])
-            cursor += data_length
-            command.add_data(data)
-            part_length -= 1
-        return cursor, command
-
-    def read_pending_bytes(self, message, cursor):
-        data = b""
-        while message[cursor] != b"\r":
-            data += message[cursor]
-            cursor += 1
-        return cursor, data
-
-    def read_bytes(self, message, length, cursor):
-        data = b"".join(message[cursor : cursor + length])
-        cursor += length
-        return cursor, data
-
-    def parse(self, msg):
+    ARRAY = ord("*")
+    BULK_STRING = ord("$")
+    SIMPLE_STRING = ord("+")
+    ERROR = ord("-")
+    INTEGER = ord(":")
+    CRLF = b"\r\n"
+
+    def __init__(self, stream_rdb=False) -> None:
+        # Bytes received from the peer that do not form a complete frame yet.
+        self.buffer = bytearray()
+        # With stream_rdb the RDB payload is returned in chunks as it arrives,
+        # an RDBSTART command with its length followed by RDBDATA commands.
+        # A payload framed with an end mark has no length and is followed by
+        # an RDBEND command.
+        self.stream_rdb = stream_rdb
+        self.payload_remaining = 0
+        self.eof_mark = None
+
+    def read_line(self, buffer, cursor):
+        end = buffer.find(self.CRLF, cursor)
+        if end == -1:
+            return None
+        return end
+
+    def read_length(self, buffer, cursor, end, limit):
+        """
+        Length of a bulk string or array, -1 for a null one. Anything else
+        out of 0..limit is a protocol error, a negative length would move the
+        cursor backwards.
+        """
+        try:
+            length = int(buffer[cursor:end])
+        except ValueError:
+            raise ProtocolError(f"Invalid length: {bytes(buffer[cursor:end])}")
+        if length < -1 or length > limit:
+            raise ProtocolError(f"Invalid length: {length}")
+        return length
+
+    def decode_name(self, name):
+        try:
+            return name.decode()
+        except UnicodeDecodeError:
+            raise ProtocolError(f"Invalid command name: {name!r}")
+
+    def read_array(self, buffer, view, cursor):
+        end = self.read_line(buffer, cursor)
+        if end is None:
+            return None
+        part_length = self.read_length(
+            buffer, cursor + 1, end, PROTO_MAX_MULTIBULK_LEN
+        )
+        position = end + 2
+        parts = []
+        for _ in range(part_length):
+            if position >= len(buffer):
+                return None
+            if buffer[position] != self.BULK_STRING:
+                raise ProtocolError(f"Expected '$', got '{chr(buffer[position])}'")
+            end = self.read_line(buffer, position)
+            if end is None:
+                return None
+            data_length = self.read_length(
+                buffer, position + 1, end, PROTO_MAX_BULK_LEN
+            )
+            if data_length < 0:
+                raise ProtocolError("Null bulk string in a command")
+            start = end + 2
+            position = start + data_length + 2
+            if position > len(buffer):
+                return None
+            parts.append(view[start : start + data_length].tobytes())
+        if not parts:
+            return position, None
+        command = Command(self.decode_name(parts[0]), parts[1:])
+        command.set_size(position - cursor)
+        command.set_raw(view[cursor:position].tobytes())
+        return position, command
+
+    def read_simple_string(self, buffer, view, cursor):
+        end = self.read_line(buffer, cursor)
+        if end is None:
+            return None
+        parts = view[cursor + 1 : end].tobytes().split()
+        if not parts:
+            return end + 2, None
+        return end + 2, Command(self.decode_name(parts[0]), data=parts[1:])
+
+    def read_rdb(self, buffer, view, cursor):
+        # The RDB payload is sent as "$<length>\r\n<contents>" without a
+        # trailing CRLF, so it can't be read as a regular bulk string.
+        end = self.read_line(buffer, cursor)
+        if end is None:
+            return None
+        if self.stream_rdb and buffer.startswith(b"$EOF:", cursor):
+            mark = bytes(buffer[cursor + 5 : end])
+            if len(mark) != RDB_EOF_MARK_SIZE:
+                raise ProtocolError(f"Invalid RDB end mark: {mark}")
+            self.eof_mark = mark
+            return end + 2, Command("RDBSTART")
+        data_length = self.read_length(buffer, cursor + 1, end, PROTO_MAX_BULK_LEN)
+        start = end + 2
+        if data_length < 0:
+            return start, None
+        if self.stream_rdb:
+            self.payload_remaining = data_length
+            return start, Command("RDBSTART", [b"%d" % data_length])
+        if start + data_length > len(buffer):
+            return None
+        contents = view[start : start + data_length].tobytes()
+        return start + data_length, Command("RDB", [contents])
+
+    def read_payload(self, buffer, view, cursor):
+        end = min(len(buffer), cursor + self.payload_remaining)
+        self.payload_remaining -= end - cursor
+        return end, Command("RDBDATA", [view[cursor:end].tobytes()])
+
+    def read_marked_payload(self, buffer, view, cursor):
+        mark = self.eof_mark
+        end = buffer.find(mark, cursor)
+        if end == cursor:
+            self.eof_mark = None
+            return cursor + len(mark), Command("RDBEND")
+        if end == -1:
+            # The tail may be the start of the mark.
+            end = len(buffer) - len(mark) + 1
+            if end <= cursor:
+                return None
+        return end, Command("RDBDATA", [view[cursor:end].tobytes()])
+
+    def skip_line(self, buffer, cursor):
+        end = self.read_line(buffer, cursor)
+        if end is None:
+            return None
+        return end + 2, None
+
+    def read_frame(self, buffer, view, cursor):
+        marker = buffer[cursor]
+        if marker == self.ARRAY:
+            return self.read_array(buffer, view, cursor)
+        elif marker == self.SIMPLE_STRING:
+            return self.read_simple_string(buffer, view, cursor)
+        elif marker == self.BULK_STRING:
+            return self.read_rdb(buffer, view, cursor)
+        elif marker in (self.ERROR, self.INTEGER):
+            return self.skip_line(buffer, cursor)
+        return cursor + 1, None
+
+    def parse(self, msg=b""):
+        """
+        Append msg to the pending buffer and return every complete command in
+        it. Bytes of a trailing incomplete frame stay buffered for the next call.
+        """
+        if msg:
+            self.buffer += msg
+        buffer = self.buffer
         cursor = 0
-        part_length = 0
         commands = []
-        message = [i.to_bytes(1, sys.byteorder) for i in msg]
-        while cursor < len(message):
-            if message[cursor] == b"*":
-                cursor_start = cursor
-                cursor, part_length = self.read_number(message, cursor + 1)
-                cursor, command = self.read_command(message, cursor, part_length)
-                size = cursor - cursor_start + 2  # 2 for \r\n
-                command.set_size(size)
-                command.set_raw(b"".join(message[cursor_start : cursor + 2]))
-                commands.append(command)
-                cursor += 1
-            elif message[cursor] == b"+":
-                cursor, string = self.read_pending_bytes(message, cursor + 1)
-                parts = string.split()
-                command = Command(parts[0].decode(), data=parts[1:])
-                commands.append(command)
-                cursor += 1
-            elif message[cursor] == b"$":
-                cursor, data_length = self.read_number(message, cursor + 1)
-                cursor = self.skip_newline(message, cursor)
-                cursor, data = self.read_bytes(message, data_length, cursor)
-                commands.append(Command("RDB", [data]))
-            else:
-                cursor += 1
+        with memoryview(buffer) as view:
+            while cursor < len(buffer):
+                if self.payload_remaining:
+                    frame = self.read_payload(buffer, view, cursor)
+                elif self.eof_mark:
+                    frame = self.read_marked_payload(buffer, view, cursor)
+                else:
+                    frame = self.read_frame(buffer, view, cursor)
+                if frame is None:
+                    break
+                cursor, command = frame
+                if command:
+                    commands.append(command)
+        del buffer[:cursor]
         return commands
 
 
@@ -0,0 +1,70 @@
+import struct
+
+try:
+    import crcmod
+    # Without its C extension crcmod is slower than the tables below.
+    import crcmod._crcfunext  # noqa: F401
+except ImportError:
+    crcmod = None
+
+# CRC-64/Jones as used by Redis for the RDB checksum: reflected polynomial,
+# zero initial value and no final xor.
+CRC64_POLY = 0x95AC9329AC4BC9B5
+# The same polynomial, not reflected, with its x^64 term as crcmod wants it.
+CRC64_POLY_FULL = 0x1AD93D23594C935A9
+
+
+def _build_tables():
+    # Slicing-by-8: tables[k][b] is the crc of byte b followed by k zero
+    # bytes, so eight bytes are folded in with eight lookups.
+    first = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ CRC64_POLY if crc & 1 else crc >> 1
+        first.append(crc)
+    tables = [first]
+    for _ in range(7):
+        previous = tables[-1]
+        tables.append([first[crc & 0xFF] ^ (crc >> 8) for crc in previous])
+    return tables
+
+
+CRC64_TABLES = _build_tables()
+
+
+def crc64_python(crc, data):
+    """
+    Update crc with data, so a checksum can be computed a chunk at a time.
+    It runs at a few MB/s; crc64 uses crcmod instead when it is installed.
+    """
+    t0, t1, t2, t3, t4, t5, t6, t7 = CRC64_TABLES
+    tail = len(data) % 8
+    view = memoryview(data)
+    for (word,) in struct.iter_unpack("<Q", view[: len(data) - tail]):
+        crc ^= word
+        crc = (
+            t7[crc & 0xFF]
+            ^ t6[(crc >> 8) & 0xFF]
+            ^ t5[(crc >> 16) & 0xFF]
+            ^ t4[(crc >> 24) & 0xFF]
+            ^ t3[(crc >> 32) & 0xFF]
+            ^ t2[(crc >> 40) & 0xFF]
+            ^ t1[(crc >> 48) & 0xFF]
+            ^ t0[crc >> 56]
+        )
+    for byte in view[len(data) - tail :]:
+        crc = t0[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+if crcmod is not None:
+    _crc64_native = crcmod.mkCrcFun(CRC64_POLY_FULL, initCrc=0, rev=True, xorOut=0)
+
+    def crc64(crc, data):
+        return _crc64_native(data, crc)
+
+    HAS_NATIVE_CRC64 = True
+else:
+    crc64 = crc64_python
+    HAS_NATIVE_CRC64 = False
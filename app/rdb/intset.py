@@ -0,0 +1,29 @@
+"""
+Intset serialization, the sorted array of integers Redis uses for small
+sets holding only integers.
+"""
+
+import struct
+
+INTSET_HEADER_SIZE = 8
+INTSET_FORMATS = {2: "h", 4: "i", 8: "q"}
+
+
+class InvalidIntsetException(Exception):
+    pass
+
+
+def check_intset(data):
+    width = int.from_bytes(data[0:4], "little")
+    length = int.from_bytes(data[4:8], "little")
+    if width not in INTSET_FORMATS:
+        raise InvalidIntsetException(f"Invalid intset encoding: {width}")
+    if INTSET_HEADER_SIZE + width * length != len(data):
+        raise InvalidIntsetException(f"Intset of {length} in {len(data)} bytes")
+    return width, length
+
+
+def decode_intset(data):
+    width, length = check_intset(data)
+    integers = f"<{length}{INTSET_FORMATS[width]}"
+    return list(struct.unpack_from(integers, data, INTSET_HEADER_SIZE))
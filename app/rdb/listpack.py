@@ -0,0 +1,145 @@
+"""
+Listpack serialization, the compact encoding Redis uses for small
+aggregates and stream nodes inside RDB files.
+"""
+
+LISTPACK_HEADER_SIZE = 6
+LISTPACK_END = 0xFF
+# Element count stored in the header when there are too many to count.
+LISTPACK_COUNT_UNKNOWN = 65535
+
+
+class InvalidListpackException(Exception):
+    pass
+
+
+def encode_backlen(length):
+    if length <= 127:
+        return bytes([length])
+    elif length < 16383:
+        return bytes([length >> 7, (length & 127) | 128])
+    elif length < 2097151:
+        return bytes(
+            [length >> 14, ((length >> 7) & 127) | 128, (length & 127) | 128]
+        )
+    elif length < 268435455:
+        return bytes(
+            [
+                length >> 21,
+                ((length >> 14) & 127) | 128,
+                ((length >> 7) & 127) | 128,
+                (length & 127) | 128,
+            ]
+        )
+    return bytes(
+        [
+            length >> 28,
+            ((length >> 21) & 127) | 128,
+            ((length >> 14) & 127) | 128,
+            ((length >> 7) & 127) | 128,
+            (length & 127) | 128,
+        ]
+    )
+
+
+def backlen_size(length):
+    if length <= 127:
+        return 1
+    elif length < 16383:
+        return 2
+    elif length < 2097151:
+        return 3
+    elif length < 268435455:
+        return 4
+    return 5
+
+
+def encode_integer(value):
+    if 0 <= value <= 127:
+        return bytes([value])
+    elif -4096 <= value <= 4095:
+        value &= 0x1FFF
+        return bytes([0xC0 | (value >> 8), value & 0xFF])
+    elif -(1 << 15) <= value < (1 << 15):
+        return b"\xf1" + value.to_bytes(2, "little", signed=True)
+    elif -(1 << 23) <= value < (1 << 23):
+        return b"\xf2" + value.to_bytes(3, "little", signed=True)
+    elif -(1 << 31) <= value < (1 << 31):
+        return b"\xf3" + value.to_bytes(4, "little", signed=True)
+    return b"\xf4" + value.to_bytes(8, "little", signed=True)
+
+
+def encode_string(value):
+    length = len(value)
+    if length < 64:
+        return bytes([0x80 | length]) + value
+    elif length < 4096:
+        return bytes([0xE0 | (length >> 8), length & 0xFF]) + value
+    return b"\xf0" + length.to_bytes(4, "little") + value
+
+
+def encode_listpack(elements):
+    """
+    Serialize elements, ints are stored with integer encodings and str or
+    bytes as strings.
+    """
+    body = bytearray()
+    for element in elements:
+        if isinstance(element, int):
+            entry = encode_integer(element)
+        else:
+            if isinstance(element, str):
+                element = element.encode("utf-8", "surrogateescape")
+            entry = encode_string(element)
+        body += entry
+        body += encode_backlen(len(entry))
+    total = LISTPACK_HEADER_SIZE + len(body) + 1
+    count = min(len(elements), LISTPACK_COUNT_UNKNOWN)
+    return (
+        total.to_bytes(4, "little")
+        + count.to_bytes(2, "little")
+        + bytes(body)
+        + bytes([LISTPACK_END])
+    )
+
+
+def decode_listpack(data):
+    """
+    Elements of a serialized listpack, integers as int and strings as bytes.
+    """
+    total = int.from_bytes(data[0:4], "little")
+    if total != len(data):
+        raise InvalidListpackException(f"Listpack size {total} != {len(data)}")
+    elements = []
+    cursor = LISTPACK_HEADER_SIZE
+    while True:
+        byte = data[cursor]
+        if byte == LISTPACK_END:
+            break
+        if byte & 0x80 == 0:
+            element, size = byte, 1
+        elif byte & 0xC0 == 0x80:
+            length = byte & 0x3F
+            element, size = bytes(data[cursor + 1 : cursor + 1 + length]), 1 + length
+        elif byte & 0xE0 == 0xC0:
+            element = ((byte & 0x1F) << 8) | data[cursor + 1]
+            if element >= 1 << 12:
+                element -= 1 << 13
+            size = 2
+        elif byte & 0xF0 == 0xE0:
+            length = ((byte & 0x0F) << 8) | data[cursor + 1]
+            element, size = bytes(data[cursor + 2 : cursor + 2 + length]), 2 + length
+        elif byte == 0xF0:
+            length = int.from_bytes(data[cursor + 1 : cursor + 5], "little")
+            element, size = bytes(data[cursor + 5 : cursor + 5 + length]), 5 + length
+        elif 0xF1 <= byte <= 0xF4:
+            width = {0xF1: 2, 0xF2: 3, 0xF3: 4, 0xF4: 8}[byte]
+            element = int.from_bytes(
+                data[cursor + 1 : cursor + 1 + width], "little", signed=True
+            )
+            size = 1 + width
+        else:
+            raise InvalidListpackException(f"Invalid listpack encoding: {byte}")
+        elements.append(element)
+        cursor += size + backlen_size(size)
+    return elements
@@ -0,0 +1,47 @@
+class LzfError(Exception):
+    pass
+
+
+def lzf_decompress(data, expected_length):
+    """
+    Decompress an LZF block, the compression Redis uses for long strings.
+    Literal runs and back references are copied as slices, so the loop
+    runs once per LZF instruction instead of once per byte.
+    """
+    out = bytearray()
+    cursor = 0
+    end = len(data)
+    while cursor < end:
+        ctrl = data[cursor]
+        cursor += 1
+        if ctrl < 32:
+            # Literal run of ctrl + 1 bytes.
+            length = ctrl + 1
+            if cursor + length > end:
+                raise LzfError("Literal run past the end of the input")
+            out += data[cursor : cursor + length]
+            cursor += length
+            continue
+        # Back reference: length in the top 3 bits, extended by the next
+        # byte when they are all set, and a 13 bit distance.
+        length = ctrl >> 5
+        if length == 7:
+            length += data[cursor]
+            cursor += 1
+        length += 2
+        if cursor >= end:
+            raise LzfError("Back reference past the end of the input")
+        start = len(out) - ((ctrl & 0x1F) << 8) - data[cursor] - 1
+        cursor += 1
+        if start < 0:
+            raise LzfError("Back reference before the start of the output")
+        if start + length <= len(out):
+            out += out[start : start + length]
+        else:
+            # Overlapping reference, it repeats the last bytes written.
+            pattern = out[start:]
+            repeats = length // len(pattern) + 1
+            out += (pattern * repeats)[:length]
+    if len(out) != expected_length:
+        raise LzfError(f"Decompressed {len(out)} bytes instead of {expected_length}")
+    return bytes(out)
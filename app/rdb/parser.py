@@ -1,6 +1,28 @@
-import sys
-from enum import Enum
-from collections import defaultdict
+import mmap
+import os
+import struct
+
+from .crc64 import crc64
+from .intset import InvalidIntsetException, check_intset
+from .listpack import InvalidListpackException, decode_listpack, encode_listpack
+from .lzf import LzfError, lzf_decompress
+from .ziplist import InvalidZiplistException, decode_ziplist
+from ..store import (
+    OBJ_ENCODING_INTSET,
+    OBJ_ENCODING_LISTPACK,
+    OBJ_HASH,
+    OBJ_LIST,
+    OBJ_SET,
+    OBJ_STREAM,
+    OBJ_ZSET,
+    RedisObject,
+    create_string_object,
+)
+from ..stream import Stream, pack_stream_id, unpack_stream_id
+
+INT16 = struct.Struct("<h")
+INT32 = struct.Struct("<i")
+DOUBLE = struct.Struct("<d")
 
 
 class RdbData:
@@ -29,39 +51,87 @@ class InvalidRdbFileException(Exception):
 
 
 class RdbParser:
-    class State(Enum):
-        INIT = "init"
-        READ_KEYS = "read_keys"
-        DONE = "done"
+    """
+    Reads RDB files. The readers take a cursor into data, a bytes-like
+    object, and return the cursor past what they read along with the value.
+
+    load and load_file insert keys straight into a KeyValueStore, parse
+    builds an RdbData of KeyValue records instead.
+    """
 
-    state = State.INIT
     DATABASE_SELECTOR = 0xFE
-    MAGIC_BYTES = [ord("R"), ord("E"), ord("D"), ord("I"), ord("S")]
+    MAGIC_BYTES = b"REDIS"
     MILLIS_EXPIRATION = 0xFC
     SECOND_EXPIRATION = 0xFD
     RDB_FILE_END = 0xFF
-    STRING_TYPE = 0x0
     RESIZEDB_BYTE = 0xFB
+    AUX_FIELD = 0xFA
+    FREQ_BYTE = 0xF9
+    IDLE_BYTE = 0xF8
+    MODULE_AUX = 0xF7
+    FUNCTION_PRE_GA = 0xF6
+    FUNCTION2 = 0xF5
+    SLOT_INFO = 0xF4
+    STRING_TYPE = 0x0
+    LIST_TYPE = 1
+    SET_TYPE = 2
+    ZSET_TYPE = 3
+    HASH_TYPE = 4
+    ZSET_2_TYPE = 5
+    LIST_ZIPLIST_TYPE = 10
+    SET_INTSET_TYPE = 11
+    ZSET_ZIPLIST_TYPE = 12
+    HASH_ZIPLIST_TYPE = 13
+    LIST_QUICKLIST_TYPE = 14
+    HASH_LISTPACK_TYPE = 16
+    ZSET_LISTPACK_TYPE = 17
+    LIST_QUICKLIST_2_TYPE = 18
+    SET_LISTPACK_TYPE = 20
+    STREAM_LISTPACKS_TYPE = 15
+    STREAM_LISTPACKS_2_TYPE = 19
+    STREAM_LISTPACKS_3_TYPE = 21
+    STREAM_ITEM_FLAG_DELETED = 1
+    STREAM_ITEM_FLAG_SAMEFIELDS = 2
+    QUICKLIST_NODE_CONTAINER_PLAIN = 1
+    QUICKLIST_NODE_CONTAINER_PACKED = 2
+    # Lengths of the ASCII doubles of ZSET_TYPE standing for special values.
+    ASCII_DOUBLE_NAN = 253
+    ASCII_DOUBLE_POSITIVE_INF = 254
+    ASCII_DOUBLE_NEGATIVE_INF = 255
+    ENCODING_INT8 = 0
+    ENCODING_INT16 = 1
+    ENCODING_INT32 = 2
+    ENCODING_LZF = 3
+    # Files older than this have no checksum.
+    FIRST_VERSION_WITH_CHECKSUM = 5
+    MAX_VERSION = 12
+
+    def __init__(self, verify_checksum=True):
+        self.verify_checksum = verify_checksum
+        # Position reached in the file, to report loading progress.
+        self.cursor = 0
+        self.version = None
+        self.keys_loaded = 0
+        self.db_number = 0
+        self.expiry = None
 
     def check_magic_bytes(self, cursor, data):
-        for byte in self.MAGIC_BYTES:
-            if data[cursor] != byte:
-                raise InvalidRdbFileException(f"Invalid bytes found: {data[0:cursor]}")
-            cursor += 1
-        return cursor
-
-    def read_number(self, cursor, data, length):
-        integer_bytes = data[cursor : cursor + length]
-        integer = int("".join(chr(b) for b in integer_bytes))
-        return cursor + length, integer
+        if bytes(data[cursor : cursor + 5]) != self.MAGIC_BYTES:
+            raise InvalidRdbFileException(f"Invalid bytes found: {data[0:5]}")
+        return cursor + 5
 
     def read_number_from_bytes(self, cursor, data, length):
-        integer_bytes = data[cursor : cursor + length]
-        integer = int.from_bytes(integer_bytes, byteorder="little")
+        integer = int.from_bytes(data[cursor : cursor + length], "little")
         return cursor + length, integer
 
     def read_version(self, cursor, data):
-        return self.read_number(cursor, data, 4)
+        try:
+            version = int(bytes(data[cursor : cursor + 4]))
+        except ValueError:
+            raise InvalidRdbFileException(f"Invalid version: {data[cursor:cursor + 4]}")
+        if version > self.MAX_VERSION:
+            raise InvalidRdbFileException(f"Can't handle RDB format version {version}")
+        return cursor + 4, version
 
     def read_db_number(self, cursor, data):
         cursor += 1
@@ -73,106 +143,530 @@ class RdbParser:
     def read_milliseconds(self, cursor, data):
         return self.read_number_from_bytes(cursor, data, 8)
 
-    def convert_sec_to_milli(self, seconds):
-        return seconds * 1000
+    def read_length(self, cursor, data):
+        byte = data[cursor]
+        kind = byte >> 6
+        if kind == 0:
+            return cursor + 1, byte & 0x3F
+        elif kind == 1:
+            return cursor + 2, ((byte & 0x3F) << 8) | data[cursor + 1]
+        elif byte == 0x80:
+            return cursor + 5, int.from_bytes(data[cursor + 1 : cursor + 5], "big")
+        elif byte == 0x81:
+            return cursor + 9, int.from_bytes(data[cursor + 1 : cursor + 9], "big")
+        raise InvalidRdbFileException(f"Invalid length encoding: {byte}")
+
+    def read_raw_string(self, cursor, data):
+        """
+        Read a string in any of its encodings and return it as bytes.
+        """
+        byte = data[cursor]
+        if byte >> 6 != 3:
+            cursor, length = self.read_length(cursor, data)
+            return cursor + length, bytes(data[cursor : cursor + length])
+        encoding = byte & 0x3F
+        cursor += 1
+        if encoding == self.ENCODING_INT8:
+            return cursor + 1, b"%d" % int.from_bytes(
+                data[cursor : cursor + 1], "little", signed=True
+            )
+        elif encoding == self.ENCODING_INT16:
+            return cursor + 2, b"%d" % INT16.unpack_from(data, cursor)
+        elif encoding == self.ENCODING_INT32:
+            return cursor + 4, b"%d" % INT32.unpack_from(data, cursor)
+        elif encoding == self.ENCODING_LZF:
+            cursor, compressed_length = self.read_length(cursor, data)
+            cursor, length = self.read_length(cursor, data)
+            end = cursor + compressed_length
+            try:
+                return end, lzf_decompress(data[cursor:end], length)
+            except LzfError as e:
+                raise InvalidRdbFileException(f"Invalid LZF string: {e}")
+        raise InvalidRdbFileException(f"Unsupported string encoding: {encoding}")
 
-    def get_two_most_signifcant_bit(self, byte):
-        return (byte & 0xC0) >> 6
+    def read_string_encoding(self, cursor, data):
+        cursor, value = self.read_raw_string(cursor, data)
+        return cursor, bytes(value)
+
+    def read_stream_node(self, stream, master_key, listpack):
+        master_ms, master_seq = unpack_stream_id(int.from_bytes(master_key, "big"))
+        # Fields and values come back as bytes, or as int when they were
+        # stored with an integer encoding.
+        elements = decode_listpack(listpack)
+        count, deleted, num_fields = elements[0:3]
+        master_fields = [to_bytes(i) for i in elements[3 : 3 + num_fields]]
+        # Skip the master entry terminator.
+        position = 3 + num_fields + 1
+        for _ in range(count + deleted):
+            flags, ms_diff, seq_diff = elements[position : position + 3]
+            position += 3
+            if flags & self.STREAM_ITEM_FLAG_SAMEFIELDS:
+                values = elements[position : position + num_fields]
+                entry = []
+                for field, value in zip(master_fields, values):
+                    entry.extend([field, to_bytes(value)])
+                position += num_fields
+            else:
+                field_count = elements[position]
+                position += 1
+                end = position + 2 * field_count
+                entry = [to_bytes(i) for i in elements[position:end]]
+                position = end
+            # Skip lp-count.
+            position += 1
+            if flags & self.STREAM_ITEM_FLAG_DELETED:
+                continue
+            stream_id = pack_stream_id(master_ms + ms_diff, master_seq + seq_diff)
+            stream.append(stream_id, entry)
+
+    def read_stream(self, cursor, data, value_type):
+        stream = Stream()
+        cursor, node_count = self.read_length(cursor, data)
+        for _ in range(node_count):
+            cursor, master_key = self.read_raw_string(cursor, data)
+            cursor, listpack = self.read_raw_string(cursor, data)
+            self.read_stream_node(stream, master_key, listpack)
+        cursor, length = self.read_length(cursor, data)
+        cursor, last_ms = self.read_length(cursor, data)
+        cursor, last_seq = self.read_length(cursor, data)
+        stream.last_id = max(stream.last_id, pack_stream_id(last_ms, last_seq))
+        if value_type >= self.STREAM_LISTPACKS_2_TYPE:
+            # First id, max deleted entry id and entries added.
+            for _ in range(5):
+                cursor, _ = self.read_length(cursor, data)
+        cursor, group_count = self.read_length(cursor, data)
+        if group_count:
+            raise InvalidRdbFileException("Stream consumer groups are not supported")
+        return cursor, stream
+
+    def read_strings(self, cursor, data, count):
+        strings = []
+        for _ in range(count):
+            cursor, string = self.read_string_encoding(cursor, data)
+            strings.append(string)
+        return cursor, strings
+
+    def read_list(self, cursor, data):
+        cursor, length = self.read_length(cursor, data)
+        cursor, elements = self.read_strings(cursor, data, length)
+        return cursor, RedisObject(OBJ_LIST, elements)
 
-    def get_last_six_bits(self, byte):
-        return byte & 0x3F
+    def read_set(self, cursor, data):
+        cursor, length = self.read_length(cursor, data)
+        cursor, members = self.read_strings(cursor, data, length)
+        return cursor, RedisObject(OBJ_SET, set(members))
 
-    def read_length(self, cursor, data):
-        decision_bits = self.get_two_most_signifcant_bit(data[cursor])
-        if decision_bits == 0:
-            # Take the next 6 bits as the length
-            length = self.get_last_six_bits(data[cursor])
-            return cursor + 1, length
-        elif decision_bits == 1:
-            # Take the next 14 bits as the length
-            first_six_bits = self.get_last_six_bits(data[cursor]) << 8
-            length = first_six_bits + int(data[cursor + 1])
-            return cursor + 2, length
-        elif decision_bits == 2:
-            cursor += 1
-            return self.read_number(cursor, data, 4)
-        elif decision_bits == 3:
-            cursor += 1
-            return self.read_number(cursor, data, 8)
-        raise Exception("Invalid length")
+    def read_hash(self, cursor, data):
+        cursor, length = self.read_length(cursor, data)
+        cursor, strings = self.read_strings(cursor, data, 2 * length)
+        return cursor, RedisObject(OBJ_HASH, dict(zip(strings[0::2], strings[1::2])))
 
-    def read_string_encoding(self, cursor, data):
+    def read_ascii_double(self, cursor, data):
+        length = data[cursor]
+        cursor += 1
+        if length == self.ASCII_DOUBLE_NAN:
+            return cursor, float("nan")
+        elif length == self.ASCII_DOUBLE_POSITIVE_INF:
+            return cursor, float("inf")
+        elif length == self.ASCII_DOUBLE_NEGATIVE_INF:
+            return cursor, float("-inf")
+        return cursor + length, float(bytes(data[cursor : cursor + length]))
+
+    def read_zset(self, cursor, data, value_type):
         cursor, length = self.read_length(cursor, data)
-        key = "".join([chr(i) for i in data[cursor : cursor + length]])
-        return cursor + length, key
+        scores = {}
+        for _ in range(length):
+            cursor, member = self.read_string_encoding(cursor, data)
+            if value_type == self.ZSET_2_TYPE:
+                scores[member] = DOUBLE.unpack_from(data, cursor)[0]
+                cursor += 8
+            else:
+                cursor, scores[member] = self.read_ascii_double(cursor, data)
+        return cursor, RedisObject(OBJ_ZSET, scores)
+
+    def read_quicklist(self, cursor, data, value_type):
+        """
+        Quicklists are lists of ziplist nodes, or for LIST_QUICKLIST_2_TYPE
+        of listpack and plain nodes. A list with a single packed node stays
+        a listpack.
+        """
+        cursor, node_count = self.read_length(cursor, data)
+        nodes = []
+        for _ in range(node_count):
+            container = self.QUICKLIST_NODE_CONTAINER_PACKED
+            if value_type == self.LIST_QUICKLIST_2_TYPE:
+                cursor, container = self.read_length(cursor, data)
+            cursor, node = self.read_raw_string(cursor, data)
+            nodes.append((container, node))
+        if len(nodes) == 1 and nodes[0][0] == self.QUICKLIST_NODE_CONTAINER_PACKED:
+            listpack = nodes[0][1]
+            if value_type == self.LIST_QUICKLIST_TYPE:
+                listpack = encode_listpack(decode_ziplist(listpack))
+            return cursor, create_listpack_object(OBJ_LIST, listpack)
+        elements = []
+        for container, node in nodes:
+            if container == self.QUICKLIST_NODE_CONTAINER_PLAIN:
+                elements.append(bytes(node))
+                continue
+            if value_type == self.LIST_QUICKLIST_2_TYPE:
+                packed = decode_listpack(node)
+            else:
+                packed = decode_ziplist(node)
+            elements.extend(to_bytes(i) for i in packed)
+        return cursor, RedisObject(OBJ_LIST, elements)
+
+    def read_packed(self, cursor, data, value_type):
+        """
+        Read the compact encodings, kept serialized in the store. Ziplists
+        are converted to listpacks, the encoding that replaced them.
+        """
+        cursor, blob = self.read_raw_string(cursor, data)
+        if value_type == self.SET_INTSET_TYPE:
+            check_intset(blob)
+            return cursor, RedisObject(OBJ_SET, blob, OBJ_ENCODING_INTSET)
+        obj_type = PACKED_TYPES[value_type]
+        if value_type in (
+            self.LIST_ZIPLIST_TYPE,
+            self.ZSET_ZIPLIST_TYPE,
+            self.HASH_ZIPLIST_TYPE,
+        ):
+            blob = encode_listpack(decode_ziplist(blob))
+        return cursor, create_listpack_object(obj_type, blob)
 
     def read_value(self, cursor, data, value_type):
-        if value_type == self.STRING_TYPE:
-            return self.read_string_encoding(cursor, data)
-        return None
+        """
+        Strings come back as bytes and streams as Stream. Other types come back
+        as a RedisObject, as their value depends on the encoding.
+        """
+        try:
+            if value_type == self.STRING_TYPE:
+                return self.read_string_encoding(cursor, data)
+            elif value_type in (
+                self.STREAM_LISTPACKS_TYPE,
+                self.STREAM_LISTPACKS_2_TYPE,
+                self.STREAM_LISTPACKS_3_TYPE,
+            ):
+                return self.read_stream(cursor, data, value_type)
+            elif value_type == self.LIST_TYPE:
+                return self.read_list(cursor, data)
+            elif value_type == self.SET_TYPE:
+                return self.read_set(cursor, data)
+            elif value_type == self.HASH_TYPE:
+                return self.read_hash(cursor, data)
+            elif value_type in (self.ZSET_TYPE, self.ZSET_2_TYPE):
+                return self.read_zset(cursor, data, value_type)
+            elif value_type in (self.LIST_QUICKLIST_TYPE, self.LIST_QUICKLIST_2_TYPE):
+                return self.read_quicklist(cursor, data, value_type)
+            elif value_type in PACKED_TYPES:
+                return self.read_packed(cursor, data, value_type)
+        except (
+            InvalidIntsetException,
+            InvalidListpackException,
+            InvalidZiplistException,
+        ) as e:
+            raise InvalidRdbFileException(f"Invalid value of type {value_type}: {e}")
+        raise InvalidRdbFileException(f"Unsupported value type: {value_type}")
 
     def read_key_value(self, cursor, data):
-        expiry_millis = None
         kv = KeyValue()
         if data[cursor] == self.SECOND_EXPIRATION:
-            cursor += 1
-            cursor, seconds = self.read_seconds(cursor, data)
-            expiry_millis = self.convert_sec_to_milli(seconds)
-            value_type = data[cursor]
-            cursor, key = self.read_string_encoding(cursor, data)
-            cursor += 1
-            cursor, value = self.read_string_encoding(cursor, data)
-            kv.set_key_value(key, value, value_type)
+            cursor, seconds = self.read_seconds(cursor + 1, data)
             kv.set_expiry_seconds(seconds)
         elif data[cursor] == self.MILLIS_EXPIRATION:
-            cursor += 1
-            cursor, expiry_millis = self.read_milliseconds(cursor, data)
-            value_type = data[cursor]
-            cursor += 1
-            cursor, key = self.read_string_encoding(cursor, data)
-            cursor, value = self.read_string_encoding(cursor, data)
-            kv.set_key_value(key, value, value_type)
+            cursor, expiry_millis = self.read_milliseconds(cursor + 1, data)
             kv.set_expiry_milliseconds(expiry_millis)
-        else:
-            value_type = data[cursor]
-            cursor += 1
-            cursor, key = self.read_string_encoding(cursor, data)
-            cursor, value = self.read_string_encoding(cursor, data)
-            kv.set_key_value(key, value, value_type)
+        value_type = data[cursor]
+        cursor += 1
+        cursor, key = self.read_string_encoding(cursor, data)
+        cursor, value = self.read_value(cursor, data, value_type)
+        kv.set_key_value(key, value, value_type)
         return cursor, kv
 
-    # data is a bytes class
+    def read_header(self, data):
+        """
+        Read the magic bytes and the version, returns the cursor past them.
+        """
+        cursor = self.check_magic_bytes(0, data)
+        cursor, self.version = self.read_version(cursor, data)
+        self.db_number = 0
+        self.expiry = None
+        return cursor
+
+    def read_entry(self, cursor, data):
+        """
+        Read the opcode at cursor and what follows it, anything but the end
+        of the file. Returns the cursor past it along with (db_number, key,
+        value_type, value, expiry) for a key, None for the other opcodes.
+        Database and expiry opcodes set self.db_number and self.expiry for
+        the keys that follow.
+        """
+        opcode = data[cursor]
+        if opcode == self.MILLIS_EXPIRATION:
+            cursor, self.expiry = self.read_milliseconds(cursor + 1, data)
+        elif opcode == self.SECOND_EXPIRATION:
+            cursor, seconds = self.read_seconds(cursor + 1, data)
+            self.expiry = seconds * 1000
+        elif opcode == self.DATABASE_SELECTOR:
+            cursor, self.db_number = self.read_db_number(cursor, data)
+        elif opcode == self.RESIZEDB_BYTE:
+            cursor, _ = self.read_length(cursor + 1, data)
+            cursor, _ = self.read_length(cursor, data)
+        elif opcode == self.AUX_FIELD:
+            cursor, _ = self.read_raw_string(cursor + 1, data)
+            cursor, _ = self.read_raw_string(cursor, data)
+        elif opcode == self.IDLE_BYTE:
+            # LRU and LFU hints, not used by this server.
+            cursor, _ = self.read_length(cursor + 1, data)
+        elif opcode == self.FREQ_BYTE:
+            cursor += 2
+        elif opcode == self.SLOT_INFO:
+            # Cluster slot info, three lengths.
+            cursor += 1
+            for _ in range(3):
+                cursor, _ = self.read_length(cursor, data)
+        elif opcode == self.FUNCTION2:
+            # Function libraries are skipped, there is no scripting.
+            cursor, _ = self.read_raw_string(cursor + 1, data)
+        elif opcode in (self.MODULE_AUX, self.FUNCTION_PRE_GA):
+            raise InvalidRdbFileException(f"Unsupported opcode: {opcode}")
+        else:
+            cursor, key = self.read_string_encoding(cursor + 1, data)
+            cursor, value = self.read_value(cursor, data, opcode)
+            entry = (self.db_number, key, opcode, value, self.expiry)
+            self.expiry = None
+            return cursor, entry
+        return cursor, None
+
+    def iter_entries(self, data):
+        """
+        Yield (db_number, key, value_type, value, expiry) for every key in
+        the file, expiry being unix time in milliseconds or None. self.cursor
+        follows the position in data and ends right after the checksum,
+        which is verified once the end of the file is reached.
+        """
+        cursor = self.read_header(data)
+        while True:
+            self.cursor = cursor
+            # Truncated files make the reads run past the end of data.
+            try:
+                if data[cursor] == self.RDB_FILE_END:
+                    break
+                cursor, entry = self.read_entry(cursor, data)
+            except (IndexError, struct.error):
+                raise InvalidRdbFileException("Unexpected end of the RDB file")
+            if entry is not None:
+                yield entry
+        end = cursor + 1
+        if self.version >= self.FIRST_VERSION_WITH_CHECKSUM:
+            end += 8
+        if self.needs_checksum() and len(data) >= end:
+            self.check_checksum(crc64(0, data[: cursor + 1]), data[cursor + 1 : end])
+        # Data may go on after the file, as in an AOF with a preamble.
+        self.cursor = min(end, len(data))
+
+    def needs_checksum(self):
+        return (
+            self.verify_checksum and self.version >= self.FIRST_VERSION_WITH_CHECKSUM
+        )
+
+    def check_checksum(self, crc, trailer):
+        """
+        Compare crc, the checksum of the file up to its 8 bytes trailer, with
+        the one stored in the trailer.
+        """
+        expected = int.from_bytes(trailer, "little")
+        # A zero checksum means the writer had checksums disabled.
+        if expected and crc != expected:
+            raise InvalidRdbFileException("Wrong RDB checksum")
+
+    def iter_load(self, data, store):
+        """
+        Insert the keys of the RDB file in data into store, yielding after
+        each one so the caller can interleave loading with other work. Keys
+        that already expired are skipped, self.keys_loaded counts the rest.
+        """
+        now = store.get_current_millis()
+        view = memoryview(data)
+        try:
+            for _, key, value_type, value, expiry in self.iter_entries(view):
+                if expiry is None or expiry > now:
+                    store.load_object(key, create_object(value_type, value), expiry)
+                    self.keys_loaded += 1
+                yield
+        finally:
+            view.release()
+
+    def load(self, data, store):
+        """
+        Insert every key of the RDB file in data into store. Returns the
+        number of keys loaded.
+        """
+        for _ in self.iter_load(data, store):
+            pass
+        return self.keys_loaded
+
+    def iter_load_file(self, path, store):
+        """
+        iter_load for the RDB file at path. The file is memory mapped, so it
+        is read by the OS as the parser goes instead of copied up front.
+        """
+        with open(path, "rb") as rdb_file:
+            if os.fstat(rdb_file.fileno()).st_size == 0:
+                raise InvalidRdbFileException("Empty RDB file")
+            with mmap.mmap(rdb_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from self.iter_load(mapped, store)
+
+    def load_file(self, path, store):
+        for _ in self.iter_load_file(path, store):
+            pass
+        return self.keys_loaded
+
     def parse(self, data):
-        print("Parsing data", data)
-        cursor = 0
-        # data_bytes = [i.to_bytes(1, sys.byteorder) for i in data]
         rdb = RdbData()
-        cursor = self.check_magic_bytes(cursor, data)
-        cursor, version = self.read_version(cursor, data)
-        rdb.set_version(version)
-        print("RDB Version:", version, cursor, data[cursor])
-        state = self.State.INIT
-        while cursor < len(data) and self.state != self.State.DONE:
-            if data[cursor] == self.DATABASE_SELECTOR:
-                cursor, db_number = self.read_db_number(cursor, data)
+        for db_number, key, value_type, value, expiry in self.iter_entries(
+            memoryview(data)
+        ):
+            if db_number != rdb.current_selector:
                 rdb.add_database(db_number)
-                if data[cursor] == self.RESIZEDB_BYTE:
-                    cursor, db_hash_size = self.read_length(cursor + 1, data)
-                    cursor, expiry_hash_size = self.read_length(cursor, data)
-                # Read key value pairs
-                state = self.State.READ_KEYS
-            elif data[cursor] == self.RDB_FILE_END:
-                state = self.State.DONE
-                break
-            elif state == self.State.READ_KEYS:
-                cursor, kv = self.read_key_value(cursor, data)
-                rdb.add_key_value(kv)
-            else:
-                cursor += 1
+            kv = KeyValue(key, value, expiry)
+            kv.set_data_type(value_type)
+            rdb.add_key_value(kv)
+        rdb.set_version(self.version)
         return rdb
 
 
+class RdbStreamLoader:
+    """
+    Loads an RDB file of length bytes into store while it is received, as
+    replicas do with the file sent by their master. Every complete entry
+    in what has been fed is inserted right away and only the bytes of an
+    incomplete one are kept, so the file is never held in memory whole.
+    A length of None is for a file sent with an end mark, feed_eof() is
+    called once the mark is read.
+    """
+
+    # Magic bytes and version.
+    HEADER_SIZE = 9
+
+    def __init__(self, parser, store, length):
+        self.parser = parser
+        self.store = store
+        self.length = length
+        self.received = 0
+        # Whether everything got fed.
+        self.ended = length == 0
+        self.buffer = bytearray()
+        self.finished = False
+        self.crc = 0
+        # An entry found incomplete is parsed again once the buffer doubled,
+        # so a value spanning many reads is not parsed once per read.
+        self.retry_size = 0
+        self.now = store.get_current_millis()
+
+    def feed(self, data):
+        self.received += len(data)
+        if self.length is not None:
+            if self.received > self.length:
+                raise InvalidRdbFileException("More data than the RDB file length")
+            self.ended = self.received == self.length
+        self.buffer += data
+        if len(self.buffer) >= self.retry_size or self.ended:
+            self.load_buffer()
+
+    def feed_eof(self):
+        self.ended = True
+        self.load_buffer()
+
+    def load_buffer(self):
+        parser = self.parser
+        with memoryview(self.buffer) as view:
+            if parser.version is None:
+                if len(view) < self.HEADER_SIZE and not self.ended:
+                    return
+                cursor = parser.read_header(view)
+            else:
+                cursor = 0
+            while cursor < len(view):
+                if view[cursor] == parser.RDB_FILE_END:
+                    if self.ended:
+                        self.finish(cursor, view)
+                        cursor = len(view)
+                    break
+                state = parser.db_number, parser.expiry
+                try:
+                    end, entry = parser.read_entry(cursor, view)
+                except InvalidRdbFileException:
+                    if self.ended:
+                        raise
+                    end = None
+                except (IndexError, ValueError, struct.error):
+                    if self.ended:
+                        raise InvalidRdbFileException("Unexpected end of the RDB file")
+                    end = None
+                if end is None or end > len(view):
+                    # The entry goes on in data not received yet.
+                    parser.db_number, parser.expiry = state
+                    break
+                cursor = end
+                if entry is not None:
+                    self.insert(entry)
+            if not self.finished and parser.needs_checksum():
+                self.crc = crc64(self.crc, view[:cursor])
+        del self.buffer[:cursor]
+        self.retry_size = 2 * len(self.buffer)
+        if self.ended and not self.finished:
+            raise InvalidRdbFileException("Unexpected end of the RDB file")
+
+    def finish(self, cursor, view):
+        parser = self.parser
+        if parser.needs_checksum():
+            self.crc = crc64(self.crc, view[: cursor + 1])
+            parser.check_checksum(self.crc, view[cursor + 1 : cursor + 9])
+        self.finished = True
+
+    def insert(self, entry):
+        _, key, value_type, value, expiry = entry
+        if expiry is None or expiry > self.now:
+            self.store.load_object(key, create_object(value_type, value), expiry)
+            self.parser.keys_loaded += 1
+
+    def get_loaded_bytes(self):
+        return self.received - len(self.buffer)
+
+
+def to_bytes(element):
+    # Listpack and ziplist elements stored as integers come back as int.
+    return b"%d" % element if isinstance(element, int) else element
+
+
+def create_object(value_type, value):
+    if isinstance(value, RedisObject):
+        return value
+    elif value_type == RdbParser.STRING_TYPE:
+        return create_string_object(value)
+    return RedisObject(OBJ_STREAM, value)
+
+
+def create_listpack_object(obj_type, listpack):
+    if int.from_bytes(listpack[0:4], "little") != len(listpack):
+        raise InvalidListpackException(f"Listpack of {len(listpack)} bytes")
+    return RedisObject(obj_type, listpack, OBJ_ENCODING_LISTPACK)
+
+
+# Types of the values kept in their serialized form.
+PACKED_TYPES = {
+    RdbParser.LIST_ZIPLIST_TYPE: OBJ_LIST,
+    RdbParser.SET_INTSET_TYPE: OBJ_SET,
+    RdbParser.ZSET_ZIPLIST_TYPE: OBJ_ZSET,
+    RdbParser.HASH_ZIPLIST_TYPE: OBJ_HASH,
+    RdbParser.HASH_LISTPACK_TYPE: OBJ_HASH,
+    RdbParser.ZSET_LISTPACK_TYPE: OBJ_ZSET,
+    RdbParser.SET_LISTPACK_TYPE: OBJ_SET,
+}
+
+
 class KeyValue:
+    # expiry is unix time in milliseconds, the unit used by the store.
     def __init__(self, key=None, value=None, expiry=None):
         self.key = key
         self.value = value
@@ -0,0 +1,61 @@
+"""
+Ziplist deserialization. Ziplists are the compact encoding RDB files
+written before Redis 7 use for small lists, hashes and sorted sets, they
+are converted to listpacks when loaded.
+"""
+
+ZIPLIST_HEADER_SIZE = 10
+ZIPLIST_END = 0xFF
+# First byte of a 5 bytes previous entry length.
+ZIPLIST_BIG_PREVLEN = 0xFE
+# Integer encodings and the width of the integer following them.
+ZIPLIST_INT_WIDTHS = {0xC0: 2, 0xD0: 4, 0xE0: 8, 0xF0: 3, 0xFE: 1}
+# Encodings 0xF1 to 0xFD hold the integers 0 to 12 themselves.
+ZIPLIST_IMMEDIATE_MIN = 0xF1
+ZIPLIST_IMMEDIATE_MAX = 0xFD
+
+
+class InvalidZiplistException(Exception):
+    pass
+
+
+def decode_ziplist(data):
+    """
+    Elements of a serialized ziplist, integers as int and strings as bytes.
+    """
+    total = int.from_bytes(data[0:4], "little")
+    if total != len(data):
+        raise InvalidZiplistException(f"Ziplist size {total} != {len(data)}")
+    elements = []
+    cursor = ZIPLIST_HEADER_SIZE
+    while cursor < total:
+        byte = data[cursor]
+        if byte == ZIPLIST_END:
+            return elements
+        cursor += 5 if byte == ZIPLIST_BIG_PREVLEN else 1
+        byte = data[cursor]
+        kind = byte >> 6
+        if kind == 0:
+            length = byte & 0x3F
+            cursor += 1
+        elif kind == 1:
+            length = ((byte & 0x3F) << 8) | data[cursor + 1]
+            cursor += 2
+        elif kind == 2:
+            length = int.from_bytes(data[cursor + 1 : cursor + 5], "big")
+            cursor += 5
+        elif ZIPLIST_IMMEDIATE_MIN <= byte <= ZIPLIST_IMMEDIATE_MAX:
+            elements.append(byte - ZIPLIST_IMMEDIATE_MIN)
+            cursor += 1
+            continue
+        elif byte in ZIPLIST_INT_WIDTHS:
+            width = ZIPLIST_INT_WIDTHS[byte]
+            integer = data[cursor + 1 : cursor + 1 + width]
+            elements.append(int.from_bytes(integer, "little", signed=True))
+            cursor += 1 + width
+            continue
+        else:
+            raise InvalidZiplistException(f"Invalid ziplist encoding: {byte}")
+        elements.append(bytes(data[cursor : cursor + length]))
+        cursor += length
+    raise InvalidZiplistException("Ziplist without end marker")
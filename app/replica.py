@@ -1,53 +1,78 @@
 from enum import Enum
 from .encoder import Encoder
+from .timer import monotonic_millis
 
 
 class ReplicaState(Enum):
     WAITING_FOR_PING = "waiting_for_ping"
     WAITING_FOR_PORT = "waiting_for_port"
     WAITING_FOR_CAPA = "waiting_for_capa"
+    # Full resync in progress, the RDB file is being generated.
+    WAIT_BGSAVE_END = "wait_bgsave_end"
+    ONLINE = "online"
 
 
 class Replica:
     state = ReplicaState.WAITING_FOR_PING
 
-    def __init__(self, addr, socket, offset, replica_id):
+    def __init__(
+        self, server, addr, socket, offset, replica_id, ack_offset=0, sent_offset=0
+    ):
+        self.server = server
         self.addr = addr
         self.socket = socket
         self.offset = offset
         self.replid = replica_id
         self.encoder = Encoder()
-        self.processed = True
-        self.sent_count = 0
-
-    def send_write_command(self, message):
-        self.processed = False
-        self.sent_count += len(message)
-        self.send_message(message)
-
-    def send_message(self, message):
-        print(f"Syncing with replica {self.addr}", message)
-        self.socket.sendall(message)
-
-    def check_processed(self):
-        print("Checking if replica is processed")
-        self.send_message(
-            self.encoder.generate_array_string(["REPLCONF", "GETACK", "*"])
-        )
-
-    def update_processed(self, offset_count):
-        if self.sent_count <= offset_count:
-            self.processed = True
-        else:
-            self.processed = False
-        print(
-            "Replica",
-            self.addr,
-            "updated as ",
-            self.processed,
-            "with sent_count",
-            self.sent_count,
-        )
-
-    def is_processed(self):
-        return self.processed
+        # Replication offset the replica last acknowledged with REPLCONF ACK.
+        self.ack_offset = ack_offset
+        self.ack_time = monotonic_millis()
+        self.state = ReplicaState.ONLINE
+        # Master offset the replication stream has been written up to. It
+        # stays at the snapshot offset during a full sync, so writes made
+        # meanwhile follow the RDB file.
+        self.sent_offset = sent_offset
+        self.soft_limit_since = None
+        self.listening_port = 0
+        # Whether it takes an RDB file framed with an end mark, REPLCONF
+        # capa eof, instead of one preceded by its length.
+        self.capa_eof = False
+
+    def start_full_sync(self):
+        self.state = ReplicaState.WAIT_BGSAVE_END
+
+    def finish_full_sync(self):
+        self.state = ReplicaState.ONLINE
+
+    def is_streaming(self):
+        return self.state == ReplicaState.ONLINE
+
+    def output_limit_reached(self, pending, limits):
+        """
+        Whether pending bytes of replication stream exceed limits, a (hard,
+        soft, soft_seconds) tuple like Redis' client-output-buffer-limit. A
+        limit of 0 is disabled.
+        """
+        hard, soft, soft_seconds = limits
+        if hard and pending >= hard:
+            return True
+        if not soft or pending < soft:
+            self.soft_limit_since = None
+            return False
+        now = monotonic_millis()
+        if self.soft_limit_since is None:
+            self.soft_limit_since = now
+        return now - self.soft_limit_since >= soft_seconds * 1000
+
+    def update_ack_offset(self, offset):
+        # Acks can't move backwards, a late reply to an older GETACK is
+        # ignored.
+        self.ack_offset = max(self.ack_offset, offset)
+        self.ack_time = monotonic_millis()
+
+    def get_lag_seconds(self):
+        # Seconds since the last REPLCONF ACK, sent every second when synced.
+        return (monotonic_millis() - self.ack_time) // 1000
+
+    def has_acknowledged(self, offset):
+        return self.state == ReplicaState.ONLINE and self.ack_offset >= offset
@@ -1,20 +1,79 @@
+import gc
 import os
-import datetime
 import socket
+import sys
+import tempfile
+import time
 import selectors
 import types
+from collections import deque
 from enum import Enum
+from itertools import islice
 from .encoder import Encoder
-from .utils import generate_repl_id, is_bigger_stream_id
-from .replica import Replica
+from .utils import generate_repl_id, get_private_dirty_bytes
+from .replica import Replica, ReplicaState
 from .handler import CommandHandler, ClientCommandHandler
+from .commands import populate_command_table
 from .store import KeyValueStore
 from .master_connection import MasterConnection
-from .rdb.parser import RdbParser
+from .rdb.crc64 import HAS_NATIVE_CRC64
+from .rdb.parser import InvalidRdbFileException, RdbParser
+from .rdb.writer import RDB_CHUNK_SIZE, RdbWriter
+from .parser import RespParser, ProtocolError, READ_BUFFER_SIZE
 from .logger import logger
+from .timer import NO_MORE, TimerQueue, monotonic_millis
+from .blocking import BlockedClient, BlockingRegistry, Waiter, WaitingClients
+from .stream import format_stream_id
+from .backlog import DEFAULT_BACKLOG_SIZE, ReplicationBacklog, ReplicationBuffer
+from .aof import (
+    DEFAULT_AOF_FILENAME,
+    FSYNC_EVERYSEC,
+    AppendOnlyFile,
+    InvalidAofFileException,
+    can_rewrite_as_commands,
+    write_rewritten_file,
+)
 
 sel = selectors.DefaultSelector()
 
+DEFAULT_HZ = 10
+MAX_HZ = 500
+ACTIVE_EXPIRE_CYCLE_CPU_PERCENT = 25
+
+# Upper bound of buffers passed to a single sendmsg call.
+IOV_MAX = 1024
+# Replication stream a replica may lag behind by: hard limit, soft limit and
+# how many seconds the soft one may be exceeded, as in Redis' default
+# client-output-buffer-limit for replicas.
+DEFAULT_REPLICA_OUTPUT_LIMITS = (256 * 1024 * 1024, 64 * 1024 * 1024, 60)
+
+# How often a replica retries connecting to its master.
+REPL_RECONNECT_PERIOD_MS = 1000
+# Seconds between the PINGs a master sends down the replication stream, so
+# replicas can tell an idle master from a lost one.
+DEFAULT_REPL_PING_REPLICA_PERIOD = 10
+
+# Time spent generating a replica's RDB file per event loop iteration.
+RDB_TRANSFER_TIME_SLICE_MS = 10
+# RDB file queued to a replica before the transfer waits for it to be
+# written, and how long it waits, so a slow replica doesn't make the whole
+# file pile up in memory.
+RDB_TRANSFER_MAX_PENDING = 1024 * 1024
+RDB_TRANSFER_WAIT_MS = 1
+# Length of the random mark ending a file sent with EOF framing, as Redis'
+# RDB_EOF_MARK_SIZE.
+RDB_EOF_MARK_SIZE = 40
+# Time spent loading the dataset before clients get served again.
+LOADING_TIME_SLICE_MS = 10
+
+# Where SAVE and BGSAVE write when --dir and --dbfilename aren't given.
+DEFAULT_RDB_DIR = "."
+DEFAULT_RDB_FILENAME = "dump.rdb"
+# (seconds, changes) pairs, same as Redis' default "save" config.
+DEFAULT_SAVE_PARAMS = [(3600, 1), (300, 100), (60, 10000)]
+# A save policy retries a failed BGSAVE only after this many seconds.
+BGSAVE_RETRY_DELAY_SECONDS = 5
+
 
 class RedisServer:
     class ServerType(Enum):
@@ -27,10 +86,7 @@ class RedisServer:
     server_type = ServerType.MASTER
     master_connection = None
     store = None
-    waiting_clients = []
-    last_processed = 0
     replicas = []
-    stream_blocking_clients = []
 
     def __init__(
         self,
@@ -40,6 +96,18 @@ class RedisServer:
         rdb_dir=None,
         rdb_filename=None,
         debug=True,
+        hz=DEFAULT_HZ,
+        repl_backlog_size=DEFAULT_BACKLOG_SIZE,
+        replica_output_limits=DEFAULT_REPLICA_OUTPUT_LIMITS,
+        save_params=None,
+        appendonly=False,
+        appendfilename=DEFAULT_AOF_FILENAME,
+        appendfsync=FSYNC_EVERYSEC,
+        rdbchecksum=True,
+        aof_use_rdb_preamble=True,
+        replica_read_only=True,
+        replica_max_staleness=0,
+        repl_ping_replica_period=DEFAULT_REPL_PING_REPLICA_PERIOD,
     ):
         self.port = port
         self.server_socket = None
@@ -47,25 +115,322 @@ class RedisServer:
         self.master_server = master_server
         self.master_port = int(master_port) if master_port else None
         self.store = KeyValueStore()
+        self.clients_pending_write = set()
+        self.waiting_clients = WaitingClients()
+        self.get_ack_from_replicas = False
+        self.repl_offset = 0
+        self.repl_backlog_size = repl_backlog_size
+        self.repl_backlog = None
+        self.repl_buffer = None
+        self.replica_output_limits = replica_output_limits
+        self.replica_read_only = replica_read_only
+        # Seconds a replica may go without hearing from its master before it
+        # refuses reads, 0 serves them regardless.
+        self.replica_max_staleness = replica_max_staleness
+        self.repl_ping_replica_period = repl_ping_replica_period
+        self.master_last_io = None
+        self.master_link_down_since = monotonic_millis()
+        self.stream_blocking_clients = BlockingRegistry()
+        self.hz = min(max(hz, 1), MAX_HZ)
+        self.cronloops = 0
+        self.timers = TimerQueue()
+        self.timers.add_timer(1000 // self.hz, self.server_cron)
+        self.commands = populate_command_table()
         self.command_handler = CommandHandler(self, store=self.store)
         self.rdb_dir = rdb_dir
         self.rdb_filename = rdb_filename
+        self.rdbchecksum = rdbchecksum
+        if save_params is None:
+            save_params = DEFAULT_SAVE_PARAMS
+        self.save_params = save_params
+        self.lastsave = int(time.time())
+        self.lastbgsave_try = 0
+        self.lastbgsave_ok = True
+        self.rdb_child_pid = None
+        self.rdb_child_pipe = None
+        self.rdb_save_time_start = None
+        self.rdb_save_time_last = -1
+        self.dirty_before_bgsave = 0
+        self.stat_rdb_saves = 0
+        self.stat_rdb_cow_bytes = 0
+        self.stat_fork_time_usec = 0
+        self.appendonly = appendonly
+        self.appendfilename = appendfilename
+        self.appendfsync = appendfsync
+        self.aof_use_rdb_preamble = aof_use_rdb_preamble
+        self.aof = None
+        self.aof_child_pid = None
+        self.aof_rewrite_scheduled = False
+        self.aof_rewrite_time_start = None
+        self.aof_rewrite_time_last = -1
+        self.aof_lastbgrewrite_ok = True
         if master_server:
             self.setup_as_slave()
         else:
             self.setup_as_master()
         self.debug = debug
-        self.load_initial_data()
+        self.loading = False
+        self.loading_job = None
+        self.loading_start_time = 0
+        self.loading_total_bytes = 0
+        self.loading_loaded_bytes = 0
+
+    def start_loading(self):
+        """
+        Prepare loading the AOF or the RDB file as self.loading_job, a
+        generator loading a key or a few commands per step. Returns False
+        when there is nothing to load.
+        """
+        if self.server_type != self.ServerType.MASTER:
+            job = None
+        elif self.appendonly and os.path.exists(self.get_aof_path()):
+            # The AOF is the more up to date of the two.
+            path, job = self.get_aof_path(), self.append_only_file_loading_steps()
+        elif os.path.exists(self.get_rdb_save_path()):
+            # The same path SAVE writes to, ./dump.rdb without --dir.
+            path, job = self.get_rdb_save_path(), self.rdb_file_loading_steps()
+        else:
+            job = None
+        if job is None:
+            self.finish_loading()
+            return False
+        self.log("Loading the dataset from %s", path)
+        self.loading = True
+        self.loading_job = job
+        self.loading_start_time = time.time()
+        self.loading_total_bytes = os.path.getsize(path)
+        self.loading_loaded_bytes = 0
+        return True
 
     def load_initial_data(self):
-        if self.server_type == self.ServerType.MASTER and self.rdb_dir:
-            raw_rdb_data = self.get_rdb_contents()
-            if raw_rdb_data:
-                rdb_data = self.parse_rdb_file(raw_rdb_data)
-                self.store.load_data_from_rdb(rdb_data)
+        """
+        Load the dataset in one go, without serving clients meanwhile.
+        """
+        if self.start_loading():
+            for _ in self.loading_job:
+                pass
+            self.finish_loading()
+
+    def loading_step(self):
+        deadline = monotonic_millis() + LOADING_TIME_SLICE_MS
+        try:
+            for _ in self.loading_job:
+                if monotonic_millis() >= deadline:
+                    # Serve clients, then carry on loading.
+                    return 0
+        except (InvalidRdbFileException, InvalidAofFileException, OSError) as e:
+            logger.error("Fatal error loading the dataset: %s", e)
+            sys.exit(1)
+        self.finish_loading()
+        return NO_MORE
+
+    def finish_loading(self):
+        if self.loading:
+            self.log(
+                "Dataset loaded in %.3f seconds", time.time() - self.loading_start_time
+            )
+        self.loading = False
+        self.loading_job = None
+        self.store.dirty = 0
+        if self.appendonly:
+            self.start_append_only()
+
+    def start_sync_loading(self, total_bytes):
+        """
+        Flag the dataset as loading while the RDB file sent by the master is
+        received, it is loaded as it arrives. total_bytes is None for a file
+        ended by a mark, reported as 0 like Redis does.
+        """
+        self.loading = True
+        self.loading_start_time = time.time()
+        self.loading_total_bytes = total_bytes or 0
+        self.loading_loaded_bytes = 0
+
+    def finish_sync_loading(self):
+        self.log(
+            "Synced with master in %.3f seconds", time.time() - self.loading_start_time
+        )
+        self.loading = False
+        # The AOF still holds the dataset from before the sync.
+        if self.aof:
+            self.aof_rewrite_scheduled = True
+
+    def get_loading_eta(self):
+        """
+        Seconds left until the dataset is loaded, extrapolated from the
+        loading speed so far, or None before anything got loaded or when the
+        size isn't known.
+        """
+        elapsed = time.time() - self.loading_start_time
+        if not self.loading_total_bytes or not self.loading_loaded_bytes:
+            return None
+        if elapsed <= 0:
+            return None
+        speed = self.loading_loaded_bytes / elapsed
+        return (self.loading_total_bytes - self.loading_loaded_bytes) / speed
+
+    def get_aof_path(self):
+        return os.path.join(self.get_rdb_dir() or DEFAULT_RDB_DIR, self.appendfilename)
+
+    def start_append_only(self):
+        path = self.get_aof_path()
+        if not os.path.exists(path) and self.store.data:
+            # Data loaded from the RDB file has to be in the log too.
+            self.write_append_only_base(path)
+        self.aof = AppendOnlyFile(path, self.appendfsync)
+
+    def write_append_only_base(self, path):
+        data, expires = self.store.data, self.store.expires
+        rdb_writer = None
+        if self.aof_use_rdb_preamble:
+            rdb_writer = self.get_rdb_writer()
+        elif not can_rewrite_as_commands(data, expires):
+            self.log("Using an RDB preamble for keys the AOF commands can't rebuild")
+            rdb_writer = self.get_rdb_writer()
+        write_rewritten_file(path, data, expires, rdb_writer)
+
+    def append_only_file_loading_steps(self):
+        """
+        Replay the AOF through the command handler, like commands sent by a
+        client, after loading its RDB preamble if it has one. A truncated
+        last command, left by a crash in the middle of a write, is cut from
+        the file. Raises InvalidAofFileException on unknown commands or a bad
+        format, error replies of known ones are logged.
+        """
+        path = self.get_aof_path()
+        data = self.create_connection_data(("aof",))
+        loaded = 0
+        with open(path, "rb") as aof_file:
+            if aof_file.read(len(RdbParser.MAGIC_BYTES)) == RdbParser.MAGIC_BYTES:
+                parser = self.get_rdb_parser()
+                for _ in parser.iter_load_file(path, self.store):
+                    self.loading_loaded_bytes = parser.cursor
+                    yield
+                self.log("Loaded %d keys from the AOF preamble", parser.keys_loaded)
+                aof_file.seek(parser.cursor)
+            else:
+                aof_file.seek(0)
+            while chunk := aof_file.read(READ_BUFFER_SIZE):
+                try:
+                    commands = data.parser.parse(chunk)
+                except ProtocolError as e:
+                    raise InvalidAofFileException(
+                        f"Bad file format reading the append only file: {e}"
+                    )
+                for command in commands:
+                    if self.command_handler.lookup_command(command.command) is None:
+                        raise InvalidAofFileException(
+                            f"Unknown command '{command.command}' reading the "
+                            "append only file"
+                        )
+                    response = self.command_handler.handle_single_command(
+                        data, command, None
+                    )
+                    if response and response.startswith(b"-"):
+                        logger.warning(
+                            "Error replaying %s from the AOF: %s",
+                            command,
+                            bytes(response).decode(errors="replace").strip(),
+                        )
+                    loaded += 1
+                self.loading_loaded_bytes = aof_file.tell()
+                yield
+        if data.parser.buffer:
+            valid_size = os.path.getsize(path) - len(data.parser.buffer)
+            logger.warning("AOF is truncated, cutting it to %d bytes", valid_size)
+            os.truncate(path, valid_size)
+        self.log("Loaded %d commands from the AOF", loaded)
+
+    def feed_append_only_file(self, message):
+        if self.aof:
+            self.aof.feed(message)
+
+    def has_aof_child(self):
+        return self.aof_child_pid is not None
+
+    def get_aof_rewrite_temp_path(self, pid):
+        aof_dir = os.path.dirname(self.get_aof_path())
+        return os.path.join(aof_dir, f"temp-rewriteaof-bg-{pid}.aof")
+
+    def rewrite_append_only_file_background(self):
+        """
+        Fork a child that writes the shortest command log rebuilding the
+        current keyspace. Commands run meanwhile are kept aside and appended
+        to it by check_aof_child_done, which then swaps it in as the AOF.
+        """
+        if self.has_active_child():
+            return False
+        self.aof_rewrite_scheduled = False
+        start = time.monotonic_ns()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            logger.error("Can't rewrite the AOF, fork failed: %s", e)
+            self.aof_lastbgrewrite_ok = False
+            return False
+        if pid == 0:
+            gc.disable()
+            status = 0
+            try:
+                self.write_append_only_base(self.get_aof_rewrite_temp_path(os.getpid()))
+            except BaseException:
+                logger.exception("AOF rewrite failed")
+                status = 1
+            finally:
+                os._exit(status)
+        self.stat_fork_time_usec = (time.monotonic_ns() - start) // 1000
+        self.log("Background AOF rewrite started by pid %s", pid)
+        self.aof_child_pid = pid
+        self.aof_rewrite_time_start = time.time()
+        if self.aof:
+            self.aof.start_rewrite()
+        return True
+
+    def check_aof_child_done(self):
+        pid, status = os.waitpid(self.aof_child_pid, os.WNOHANG)
+        if pid == 0:
+            return
+        temp_path = self.get_aof_rewrite_temp_path(pid)
+        ok = os.waitstatus_to_exitcode(status) == 0
+        try:
+            if ok and self.aof:
+                self.aof.finish_rewrite(temp_path)
+            elif ok:
+                os.replace(temp_path, self.get_aof_path())
+        except OSError as e:
+            logger.error("Can't install the rewritten AOF: %s", e)
+            ok = False
+        if not ok:
+            logger.error("Background AOF rewrite error")
+            if self.aof:
+                self.aof.cancel_rewrite()
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        else:
+            self.log("Background AOF rewrite terminated with success")
+        self.aof_lastbgrewrite_ok = ok
+        self.aof_rewrite_time_last = int(time.time() - self.aof_rewrite_time_start)
+        self.aof_child_pid = None
+        self.aof_rewrite_time_start = None
+
+    def rdb_file_loading_steps(self):
+        parser = self.get_rdb_parser()
+        for _ in parser.iter_load_file(self.get_rdb_save_path(), self.store):
+            self.loading_loaded_bytes = parser.cursor
+            yield
+        self.log("Loaded %d keys from the RDB file", parser.keys_loaded)
+
+    def get_rdb_parser(self):
+        # The pure Python CRC would make loading several times slower, so
+        # without crcmod files are loaded unverified, as Redis does for files
+        # saved without a checksum.
+        return RdbParser(verify_checksum=self.rdbchecksum and HAS_NATIVE_CRC64)
+
+    def get_rdb_writer(self):
+        return RdbWriter(checksum=self.rdbchecksum)
 
     def parse_rdb_file(self, contents):
-        parser = RdbParser()
+        parser = self.get_rdb_parser()
         rdb_data = parser.parse(contents)
         return rdb_data
 
@@ -75,43 +440,212 @@ class RedisServer:
     def get_rdb_filename(self):
         return self.rdb_filename
 
-    def get_rdb_filepath(self):
-        return os.path.join(self.get_rdb_dir(), self.get_rdb_filename())
+    def get_rdb_save_path(self):
+        rdb_dir = self.get_rdb_dir() or DEFAULT_RDB_DIR
+        return os.path.join(rdb_dir, self.get_rdb_filename() or DEFAULT_RDB_FILENAME)
 
-    def get_rdb_contents(self):
-        filepath = self.get_rdb_filepath()
-        if os.path.exists(filepath):
-            return open(filepath, "rb").read()
-        return None
+    def has_active_child(self):
+        return self.has_rdb_child() or self.has_aof_child()
+
+    def has_rdb_child(self):
+        return self.rdb_child_pid is not None
+
+    def get_lastsave(self):
+        return self.lastsave
+
+    def rdb_save(self):
+        """
+        Write the RDB file in the foreground. Returns True on success.
+        """
+        try:
+            self.get_rdb_writer().save(
+                self.get_rdb_save_path(), {0: (self.store.data, self.store.expires)}
+            )
+        except OSError as e:
+            logger.error("Error saving the RDB file: %s", e)
+            self.lastbgsave_ok = False
+            return False
+        self.store.dirty = 0
+        self.lastsave = int(time.time())
+        self.lastbgsave_ok = True
+        self.stat_rdb_saves += 1
+        return True
+
+    def rdb_background_save(self):
+        """
+        Fork a child that writes the RDB file from its copy-on-write view
+        of the keyspace while this process keeps serving clients. The child
+        is reaped by server_cron.
+        """
+        if self.has_active_child():
+            return False
+        self.lastbgsave_try = int(time.time())
+        # The child reports its copy-on-write size through the pipe.
+        read_fd, write_fd = os.pipe()
+        start = time.monotonic_ns()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            logger.error("Can't save in background, fork failed: %s", e)
+            os.close(read_fd)
+            os.close(write_fd)
+            self.lastbgsave_ok = False
+            return False
+        if pid == 0:
+            os.close(read_fd)
+            self.rdb_child_main(write_fd)
+        self.stat_fork_time_usec = (time.monotonic_ns() - start) // 1000
+        os.close(write_fd)
+        self.log("Background saving started by pid %s", pid)
+        self.rdb_child_pid = pid
+        self.rdb_child_pipe = read_fd
+        self.rdb_save_time_start = time.time()
+        self.dirty_before_bgsave = self.store.dirty
+        return True
+
+    def rdb_child_main(self, pipe_fd):
+        # A collection would write to the header of every object it visits
+        # and copy most of the heap.
+        gc.disable()
+        status = 0
+        try:
+            self.get_rdb_writer().save(
+                self.get_rdb_save_path(), {0: (self.store.data, self.store.expires)}
+            )
+            os.write(pipe_fd, str(get_private_dirty_bytes()).encode())
+        except BaseException:
+            logger.exception("Background saving failed")
+            status = 1
+        finally:
+            os._exit(status)
+
+    def check_rdb_child_done(self):
+        pid, status = os.waitpid(self.rdb_child_pid, os.WNOHANG)
+        if pid == 0:
+            return
+        ok = os.waitstatus_to_exitcode(status) == 0
+        report = os.read(self.rdb_child_pipe, 64)
+        os.close(self.rdb_child_pipe)
+        if ok:
+            self.log("Background saving terminated with success")
+            # Writes made while the child was saving are still unsaved.
+            self.store.dirty -= self.dirty_before_bgsave
+            self.lastsave = int(time.time())
+            self.stat_rdb_saves += 1
+            self.stat_rdb_cow_bytes = int(report or 0)
+        else:
+            logger.error("Background saving error")
+        self.lastbgsave_ok = ok
+        self.rdb_save_time_last = int(time.time() - self.rdb_save_time_start)
+        self.rdb_child_pid = None
+        self.rdb_child_pipe = None
+        self.rdb_save_time_start = None
+
+    def should_background_save(self):
+        now = int(time.time())
+        can_retry = (
+            self.lastbgsave_ok or now - self.lastbgsave_try > BGSAVE_RETRY_DELAY_SECONDS
+        )
+        for seconds, changes in self.save_params:
+            if (
+                self.store.dirty >= changes
+                and now - self.lastsave > seconds
+                and can_retry
+            ):
+                self.log("%d changes in %d seconds. Saving...", changes, seconds)
+                return True
+        return False
 
     def setup_as_slave(self):
         self.server_type = self.ServerType.SLAVE
+        # Replaced by the master's replid once synced with it.
+        self.repl_id = generate_repl_id()
+        self.replicas = []
+        if self.connect_to_master() != NO_MORE:
+            self.timers.add_timer(REPL_RECONNECT_PERIOD_MS, self.connect_to_master)
+
+    def connect_to_master(self):
+        """
+        Open the link to the master and start the handshake. Used as a timer
+        callback too, so it returns the retry period when the master can't
+        be reached.
+        """
         master_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        master_sock.connect_ex((self.master_server, self.master_port))
+        error = master_sock.connect_ex((self.master_server, self.master_port))
+        if error:
+            self.log("Connecting to master failed: %s", os.strerror(error))
+            master_sock.close()
+            return REPL_RECONNECT_PERIOD_MS
         master_sock.setblocking(False)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        data = types.SimpleNamespace(
-            addr=("master conn",),
-            inb=b"",
-            outb=b"",
-            map_store={},
-            master_connection=True,
-        )
-        self.master_connection = MasterConnection(self, self.port, master_sock)
-        sel.register(master_sock, events, data=data)
+        data = self.create_connection_data(("master conn",), master_connection=True)
+        if self.master_connection is None:
+            self.master_connection = MasterConnection(self, self.port, master_sock)
+        else:
+            self.master_connection.reconnected(master_sock)
+        sel.register(master_sock, selectors.EVENT_READ, data=data)
+        self.master_connection.send_ping()
+        return NO_MORE
 
     def setup_as_master(self):
         self.server_type = self.ServerType.MASTER
         self.repl_id = generate_repl_id()
         self.repl_offset = 0
+        self.repl_backlog = ReplicationBacklog(self.repl_backlog_size, self.repl_offset)
+        self.repl_buffer = ReplicationBuffer(self.repl_offset)
         self.replicas = []
 
+    def reset_replication_stream(self, replid, offset):
+        """
+        Carry on the master's replication stream as replid at offset, after
+        a full sync with it. Sub-replicas have to sync again with the new
+        dataset, so they are disconnected.
+        """
+        self.repl_id = replid
+        self.repl_offset = offset
+        self.repl_backlog = ReplicationBacklog(self.repl_backlog_size, offset)
+        self.repl_buffer = ReplicationBuffer(offset)
+        for replica in list(self.replicas):
+            self.log("Disconnecting sub-replica %s to resync it", replica.addr)
+            self.close_connection(replica.socket)
+
+    def is_master_link_synced(self):
+        connection = self.master_connection
+        return connection is not None and connection.is_synced()
+
+    def is_replica(self):
+        return self.server_type == self.ServerType.SLAVE
+
+    def get_master_last_io_seconds(self):
+        if self.master_last_io is None:
+            return -1
+        return (monotonic_millis() - self.master_last_io) // 1000
+
+    def get_master_link_down_seconds(self):
+        return (monotonic_millis() - self.master_link_down_since) // 1000
+
+    def is_replica_data_stale(self):
+        """
+        Whether the dataset may lag the master by more than
+        replica_max_staleness seconds: the link has been down that long, or
+        nothing, not even a PING, came through it for that long.
+        """
+        if not self.replica_max_staleness:
+            return False
+        if not self.is_master_link_synced():
+            lag = self.get_master_link_down_seconds()
+        else:
+            lag = self.get_master_last_io_seconds()
+        return lag >= self.replica_max_staleness
+
     def get_rdb_dir(self):
         return self.rdb_dir
 
     def get_rdb_filename(self):
         return self.rdb_filename
 
+    def get_hz(self):
+        return self.hz
+
     def get_server_type(self):
         return self.server_type
 
@@ -134,26 +668,122 @@ class RedisServer:
         return commands
 
     def expire_data(self):
-        self.store.expire_data()
+        # Like Redis, spend at most a quarter of the cron period on expiry.
+        time_limit_ms = 1000 / self.hz * ACTIVE_EXPIRE_CYCLE_CPU_PERCENT / 100
+        self.store.active_expire_cycle(time_limit_ms)
 
     def get_data(self, key):
         return self.store.get(key)
 
     def set_data(self, key, value, expiry_time=None):
-        self.store.set(key, value, expiry_time)
+        self.store.set_with_expiry_time(key, value, expiry_time)
 
-    def add_replica(self, addr, replica_id, offset, sock):
+    def add_replica(self, addr, replica_id, offset, sock, ack_offset=None):
         logger.info(f"Adding replica {addr} {replica_id} at offset {offset}")
-        replica = Replica(addr, sock, offset, replica_id)
+        # Unless resuming, the full sync covers everything written so far.
+        if ack_offset is None:
+            ack_offset = self.repl_offset
+        replica = Replica(
+            self,
+            addr,
+            sock,
+            offset,
+            replica_id,
+            ack_offset=ack_offset,
+            sent_offset=self.repl_offset,
+        )
         self.replicas.append(replica)
+        return replica
+
+    def start_full_resync(self, replica):
+        """
+        Send replica an RDB file of the keyspace as it is now. The file is
+        generated a time slice per event loop iteration, from a snapshot, so
+        clients keep being served meanwhile.
+        """
+        replica.start_full_sync()
+        snapshot = self.store.snapshot()
+        if replica.capa_eof:
+            payload = self.stream_rdb_payload(snapshot)
+        else:
+            payload = self.spool_rdb_payload(snapshot)
+        # Run up to the first yield, from there closing the generator on a
+        # disconnect releases the snapshot.
+        next(payload)
+        self.timers.add_timer(0, self.rdb_transfer_step, replica, payload)
+
+    def stream_rdb_payload(self, snapshot):
+        """
+        The RDB file sent as it is generated, framed as $EOF:<mark> and ended
+        by the mark since its length isn't known upfront.
+        """
+        mark = os.urandom(RDB_EOF_MARK_SIZE // 2).hex().encode()
+        try:
+            yield b""
+            yield b"$EOF:%s\r\n" % mark
+            yield from self.get_rdb_writer().generate({0: snapshot})
+        finally:
+            self.store.release_snapshot()
+        yield mark
+
+    def spool_rdb_payload(self, snapshot):
+        """
+        The RDB file for replicas without the eof capability, which need its
+        length first. It is spooled to a temporary file rather than kept in
+        memory, empty pieces are yielded meanwhile.
+        """
+        with tempfile.TemporaryFile() as spool:
+            try:
+                yield b""
+                for chunk in self.get_rdb_writer().generate({0: snapshot}):
+                    spool.write(chunk)
+                    yield b""
+            finally:
+                self.store.release_snapshot()
+            yield self.encoder.generate_file_header(spool.tell())
+            spool.seek(0)
+            while chunk := spool.read(RDB_CHUNK_SIZE):
+                yield chunk
 
-    def is_write_command(self, command):
-        return command.command in ["SET", "DEL"]
+    def rdb_transfer_step(self, replica, payload):
+        if replica not in self.replicas:
+            self.log("Replica %s disconnected during sync", replica.addr)
+            payload.close()
+            return NO_MORE
+        try:
+            data = sel.get_key(replica.socket).data
+        except (KeyError, ValueError):
+            payload.close()
+            return NO_MORE
+        if data.outb_size >= RDB_TRANSFER_MAX_PENDING:
+            return RDB_TRANSFER_WAIT_MS
+        deadline = monotonic_millis() + RDB_TRANSFER_TIME_SLICE_MS
+        for chunk in payload:
+            if chunk:
+                self.add_reply(chunk, replica.socket)
+            if data.outb_size >= RDB_TRANSFER_MAX_PENDING:
+                return RDB_TRANSFER_WAIT_MS
+            if monotonic_millis() >= deadline:
+                # Carry on in the next event loop iteration.
+                return 0
+        self.log("Sent RDB file to replica %s", replica.addr)
+        replica.finish_full_sync()
+        return NO_MORE
 
-    def get_rdb_file_contents(self):
-        # hex_data = open("sample_file.rdb").read()
-        hex_data = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
-        return hex_data
+    def try_partial_resync(self, replid, psync_offset):
+        """
+        Returns the part of the replication stream a replica asking for
+        PSYNC <replid> <psync_offset> is missing, or None if it needs a full
+        resync. Like Redis, psync_offset is the offset of the first byte the
+        replica wants, so one past the offset it has processed.
+        """
+        if self.repl_backlog is None or replid != self.repl_id:
+            return None
+        offset = psync_offset - 1
+        if not self.repl_backlog.can_serve(offset):
+            self.log("Offset %s is out of the replication backlog", psync_offset)
+            return None
+        return self.repl_backlog.read_from(offset)
 
     def get_replica_count(self):
         return len(self.replicas)
@@ -170,7 +800,13 @@ class RedisServer:
     def handle_loop(self):
         try:
             while True:
-                events = sel.select(timeout=None)
+                if self.get_ack_from_replicas:
+                    self.send_getack_to_replicas()
+                # Writes reach the AOF before their replies reach clients.
+                if self.aof:
+                    self.aof.flush()
+                self.handle_clients_with_pending_writes()
+                events = sel.select(timeout=self.timers.get_timeout())
                 for key, mask in events:
                     if key.data is None:
                         self.accept_wrapper(key.fileobj)
@@ -178,115 +814,309 @@ class RedisServer:
                         self.master_connection.service_connection(key, mask)
                     else:
                         self.service_connection(key, mask)
+                self.timers.process_timers()
         finally:
             sel.close()
             self.server_socket.close()
 
+    def create_connection_data(self, addr, master_connection=False):
+        return types.SimpleNamespace(
+            addr=addr,
+            inb=b"",
+            outb=deque(),
+            outb_size=0,
+            write_registered=False,
+            close_after_reply=False,
+            map_store={},
+            master_connection=master_connection,
+            # Port a replica announced with REPLCONF listening-port.
+            listening_port=0,
+            # Capabilities a replica announced with REPLCONF capa.
+            replica_capa=set(),
+            parser=RespParser(stream_rdb=master_connection),
+        )
+
     def accept_wrapper(self, server_socket):
         client_socket, addr = server_socket.accept()
         self.log(f"Accepted connection from {addr}")
         client_socket.setblocking(False)
-        data = types.SimpleNamespace(
-            addr=addr, inb=b"", outb=b"", map_store={}, master_connection=False
-        )
-        sel.register(
-            client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, data=data
-        )
+        data = self.create_connection_data(addr)
+        sel.register(client_socket, selectors.EVENT_READ, data=data)
+
+    def read_from_client(self, sock, data):
+        try:
+            recv_data = sock.recv(READ_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError as e:
+            self.log("Error reading from %s: %s", data.addr, e)
+            recv_data = b""
+        if not recv_data:
+            self.log("Closing connection to %s", data.addr)
+            self.close_connection(sock)
+            return False
+        data.inb += recv_data
+        self.log("Received %s from %s", repr(recv_data), data.addr)
+        return True
 
     def service_connection(self, key, mask):
         sock = key.fileobj
         data = key.data
         if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(1024)
-            if recv_data:
-                data.outb += recv_data
-                self.log("Received %s from %s", repr(recv_data), data.addr)
-            else:
-                self.log("Closing connection to %s", data.addr)
-                sel.unregister(sock)
-                sock.close()
-        if mask & selectors.EVENT_WRITE:
-            if data.outb:
+            if not self.read_from_client(sock, data):
+                return
+            try:
                 response_msg = self.command_handler.handle_message(data, sock)
-                if response_msg:
-                    self.sendall(response_msg, sock)
-                data.outb = b""
-                self.expire_data()
-            self.periodic_checks()
+            except ProtocolError as e:
+                self.add_reply(
+                    self.encoder.generate_error_string(f"ERR Protocol error: {e}"),
+                    sock,
+                )
+                data.close_after_reply = True
+                return
+            finally:
+                data.inb = b""
+            if response_msg:
+                self.add_reply(response_msg, sock)
+        if mask & selectors.EVENT_WRITE:
+            self.write_to_client(sock, data)
+
+    def add_reply(self, message, sock):
+        """
+        Queue message on the connection's reply buffer. Replies are written
+        once per event loop iteration by handle_clients_with_pending_writes.
+        """
+        try:
+            data = sel.get_key(sock).data
+        except (KeyError, ValueError):
+            self.log("Dropping reply to closed connection")
+            return
+        # Large replies like RDB files are not worth formatting for the log.
+        self.log("Sending %d bytes %.200r to %s", len(message), message, data.addr)
+        data.outb.append(message)
+        data.outb_size += len(message)
+        self.clients_pending_write.add(sock)
+
+    def write_to_client(self, sock, data):
+        """
+        Write as much of the reply queue as the socket accepts with a single
+        vectored write. Returns False if the connection got closed.
+        """
+        if data.outb:
+            try:
+                sent = sock.sendmsg(islice(data.outb, IOV_MAX))
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                self.log("Error writing to %s: %s", data.addr, e)
+                self.close_connection(sock)
+                return False
+            data.outb_size -= sent
+            while sent:
+                chunk = data.outb[0]
+                if len(chunk) <= sent:
+                    data.outb.popleft()
+                    sent -= len(chunk)
+                else:
+                    data.outb[0] = memoryview(chunk)[sent:]
+                    sent = 0
+        if data.outb:
+            self.register_write_handler(sock, data, True)
+        else:
+            self.register_write_handler(sock, data, False)
+            self.clients_pending_write.discard(sock)
+            if data.close_after_reply:
+                self.close_connection(sock)
+                return False
+        return True
+
+    def register_write_handler(self, sock, data, enabled):
+        if data.write_registered == enabled:
+            return
+        events = selectors.EVENT_READ
+        if enabled:
+            events |= selectors.EVENT_WRITE
+        sel.modify(sock, events, data=data)
+        data.write_registered = enabled
+
+    def handle_clients_with_pending_writes(self):
+        for sock in list(self.clients_pending_write):
+            data = sel.get_key(sock).data
+            # Clients with write interest are flushed once their socket
+            # reports writable.
+            if not data.write_registered:
+                self.write_to_client(sock, data)
+        self.flush_replication_buffer()
+
+    def flush_replication_buffer(self):
+        """
+        Write the replication stream to the replicas that haven't got all of
+        it, one vectored write each, and drop what every replica got.
+        Replicas too far behind are disconnected.
+        """
+        buffer = self.repl_buffer
+        if buffer is None:
+            return
+        for replica in list(self.replicas):
+            pending = buffer.end_offset - replica.sent_offset
+            if replica.output_limit_reached(pending, self.replica_output_limits):
+                logger.warning(
+                    "Replica %s is %d bytes behind, disconnecting it",
+                    replica.addr,
+                    pending,
+                )
+                self.close_connection(replica.socket)
+            elif pending and replica.is_streaming():
+                self.write_to_replica(replica)
+        offsets = [replica.sent_offset for replica in self.replicas]
+        buffer.trim(min(offsets, default=buffer.end_offset))
+
+    def write_to_replica(self, replica):
+        sock = replica.socket
+        try:
+            data = sel.get_key(sock).data
+        except (KeyError, ValueError):
+            return
+        # Replies queued before, like the RDB file of a full sync, go first.
+        if data.outb:
+            return
+        views = self.repl_buffer.get_views(replica.sent_offset, IOV_MAX)
+        try:
+            sent = sock.sendmsg(views)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            self.log("Error writing to replica %s: %s", replica.addr, e)
+            self.close_connection(sock)
+            return
+        finally:
+            for view in views:
+                view.release()
+        replica.sent_offset += sent
+        # Get woken up when the socket drains if some of it is left.
+        pending = replica.sent_offset < self.repl_buffer.end_offset
+        self.register_write_handler(sock, data, pending)
 
     def close_connection(self, sock):
-        sel.unregister(sock)
+        if self.master_connection and sock is self.master_connection.socket:
+            if self.master_connection.is_synced():
+                self.master_link_down_since = monotonic_millis()
+            self.master_connection.connection_lost()
+            self.timers.add_timer(REPL_RECONNECT_PERIOD_MS, self.connect_to_master)
+        self.clients_pending_write.discard(sock)
+        self.stream_blocking_clients.remove(sock)
+        self.waiting_clients.remove(sock)
+        self.replicas = [i for i in self.replicas if i.socket != sock]
+        try:
+            sel.unregister(sock)
+        except (KeyError, ValueError):
+            return
         sock.close()
         self.log("Closed connection")
 
-    def periodic_checks(self):
-        self.check_if_client_waiting()
-        self.expire_stream_blocks()
-
-    def check_if_client_waiting(self):
-        processed_replicas = self.processed_replicas()
-        print_debug = False
-        if self.waiting_clients:
-            if processed_replicas != self.last_processed:
-                self.last_processed = processed_replicas
-                print_debug = True
-                logger.info("Processed replicas count changed, checking with clients")
-                logger.info(
-                    f"Client waiting for WAIT command: {len(self.waiting_clients)}"
-                )
-        for index, (sock, min_count, expiry_time) in enumerate(self.waiting_clients):
-            if print_debug:
-                logger.info(
-                    f"Processed replicas count: {processed_replicas}, expiry time: {expiry_time}, current: {datetime.datetime.now()}"
-                )
-            if (
-                processed_replicas >= min_count
-                or expiry_time <= datetime.datetime.now()
-            ):
-                self.sendall(
-                    self.encoder.generate_integer_string(processed_replicas), sock
-                )
-                del self.waiting_clients[index]
+    def server_cron(self):
+        """
+        Runs hz times per second, regardless of client traffic.
+        """
+        self.cronloops += 1
+        if self.loading:
+            # The dataset isn't complete yet, nothing to expire or save.
+            return 1000 // self.hz
+        self.expire_data()
+        if self.has_rdb_child():
+            self.check_rdb_child_done()
+        elif self.has_aof_child():
+            self.check_aof_child_done()
+        elif self.aof_rewrite_scheduled:
+            self.rewrite_append_only_file_background()
+        elif self.should_background_save():
+            self.rdb_background_save()
+        # Replicas report their offset once per second, so WAIT usually
+        # resolves without waiting for a GETACK round trip.
+        is_replica = self.server_type == self.ServerType.SLAVE
+        if is_replica and self.master_connection and self.cronloops % self.hz == 0:
+            self.master_connection.send_ack()
+        ping_period = self.hz * self.repl_ping_replica_period
+        if ping_period and not is_replica and self.replicas:
+            if self.cronloops % ping_period == 0:
+                ping = self.encoder.generate_array_string(["PING"])
+                self.feed_replicas(ping)
+        return 1000 // self.hz
+
+    def count_replicas_acked(self, offset):
+        return sum(1 for replica in self.replicas if replica.has_acknowledged(offset))
+
+    def wait_for_replicas(self, sock, numreplicas, timeout):
+        """
+        Returns the number of replicas that acknowledged every write so far,
+        or None if sock got blocked until enough of them do or timeout
+        milliseconds pass (0 waits forever).
+        """
+        offset = self.repl_offset
+        acked = self.count_replicas_acked(offset)
+        if acked >= numreplicas:
+            return acked
+        waiter = Waiter(sock, numreplicas, offset)
+        if timeout:
+            waiter.timer = self.timers.add_timer(timeout, self.timeout_waiter, sock)
+        self.waiting_clients.add(waiter)
+        self.get_ack_from_replicas = True
+        return None
+
+    def timeout_waiter(self, sock):
+        waiter = self.waiting_clients.remove(sock)
+        if waiter:
+            acked = self.count_replicas_acked(waiter.offset)
+            self.add_reply(self.encoder.generate_integer_string(acked), sock)
 
-    def add_waiter(self, sock, min_count, timeout):
-        expiry_time = datetime.datetime.now() + datetime.timedelta(milliseconds=timeout)
-        self.waiting_clients.append((sock, min_count, expiry_time))
+    def process_clients_waiting_replicas(self):
+        # Replicas still in full sync don't count, like in count_replicas_acked.
+        acks = [
+            replica.ack_offset
+            for replica in self.replicas
+            if replica.state == ReplicaState.ONLINE
+        ]
+        for waiter in self.waiting_clients.pop_satisfied(acks):
+            acked = self.count_replicas_acked(waiter.offset)
+            self.add_reply(self.encoder.generate_integer_string(acked), waiter.sock)
 
-    def add_stream_blocking_client(self, sock, key, identifier, timeout):
-        expiry_time = None
-        if int(timeout) != 0:
-            expiry_time = datetime.datetime.now() + datetime.timedelta(
-                milliseconds=timeout
+    def block_client_on_streams(self, sock, stream_ids, count, timeout):
+        """
+        Park sock until one of the streams in stream_ids gets an entry newer
+        than the given id, or until timeout milliseconds (0 blocks forever).
+        """
+        client = BlockedClient(sock, stream_ids, count)
+        if timeout:
+            client.timer = self.timers.add_timer(
+                timeout, self.timeout_blocked_client, sock
             )
-        logger.info(
-            f"Set expiry time to {expiry_time} for client: %s", sock.getpeername()
-        )
-        self.stream_blocking_clients.append((sock, key, identifier, expiry_time))
-
-    def expire_stream_blocks(self):
-        for index, (sock, _, _, expiry_time) in enumerate(self.stream_blocking_clients):
-            if expiry_time and expiry_time <= datetime.datetime.now():
-                logger.info("Expiring stream blocking client: %s", sock.getpeername())
-                self.sendall(self.encoder.generate_null_string(), sock)
-                del self.stream_blocking_clients[index]
-
-    def send_data_to_stream_clients(self, key, identifier, data):
-        logger.info(
-            "Sending data to stream clients Key: %s Identifier: %s Data: %s %s",
-            key,
-            identifier,
-            data,
-            datetime.datetime.now(),
-        )
-        for index, (sock, stream_key, stream_identifier, _) in enumerate(
-            self.stream_blocking_clients
-        ):
-            if stream_key == key and is_bigger_stream_id(identifier, stream_identifier):
-                self.sendall(self.encoder.generate_array_string(data), sock)
-                # del self.stream_blocking_clients[index]
+        logger.info("Blocking client on streams %s", list(stream_ids))
+        self.stream_blocking_clients.add(client)
 
-    def processed_replicas(self):
-        return sum([1 for i in self.replicas if i.is_processed()])
+    def timeout_blocked_client(self, sock):
+        if self.stream_blocking_clients.remove(sock):
+            logger.info("Expiring stream blocking client: %s", sock.getpeername())
+            self.add_reply(self.encoder.generate_null_string(), sock)
+
+    def signal_key_as_ready(self, key):
+        """
+        Serve the clients blocked on key that have new entries to read.
+        """
+        stream = self.store.get_stream(key)
+        if stream is None:
+            return
+        for client in self.stream_blocking_clients.get_clients(key):
+            entries = stream.read_after(client.stream_ids[key], client.count)
+            if not entries:
+                continue
+            self.stream_blocking_clients.remove(client.sock)
+            data = [
+                [
+                    key,
+                    [[format_stream_id(i), values] for i, values in entries],
+                ]
+            ]
+            self.add_reply(self.encoder.generate_array_string(data), client.sock)
 
     def received_replica_offset(self, offset_count, sock):
         replica = next((i for i in self.replicas if i.socket == sock), None)
@@ -294,19 +1124,45 @@ class RedisServer:
             logger.info(
                 "Received offset from replica %s %s", replica.addr, offset_count
             )
-            replica.update_processed(offset_count)
-            self.log(f"Replica {replica.addr} processed {offset_count} commands")
+            replica.update_ack_offset(offset_count)
+            if self.waiting_clients:
+                self.process_clients_waiting_replicas()
         else:
             self.log("Received offset from unknown replica: %s", sock.getpeername())
 
-    def check_with_replicas(self):
-        for replica in self.replicas:
-            replica.check_processed()
+    def propagate(self, message):
+        """
+        Log a write command to the AOF and send it to the replicas.
+        """
+        self.feed_append_only_file(message)
+        # A replica's sub-replicas get its master's stream, byte for byte,
+        # writes made on the replica itself stay local.
+        if self.server_type == self.ServerType.MASTER:
+            self.feed_replicas(message)
+
+    def feed_replicas(self, message):
+        """
+        Send message down the replication stream and advance the master
+        offset by its size. Replicas get it from the replication buffer at
+        the end of the event loop iteration.
+        """
+        if self.repl_buffer is not None:
+            self.repl_buffer.feed(message)
+        if self.repl_backlog:
+            self.repl_backlog.feed(message)
+        self.repl_offset += len(message)
 
-    def sendall(self, message, sock):
-        logger.info(f"Sending message {message} to %s", sock.getpeername())
-        sock.sendall(message)
+    def send_getack_to_replicas(self):
+        # Requested by WAIT, one GETACK per loop iteration serves all of them.
+        self.get_ack_from_replicas = False
+        if self.replicas:
+            self.feed_replicas(
+                self.encoder.generate_array_string(["REPLCONF", "GETACK", "*"])
+            )
 
     def run(self):
+        # The port is open while loading, so the server can be health checked.
         self.initialize_server()
+        if self.start_loading():
+            self.timers.add_timer(0, self.loading_step)
         self.handle_loop()
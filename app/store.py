@@ -1,71 +1,408 @@
-import datetime
+import heapq
+import math
+import time
 import uuid
 import sys
 
+from .rdb.intset import decode_intset
+from .rdb.listpack import decode_listpack
+from .stream import (
+    Stream,
+    SEQ_MASK,
+    format_stream_id,
+    parse_stream_id,
+    unpack_stream_id,
+)
+
+# Expired keys looked at per active expire cycle before the time budget is
+# checked again.
+ACTIVE_EXPIRE_CYCLE_KEYS_PER_LOOP = 20
+
+
+# Type tags of keyspace entries, same values as Redis' OBJ_* constants.
+OBJ_STRING = 0
+OBJ_LIST = 1
+OBJ_SET = 2
+OBJ_ZSET = 3
+OBJ_HASH = 4
+OBJ_STREAM = 6
+
+TYPE_NAMES = {
+    OBJ_STRING: "string",
+    OBJ_LIST: "list",
+    OBJ_SET: "set",
+    OBJ_ZSET: "zset",
+    OBJ_HASH: "hash",
+    OBJ_STREAM: "stream",
+}
+
+# How a value is represented, same values as Redis' OBJ_ENCODING_*. Listpack
+# and intset values are the serialized bytes, as read from an RDB file. The
+# others are Python objects: an int for int, bytes for raw and embstr, a list
+# for quicklist, a set or a dict for hashtable and a dict of member to score
+# for skiplist.
+OBJ_ENCODING_RAW = 0
+OBJ_ENCODING_INT = 1
+OBJ_ENCODING_HT = 2
+OBJ_ENCODING_INTSET = 6
+OBJ_ENCODING_SKIPLIST = 7
+OBJ_ENCODING_EMBSTR = 8
+OBJ_ENCODING_QUICKLIST = 9
+OBJ_ENCODING_STREAM = 10
+OBJ_ENCODING_LISTPACK = 11
+
+ENCODING_NAMES = {
+    OBJ_ENCODING_RAW: "raw",
+    OBJ_ENCODING_INT: "int",
+    OBJ_ENCODING_EMBSTR: "embstr",
+    OBJ_ENCODING_HT: "hashtable",
+    OBJ_ENCODING_INTSET: "intset",
+    OBJ_ENCODING_SKIPLIST: "skiplist",
+    OBJ_ENCODING_QUICKLIST: "quicklist",
+    OBJ_ENCODING_STREAM: "stream",
+    OBJ_ENCODING_LISTPACK: "listpack",
+}
+
+DEFAULT_ENCODINGS = {
+    OBJ_STRING: OBJ_ENCODING_RAW,
+    OBJ_LIST: OBJ_ENCODING_QUICKLIST,
+    OBJ_SET: OBJ_ENCODING_HT,
+    OBJ_ZSET: OBJ_ENCODING_SKIPLIST,
+    OBJ_HASH: OBJ_ENCODING_HT,
+    OBJ_STREAM: OBJ_ENCODING_STREAM,
+}
+
+
+# Strings up to this length are embstr encoded in Redis.
+OBJ_ENCODING_EMBSTR_SIZE_LIMIT = 44
+# Longest string that can be a 64 bit integer, "-9223372036854775808".
+MAX_LONG_DIGITS = 20
+LLONG_MIN = -(1 << 63)
+LLONG_MAX = (1 << 63) - 1
+
 
 class ZeroIdentifier(Exception):
     pass
 
 
+class InvalidStreamId(ValueError):
+    def __init__(self):
+        super().__init__("ERR Invalid stream ID specified as stream command argument")
+
+
+class InvalidValue(Exception):
+    """
+    A command can't be applied to the value of a key, the message is the
+    error reply.
+    """
+
+
+class WrongType(Exception):
+    def __init__(self):
+        super().__init__(
+            "WRONGTYPE Operation against a key holding the wrong kind of value"
+        )
+
+
+class RedisObject:
+    """
+    A keyspace entry. Slots keep the per key overhead to a single small
+    object instead of a dict, expiry lives in KeyValueStore.expires.
+    """
+
+    __slots__ = ("type", "value", "encoding", "epoch")
+
+    def __init__(self, type, value, encoding=None, epoch=0):
+        self.type = type
+        self.value = value
+        if encoding is None:
+            encoding = DEFAULT_ENCODINGS[type]
+        self.encoding = encoding
+        # Snapshot epoch of the store the object was created in. Objects of
+        # the current epoch aren't in any snapshot and can change in place.
+        self.epoch = epoch
+
+    def is_compact(self):
+        return self.encoding in (OBJ_ENCODING_LISTPACK, OBJ_ENCODING_INTSET)
+
+    def get_string(self):
+        """
+        Value of a string as bytes, int encoded ones are formatted.
+        """
+        if self.encoding == OBJ_ENCODING_INT:
+            return b"%d" % self.value
+        return self.value
+
+    def get_elements(self):
+        """
+        Value of a list, set, hash or sorted set as a list, set, dict of
+        field to value or dict of member to score, decoding compact values.
+        """
+        if not self.is_compact():
+            return self.value
+        if self.encoding == OBJ_ENCODING_INTSET:
+            return {b"%d" % i for i in decode_intset(self.value)}
+        elements = [
+            b"%d" % i if isinstance(i, int) else i for i in decode_listpack(self.value)
+        ]
+        if self.type == OBJ_LIST:
+            return elements
+        elif self.type == OBJ_SET:
+            return set(elements)
+        elif self.type == OBJ_HASH:
+            return dict(zip(elements[0::2], elements[1::2]))
+        return dict(zip(elements[0::2], map(float, elements[1::2])))
+
+    def __eq__(self, other):
+        if not isinstance(other, RedisObject) or self.type != other.type:
+            return False
+        if self.type == OBJ_STRING:
+            return self.get_string() == other.get_string()
+        return self.value == other.value
+
+    def __repr__(self):
+        return f"<RedisObject {TYPE_NAMES[self.type]} {self.value!r}>"
+
+
+# Int encoded strings for small values are shared by every key holding them,
+# like Redis' shared integers. Objects are never changed in place, so sharing
+# them is safe.
+OBJ_SHARED_INTEGERS = 10000
+SHARED_INTEGERS = [
+    RedisObject(OBJ_STRING, i, OBJ_ENCODING_INT) for i in range(OBJ_SHARED_INTEGERS)
+]
+
+
+def create_int_object(num):
+    if 0 <= num < OBJ_SHARED_INTEGERS:
+        return SHARED_INTEGERS[num]
+    return RedisObject(OBJ_STRING, num, OBJ_ENCODING_INT)
+
+
+def parse_long(value):
+    """
+    The 64 bit integer a string holds, None when it isn't exactly the decimal
+    form of one (no spaces, signs or leading zeros).
+    """
+    if not value or len(value) > MAX_LONG_DIGITS:
+        return None
+    try:
+        num = int(value)
+    except ValueError:
+        return None
+    if b"%d" % num != value or not LLONG_MIN <= num <= LLONG_MAX:
+        return None
+    return num
+
+
+def create_string_object(value):
+    """
+    String object for value, int encoded when it is a 64 bit integer so
+    counters are kept as ints instead of being parsed on every update.
+    """
+    num = parse_long(value)
+    if num is not None:
+        return create_int_object(num)
+    if len(value) <= OBJ_ENCODING_EMBSTR_SIZE_LIMIT:
+        return RedisObject(OBJ_STRING, value, OBJ_ENCODING_EMBSTR)
+    return RedisObject(OBJ_STRING, value, OBJ_ENCODING_RAW)
+
+
+def parse_double(value):
+    """
+    The float a string holds, None when it isn't one or is NaN. Python's
+    float() also takes surrounding spaces and underscores, Redis doesn't.
+    """
+    if not value or value != value.strip() or b"_" in value:
+        return None
+    try:
+        num = float(value)
+    except ValueError:
+        return None
+    return None if math.isnan(num) else num
+
+
+def format_double(value):
+    """
+    Shortest form of a float that reads back the same, without an exponent,
+    like the replies of INCRBYFLOAT.
+    """
+    text = repr(value)
+    if "e" in text:
+        text = f"{value:.17f}".rstrip("0").rstrip(".")
+    elif text.endswith(".0"):
+        text = text[:-2]
+    return text.encode()
+
+
 class KeyValueStore:
     def __init__(self):
+        # Keys, strings and collection elements are bytes, as read from the
+        # client, so they are stored and replied without being decoded.
         self.data = {}
+        # Expiry time of volatile keys as unix time in milliseconds.
+        self.expires = {}
+        # Min-heap of (expiry_time, key). Entries are not removed when a key
+        # is overwritten or deleted, they are skipped once they reach the top
+        # or dropped when the heap is rebuilt, see set_expiry().
+        self.expiry_index = []
+        # Snapshots being serialized, see snapshot().
+        self.snapshots = 0
+        # Bumped by every snapshot, see RedisObject.epoch.
+        self.snapshot_epoch = 0
+        # Changes since the last save.
+        self.dirty = 0
 
-    def get(self, key):
-        return self.data.get(key)
+    def get_current_millis(self):
+        return time.time_ns() // 1_000_000
 
     def set(self, key, value, expiry_milliseconds=None):
         print("Setting data in store", key, value, expiry_milliseconds)
         expiry_time = None
         if expiry_milliseconds:
-            expiry_time = datetime.datetime.now() + datetime.timedelta(
-                milliseconds=expiry_milliseconds
-            )
+            expiry_time = self.get_current_millis() + expiry_milliseconds
         self.set_with_expiry_time(key, value, expiry_time)
 
     def set_with_expiry_time(self, key, value, expiry_time):
-        if expiry_time:
-            if expiry_time < datetime.datetime.now():
-                return
-        self.data[key] = {"value": value, "expiry_time": expiry_time, "type": "string"}
+        """
+        Set key to value, expiry_time is unix time in milliseconds. A key
+        without expiry_time loses any timeout it had.
+        """
+        self.set_object(key, create_string_object(value), expiry_time)
+
+    def set_object(self, key, obj, expiry_time):
+        if expiry_time is not None and expiry_time <= self.get_current_millis():
+            self.delete(key)
+            return
+        self.data[key] = obj
+        self.dirty += 1
+        if expiry_time is None:
+            self.expires.pop(key, None)
+        else:
+            self.set_expiry(key, expiry_time)
+
+    def load_object(self, key, obj, expiry_time):
+        """
+        Insert a key read from a persistence file. Loaded keys don't count as
+        changes since the last save.
+        """
+        self.data[key] = obj
+        if expiry_time is not None:
+            self.set_expiry(key, expiry_time)
+
+    def set_expiry(self, key, expiry_time):
+        self.expires[key] = expiry_time
+        heapq.heappush(self.expiry_index, (expiry_time, key))
+        # Refreshing TTLs leaves stale entries behind. Rebuilding once they
+        # are half of the heap keeps it bounded at an amortized O(1) cost.
+        if len(self.expiry_index) > 2 * len(self.expires):
+            self.rebuild_expiry_index()
+
+    def rebuild_expiry_index(self):
+        self.expiry_index = [(t, key) for key, t in self.expires.items()]
+        heapq.heapify(self.expiry_index)
+
+    def get_expiry(self, key):
+        return self.expires.get(key)
+
+    def get_ttl_millis(self, key):
+        """
+        Remaining time to live in milliseconds, -2 if the key doesn't exist
+        and -1 if it has no expiry.
+        """
+        if key not in self.data or self.expire_if_needed(key):
+            return -2
+        expiry_time = self.expires.get(key)
+        if expiry_time is None:
+            return -1
+        return max(expiry_time - self.get_current_millis(), 0)
 
-    def add_stream_data(self, key, values=[], identifier=None, expiry_time=None):
+    def persist(self, key):
+        if key not in self.data or self.expire_if_needed(key):
+            return False
+        if self.expires.pop(key, None) is None:
+            return False
+        self.dirty += 1
+        return True
+
+    def delete(self, key):
+        self.expires.pop(key, None)
+        if self.data.pop(key, None) is None:
+            return False
+        self.dirty += 1
+        return True
+
+    def flush(self):
+        self.data.clear()
+        self.expires.clear()
+        self.expiry_index.clear()
+
+    def snapshot(self):
+        """
+        Point in time view of the keyspace as a (data, expires) pair. The
+        dicts are copied but objects are shared with the live keyspace, so
+        while a snapshot is held objects are replaced instead of changed in
+        place. Call release_snapshot once done with it.
+        """
+        self.snapshots += 1
+        self.snapshot_epoch += 1
+        return self.data.copy(), self.expires.copy()
+
+    def release_snapshot(self):
+        self.snapshots -= 1
+
+    def add_stream_data(self, key, values=[], identifier=None):
         self.validate_stream_identifier(key, identifier)
         identifier = self.generate_stream_identifier(key, identifier)
-        if key in self.data:
-            item = {
-                "values": values,
-                "identifier": identifier,
-                "expiry_time": expiry_time,
-            }
-            self.data[key]["value"].append(item)
-            self.data[key]["last_identifier"] = identifier
-        else:
-            item = {
-                "value": [{"values": values, "identifier": identifier}],
-                "expiry_time": expiry_time,
-                "type": "stream",
-                "last_identifier": identifier,
-            }
-            self.data[key] = item
+        # The id is range checked before a missing stream gets created.
+        try:
+            stream_id = parse_stream_id(identifier)
+        except ValueError:
+            raise InvalidStreamId() from None
+        obj = self.data.get(key)
+        if obj is None:
+            obj = RedisObject(OBJ_STREAM, Stream(), epoch=self.snapshot_epoch)
+            self.data[key] = obj
+        elif obj.type != OBJ_STREAM:
+            raise WrongType()
+        elif self.snapshots and obj.epoch != self.snapshot_epoch:
+            # Copied once per snapshot, later appends change the copy.
+            obj = RedisObject(OBJ_STREAM, obj.value.copy(), epoch=self.snapshot_epoch)
+            self.data[key] = obj
+        obj.value.append(stream_id, values)
+        self.dirty += 1
         return identifier, values
 
+    def get_stream(self, key):
+        if key not in self.data or self.expire_if_needed(key):
+            return None
+        item = self.data[key]
+        if item.type != OBJ_STREAM:
+            return None
+        return item.value
+
+    def get_last_stream_id(self, key):
+        """
+        Last id of the stream at key as (millis, seq), None if there is no
+        such stream.
+        """
+        stream = self.get_stream(key)
+        if stream is None:
+            return None
+        return unpack_stream_id(stream.last_id)
+
     def validate_stream_identifier(self, key, identifier):
         if identifier == "*":
             return
-        if "-" not in identifier:
-            raise ValueError("Invalid stream identifier")
+        if not identifier.isascii() or identifier.count("-") != 1:
+            raise InvalidStreamId()
         millisecs, sequence = identifier.split("-")
         if not (millisecs.isdigit() or millisecs == "*") or not (
             sequence.isdigit() or sequence == "*"
         ):
-            raise ValueError("Identifier not valid number")
-        if not millisecs or not sequence:
-            raise ValueError(
-                "Couldn't find identifier or sequence in stream identifier"
-            )
+            raise InvalidStreamId()
         if millisecs == "*" and sequence == "*":
-            raise ValueError("Both identifier and sequence can't be *")
+            raise InvalidStreamId()
 
         converted_millis = sys.maxsize
         if millisecs != "*":
@@ -79,9 +416,9 @@ class KeyValueStore:
             raise ZeroIdentifier(
                 "ERR The ID specified in XADD must be greater than 0-0"
             )
-        if key in self.data:
-            last_identifier = self.data[key]["last_identifier"]
-            existing_millis, existing_seq = map(int, last_identifier.split("-"))
+        last_id = self.get_last_stream_id(key)
+        if last_id:
+            existing_millis, existing_seq = last_id
             if (
                 converted_millis == existing_millis
                 and converted_sequence == existing_seq
@@ -94,7 +431,7 @@ class KeyValueStore:
                 raise ValueError("Lower than existing identifier")
 
     def get_timestamp_in_millis(self):
-        return int(datetime.datetime.now().timestamp() * 1000)
+        return self.get_current_millis()
 
     def generate_stream_identifier(self, key, identifier):
         if "*" not in identifier:
@@ -104,13 +441,17 @@ class KeyValueStore:
         if identifier == "*":
             milli_part = self.get_timestamp_in_millis()
             seq_part = 0
+            last_id = self.get_last_stream_id(key)
+            # Keep ids increasing when the clock is behind the last entry.
+            if last_id and last_id[0] >= milli_part:
+                milli_part, seq_part = last_id[0], last_id[1] + 1
             return f"{milli_part}-{seq_part}"
 
         given_milli_str, given_seq_str = identifier.split("-")
 
         # if millis part is *, generate millis from current timestamp and use given sequence part
         if given_milli_str == "*":
-            milli_part = int(datetime.datetime.now().timestamp() * 1000)
+            milli_part = self.get_current_millis()
             return f"{milli_part}-{given_seq_str}"
 
         # if sequence part is *
@@ -119,10 +460,9 @@ class KeyValueStore:
         # if given millis is 0, then sequence part should start from 1
         if given_seq_str == "*":
             last_millis = None
-            if key in self.data:
-                last_millis, last_sequence = map(
-                    int, self.data[key]["last_identifier"].split("-")
-                )
+            last_id = self.get_last_stream_id(key)
+            if last_id:
+                last_millis, last_sequence = last_id
 
             millis_part = int(given_milli_str)
             if millis_part == last_millis:
@@ -134,80 +474,204 @@ class KeyValueStore:
 
             return f"{millis_part}-{seq_part}"
 
-    def get_stream_range(self, key, start, end):
-        if key in self.data and self.data[key]["type"] == "stream":
-            if start != "-":
-                try:
-                    start_millis, start_seq = map(int, start.split("-"))
-                except ValueError:
-                    start_millis, start_seq = int(start.split("-")[0]), 0
-            else:
-                start_millis, start_seq = 0, 0
-            if end != "+":
-                try:
-                    end_millis, end_seq = map(int, end.split("-"))
-                except ValueError:
-                    end_millis, end_seq = int(end.split("-")[0]), sys.maxsize
-            else:
-                end_millis, end_seq = sys.maxsize, sys.maxsize
-            stream_data = self.data[key]["value"]
-            result = []
-            for data in stream_data:
-                millis, seq = map(int, data["identifier"].split("-"))
-                if start_millis <= millis <= end_millis:
-                    if start_millis == millis and seq < start_seq:
-                        continue
-                    if end_millis == millis and seq > end_seq:
-                        continue
-                    result.append([data["identifier"], data["values"]])
-            if result:
-                return result
+    def get_stream_range(self, key, start, end, count=None):
+        stream = self.get_stream(key)
+        if stream is None:
+            return None
+        start_id = parse_stream_id(start)
+        end_id = parse_stream_id(end, missing_seq=SEQ_MASK)
+        result = [
+            [format_stream_id(stream_id), values]
+            for stream_id, values in stream.range(start_id, end_id, count)
+        ]
+        if result:
+            return result
         return None
 
-    def get_stream_read(self, key, identifier):
-        if key in self.data and self.data[key]["type"] == "stream":
-            stream_data = self.data[key]["value"]
-            given_millis, given_seq = map(int, identifier.split("-"))
-            result = []
-            for data in stream_data:
-                current_millis, current_seq = map(int, data["identifier"].split("-"))
-                if current_millis > given_millis or (
-                    current_millis == given_millis and current_seq > given_seq
-                ):
-                    result.append([data["identifier"], data["values"]])
-            if result:
-                return [key, result]
+    def get_stream_read(self, key, identifier, count=None):
+        stream = self.get_stream(key)
+        if stream is None:
+            return None
+        result = [
+            [format_stream_id(stream_id), values]
+            for stream_id, values in stream.read_after(
+                parse_stream_id(identifier), count
+            )
+        ]
+        if result:
+            return [key, result]
         return None
 
-    def expire_data(self):
-        for key in list(self.data.keys()):
-            value = self.data[key]
-            if value["expiry_time"] and value["expiry_time"] < datetime.datetime.now():
-                del self.data[key]
+    def expire_if_needed(self, key, now=None):
+        """
+        Lazily delete key if it is expired. Returns True if it got deleted.
+        Batch operations pass now, read once for all their keys.
+        """
+        expiry_time = self.expires.get(key)
+        if expiry_time is None:
+            return False
+        if now is None:
+            now = self.get_current_millis()
+        if expiry_time > now:
+            return False
+        self.delete(key)
+        return True
+
+    def active_expire_cycle(self, time_limit_ms):
+        """
+        Delete keys whose expiry time has passed, in deadline order, until
+        there are none left or time_limit_ms is used up. Returns the number
+        of keys deleted.
+        """
+        deadline = time.monotonic() + time_limit_ms / 1000
+        now = self.get_current_millis()
+        expired = 0
+        checked = 0
+        while self.expiry_index and self.expiry_index[0][0] <= now:
+            expiry_time, key = heapq.heappop(self.expiry_index)
+            if self.expires.get(key) == expiry_time:
+                self.delete(key)
+                expired += 1
+            checked += 1
+            if checked % ACTIVE_EXPIRE_CYCLE_KEYS_PER_LOOP == 0:
+                if time.monotonic() > deadline:
+                    break
+        return expired
 
     def get(self, key):
-        self.expire_data()
-        if key not in self.data:
+        if key not in self.data or self.expire_if_needed(key):
+            return None
+        if self.data[key].type != OBJ_STRING:
+            raise WrongType()
+        return self.data[key].get_string()
+
+    def get_many(self, keys):
+        """
+        Values of keys, None for the missing ones and the ones that aren't
+        strings, like MGET.
+        """
+        now = self.get_current_millis()
+        values = []
+        for key in keys:
+            obj = self.data.get(key)
+            if obj is None or self.expire_if_needed(key, now):
+                values.append(None)
+            else:
+                values.append(obj.get_string() if obj.type == OBJ_STRING else None)
+        return values
+
+    def get_string_object(self, key):
+        if key not in self.data or self.expire_if_needed(key):
             return None
-        return self.data[key]["value"]
+        obj = self.data[key]
+        if obj.type != OBJ_STRING:
+            raise WrongType()
+        return obj
+
+    def increment(self, key, delta):
+        """
+        Add delta to the integer key holds, a missing key counting as 0, like
+        INCRBY. The new value is stored int encoded and the key keeps its
+        expiry. Returns the new value.
+        """
+        obj = self.get_string_object(key)
+        if obj is None:
+            value = 0
+        elif obj.encoding == OBJ_ENCODING_INT:
+            value = obj.value
+        else:
+            value = parse_long(obj.value)
+            if value is None:
+                raise InvalidValue("ERR value is not an integer or out of range")
+        value += delta
+        if not LLONG_MIN <= value <= LLONG_MAX:
+            raise InvalidValue("ERR increment or decrement would overflow")
+        self.data[key] = create_int_object(value)
+        self.dirty += 1
+        return value
+
+    def increment_float(self, key, delta):
+        """
+        Add the float delta to the number key holds, like INCRBYFLOAT. The
+        result is stored as a string, returns it.
+        """
+        obj = self.get_string_object(key)
+        value = 0.0
+        if obj is not None:
+            value = parse_double(obj.get_string())
+            if value is None or math.isinf(value):
+                raise InvalidValue("ERR value is not a valid float")
+        value += delta
+        if math.isnan(value) or math.isinf(value):
+            raise InvalidValue("ERR increment would produce NaN or Infinity")
+        result = format_double(value)
+        self.data[key] = create_string_object(result)
+        self.dirty += 1
+        return result
+
+    def get_encoding(self, key):
+        if key not in self.data or self.expire_if_needed(key):
+            return None
+        return ENCODING_NAMES[self.data[key].encoding]
+
+    def set_many(self, pairs):
+        """
+        Set every (key, value) of pairs, clearing their expiry, like MSET.
+        """
+        for key, value in pairs:
+            self.data[key] = create_string_object(value)
+            self.expires.pop(key, None)
+        self.dirty += len(pairs)
+
+    def set_many_if_none_exist(self, pairs):
+        """
+        Set pairs only if none of their keys exists, like MSETNX. Returns
+        whether they got set.
+        """
+        if self.count_existing([key for key, _ in pairs]):
+            return False
+        self.set_many(pairs)
+        return True
+
+    def count_existing(self, keys):
+        """
+        Number of keys that exist, a key given twice counts twice.
+        """
+        now = self.get_current_millis()
+        count = 0
+        for key in keys:
+            if key in self.data and not self.expire_if_needed(key, now):
+                count += 1
+        return count
+
+    def delete_many(self, keys):
+        """
+        Delete keys, returns the number of keys that existed.
+        """
+        now = self.get_current_millis()
+        deleted = 0
+        for key in keys:
+            if key in self.data and not self.expire_if_needed(key, now):
+                self.delete(key)
+                deleted += 1
+        return deleted
 
     def get_type(self, key):
-        if key not in self.data:
+        if key not in self.data or self.expire_if_needed(key):
             return None
         else:
-            return self.data[key]["type"]
+            return TYPE_NAMES[self.data[key].type]
 
     def get_keys(self):
-        return list(self.data.keys())
-
-    def get_time_from_epoch(self, epoch):
-        expiry_time = datetime.datetime.fromtimestamp(epoch / 1000)
-        return expiry_time
+        return [key for key in list(self.data) if not self.expire_if_needed(key)]
 
     def load_data_from_rdb(self, rdb):
         for db in rdb.data.values():
             for kv in db:
-                expiry = None
-                if kv.expiry:
-                    expiry = self.get_time_from_epoch(kv.expiry)
-                self.set_with_expiry_time(kv.key, kv.value, expiry)
+                if isinstance(kv.value, RedisObject):
+                    obj = kv.value
+                elif isinstance(kv.value, Stream):
+                    obj = RedisObject(OBJ_STREAM, kv.value)
+                else:
+                    obj = create_string_object(kv.value)
+                self.set_object(kv.key, obj, kv.expiry)
@@ -0,0 +1,123 @@
+import bisect
+
+# Entries kept in one macro node, like Redis' stream-node-max-entries.
+STREAM_NODE_MAX_ENTRIES = 100
+
+SEQ_BITS = 64
+SEQ_MASK = (1 << SEQ_BITS) - 1
+MIN_STREAM_ID = 0
+MAX_STREAM_ID = (1 << (2 * SEQ_BITS)) - 1
+
+
+def pack_stream_id(millis, seq):
+    return (millis << SEQ_BITS) | seq
+
+
+def unpack_stream_id(stream_id):
+    return stream_id >> SEQ_BITS, stream_id & SEQ_MASK
+
+
+def format_stream_id(stream_id):
+    millis, seq = unpack_stream_id(stream_id)
+    return f"{millis}-{seq}"
+
+
+def parse_stream_id(identifier, missing_seq=0):
+    """
+    Parse "<ms>-<seq>", "<ms>", "-" or "+" into a packed stream id. Raises
+    ValueError for anything else.
+    """
+    if identifier == "-":
+        return MIN_STREAM_ID
+    if identifier == "+":
+        return MAX_STREAM_ID
+    millis, separator, seq = identifier.partition("-")
+    millis = int(millis)
+    seq = int(seq) if separator else missing_seq
+    if millis < 0 or seq < 0 or millis > SEQ_MASK or seq > SEQ_MASK:
+        raise ValueError(f"Invalid stream ID: {identifier}")
+    return pack_stream_id(millis, seq)
+
+
+class StreamNode:
+    __slots__ = ("ids", "values")
+
+    def __init__(self):
+        self.ids = []
+        self.values = []
+
+
+class Stream:
+    """
+    Append only log of (id, values) entries. Ids are packed (ms, seq)
+    integers kept sorted in macro nodes of STREAM_NODE_MAX_ENTRIES, so a
+    lookup is a bisect over the node start ids followed by one inside the
+    node.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.first_ids = []
+        self.length = 0
+        self.last_id = MIN_STREAM_ID
+
+    def append(self, stream_id, values):
+        if self.length and stream_id <= self.last_id:
+            raise ValueError("Stream ID must be greater than the last one")
+        if not self.nodes or len(self.nodes[-1].ids) >= STREAM_NODE_MAX_ENTRIES:
+            self.nodes.append(StreamNode())
+            self.first_ids.append(stream_id)
+        node = self.nodes[-1]
+        node.ids.append(stream_id)
+        node.values.append(values)
+        self.length += 1
+        self.last_id = stream_id
+
+    def copy(self):
+        """
+        Copy sharing every node but the last one, the only one append
+        changes.
+        """
+        stream = Stream()
+        stream.nodes = self.nodes[:]
+        if stream.nodes:
+            last = StreamNode()
+            last.ids = self.nodes[-1].ids[:]
+            last.values = self.nodes[-1].values[:]
+            stream.nodes[-1] = last
+        stream.first_ids = self.first_ids[:]
+        stream.length = self.length
+        stream.last_id = self.last_id
+        return stream
+
+    def range(self, start, end, count=None):
+        """
+        Entries with start <= id <= end, at most count of them when count
+        is given.
+        """
+        result = []
+        if not self.nodes or start > end:
+            return result
+        node_index = max(bisect.bisect_right(self.first_ids, start) - 1, 0)
+        position = bisect.bisect_left(self.nodes[node_index].ids, start)
+        while node_index < len(self.nodes):
+            node = self.nodes[node_index]
+            while position < len(node.ids):
+                stream_id = node.ids[position]
+                if stream_id > end:
+                    return result
+                result.append((stream_id, node.values[position]))
+                if count and len(result) >= count:
+                    return result
+                position += 1
+            node_index += 1
+            position = 0
+        return result
+
+    def read_after(self, stream_id, count=None):
+        if stream_id >= MAX_STREAM_ID:
+            return []
+        return self.range(stream_id + 1, MAX_STREAM_ID, count)
+
+    def __len__(self):
+        return self.length
@@ -0,0 +1,85 @@
+import heapq
+import itertools
+import time
+
+
+# Returned by a timer callback that should not be rescheduled.
+NO_MORE = -1
+
+
+def monotonic_millis():
+    return time.monotonic_ns() // 1_000_000
+
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __str__(self):
+        return f"<Timer {self.callback.__name__} at {self.when}>"
+
+
+class TimerQueue:
+    """
+    Min-heap of timers ordered by their monotonic deadline in milliseconds.
+
+    A callback can return the number of milliseconds after which it should
+    run again, anything else (None or NO_MORE) removes the timer. Cancelled
+    timers stay in the heap and are dropped when they reach the top.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def add_timer(self, milliseconds, callback, *args):
+        timer = Timer(monotonic_millis() + milliseconds, callback, args)
+        self.push(timer)
+        return timer
+
+    def push(self, timer):
+        heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+
+    def get_next_deadline(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def get_timeout(self):
+        """
+        Seconds until the nearest timer is due, to be used as select timeout.
+        None means there is nothing scheduled and select may block forever.
+        """
+        deadline = self.get_next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - monotonic_millis(), 0) / 1000
+
+    def process_timers(self):
+        now = monotonic_millis()
+        processed = 0
+        # Timers scheduled by the callbacks below are due on the next
+        # iteration at the earliest, so they can't starve the event loop.
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        for timer in due:
+            if timer.cancelled:
+                continue
+            processed += 1
+            result = timer.callback(*timer.args)
+            if isinstance(result, int) and result != NO_MORE and not timer.cancelled:
+                timer.when = now + result
+                self.push(timer)
+        return processed
+
+    def __len__(self):
+        return len(self.heap)
@@ -5,11 +5,19 @@ def generate_repl_id():
     return uuid.uuid4().hex
 
 
-def is_bigger_stream_id(id1, id2):
-    if id2 == "$":
-        return True
-    id1_millisecs, id1_seq = id1.split("-")
-    id2_millisecs, id2_seq = id2.split("-")
-    if id1_millisecs == id2_millisecs:
-        return int(id1_seq) > int(id2_seq)
-    return int(id1_millisecs) > int(id2_millisecs)
+
+def get_private_dirty_bytes():
+    """
+    Memory this process has written to and doesn't share, for a forked
+    child that is the copy-on-write overhead. 0 where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            lines = smaps.readlines()
+    except OSError:
+        return 0
+    total = 0
+    for line in lines:
+        if line.startswith("Private_Dirty:"):
+            total += int(line.split()[1]) * 1024
+    return total
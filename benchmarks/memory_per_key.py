@@ -0,0 +1,58 @@
+"""
+Reports the keyspace memory used per key, for the dict based entries the
+store used to keep and for the current RedisObject entries.
+
+    python3 -m benchmarks.memory_per_key --keys 100000
+"""
+import argparse
+import gc
+import tracemalloc
+
+from app.store import KeyValueStore
+
+
+def build_keys(count):
+    return [f"key:{i}" for i in range(count)], [f"value:{i}" for i in range(count)]
+
+
+def legacy_store(keys, values):
+    data = {}
+    for key, value in zip(keys, values):
+        data[key] = {"value": value, "expiry_time": None, "type": "string"}
+    return data
+
+
+def current_store(keys, values):
+    store = KeyValueStore()
+    for key, value in zip(keys, values):
+        store.set_with_expiry_time(key, value, None)
+    return store
+
+
+def measure(build, keys, values):
+    gc.collect()
+    tracemalloc.start()
+    result = build(keys, values)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyspace memory benchmark")
+    parser.add_argument("--keys", type=int, default=100_000)
+    args = parser.parse_args()
+
+    # Keys and values are allocated up front so only the keyspace overhead
+    # is measured.
+    keys, values = build_keys(args.keys)
+    before = measure(legacy_store, keys, values)
+    after = measure(current_store, keys, values)
+    print(f"keys:          {args.keys}")
+    print(f"before (dict): {before / args.keys:.1f} bytes/key")
+    print(f"after (slots): {after / args.keys:.1f} bytes/key")
+
+
+if __name__ == "__main__":
+    main()
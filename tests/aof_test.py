@@ -0,0 +1,219 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from app.aof import (
+    FSYNC_ALWAYS,
+    FSYNC_NO,
+    AppendOnlyFile,
+    InvalidAofFileException,
+    can_rewrite_as_commands,
+    rewrite_commands,
+)
+from app.server import RedisServer
+from app.store import OBJ_HASH, OBJ_LIST, KeyValueStore, RedisObject
+
+SET_FOO = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n"
+
+
+class TestAppendOnlyFile(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, "appendonly.aof")
+
+    def read(self):
+        with open(self.path, "rb") as aof_file:
+            return aof_file.read()
+
+    def test_commands_are_written_on_flush(self):
+        aof = AppendOnlyFile(self.path, FSYNC_NO)
+        aof.feed(SET_FOO)
+        aof.feed(SET_FOO)
+        self.assertEqual(self.read(), b"")
+        aof.flush()
+        self.assertEqual(self.read(), SET_FOO * 2)
+        self.assertEqual(aof.buffer, b"")
+
+    def test_always_syncs_on_flush(self):
+        aof = AppendOnlyFile(self.path, FSYNC_ALWAYS)
+        with patch("app.aof.os.fsync") as fsync:
+            aof.flush()
+            fsync.assert_not_called()
+            aof.feed(SET_FOO)
+            aof.flush()
+            fsync.assert_called_once_with(aof.fd)
+
+    def test_rewrite_keeps_commands_fed_meanwhile(self):
+        aof = AppendOnlyFile(self.path, FSYNC_NO)
+        aof.feed(SET_FOO)
+        aof.start_rewrite()
+        aof.feed(b"*2\r\n$3\r\nDEL\r\n$3\r\nfoo\r\n")
+        temp_path = os.path.join(self.tempdir.name, "temp.aof")
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(b"*1\r\n$4\r\nPING\r\n")
+        aof.finish_rewrite(temp_path)
+        self.assertEqual(
+            self.read(), b"*1\r\n$4\r\nPING\r\n*2\r\n$3\r\nDEL\r\n$3\r\nfoo\r\n"
+        )
+        aof.feed(SET_FOO)
+        aof.flush()
+        self.assertTrue(self.read().endswith(SET_FOO))
+        self.assertFalse(os.path.exists(temp_path))
+
+    def test_rewrite_commands(self):
+        store = KeyValueStore()
+        store.set(b"foo", b"bar")
+        store.set_with_expiry_time(b"volatile", b"1", 4102444800000)
+        store.add_stream_data(b"stream", [b"a", b"1"], "1-1")
+        commands = list(rewrite_commands(store.data, store.expires))
+        self.assertEqual(
+            commands,
+            [
+                SET_FOO,
+                b"*5\r\n$3\r\nSET\r\n$8\r\nvolatile\r\n$1\r\n1\r\n$4\r\nPXAT\r\n"
+                b"$13\r\n4102444800000\r\n",
+                b"*5\r\n$4\r\nXADD\r\n$6\r\nstream\r\n$3\r\n1-1\r\n$1\r\na\r\n"
+                b"$1\r\n1\r\n",
+            ],
+        )
+
+    def test_collections_cannot_be_rewritten_as_commands(self):
+        store = KeyValueStore()
+        store.set(b"foo", b"bar")
+        store.add_stream_data(b"stream", [b"a", b"1"], "1-1")
+        self.assertTrue(can_rewrite_as_commands(store.data, store.expires))
+        store.set_expiry(b"stream", 4102444800000)
+        self.assertFalse(can_rewrite_as_commands(store.data, store.expires))
+        store.persist(b"stream")
+        store.set_object(b"hash", RedisObject(OBJ_HASH, {b"f": b"v"}), None)
+        self.assertFalse(can_rewrite_as_commands(store.data, store.expires))
+
+
+class TestServerAppendOnly(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, "appendonly.aof")
+
+    def create_server(self, **kwargs):
+        server = RedisServer(
+            port=0,
+            rdb_dir=self.tempdir.name,
+            appendonly=True,
+            appendfsync=FSYNC_NO,
+            **kwargs,
+        )
+        server.load_initial_data()
+        return server
+
+    def test_writes_are_replayed_at_startup(self):
+        server = self.create_server()
+        server.propagate(SET_FOO)
+        server.aof.flush()
+        restarted = self.create_server()
+        self.assertEqual(restarted.get_data(b"foo"), b"bar")
+        self.assertEqual(restarted.store.dirty, 0)
+
+    def test_truncated_command_is_cut(self):
+        with open(self.path, "wb") as aof_file:
+            aof_file.write(SET_FOO + SET_FOO[:10])
+        server = self.create_server()
+        self.assertEqual(server.get_data(b"foo"), b"bar")
+        self.assertEqual(os.path.getsize(self.path), len(SET_FOO))
+
+    def test_relative_expiry_is_written_as_absolute(self):
+        server = self.create_server()
+        data = server.create_connection_data(("test",))
+        data.inb = server.encoder.generate_array_string(
+            [b"SET", b"foo", b"bar", b"PX", b"100"]
+        )
+        server.command_handler.handle_message(data, None)
+        server.aof.flush()
+        expiry = server.store.get_expiry(b"foo")
+        with open(self.path, "rb") as aof_file:
+            self.assertEqual(
+                aof_file.read(),
+                server.encoder.generate_array_string(
+                    [b"SET", b"foo", b"bar", b"PXAT", b"%d" % expiry]
+                ),
+            )
+        time.sleep(0.11)
+        restarted = self.create_server()
+        self.assertIsNone(restarted.get_data(b"foo"))
+
+    def test_unknown_command_aborts_loading(self):
+        with open(self.path, "wb") as aof_file:
+            aof_file.write(SET_FOO + b"*1\r\n$7\r\nUNKNOWN\r\n")
+        with self.assertRaises(InvalidAofFileException):
+            self.create_server()
+
+    def test_background_rewrite(self):
+        server = self.create_server(aof_use_rdb_preamble=False)
+        for value in [b"1", b"2", b"3"]:
+            server.set_data(b"foo", value)
+            server.propagate(
+                server.encoder.generate_array_string([b"SET", b"foo", value])
+            )
+        self.assertTrue(server.rewrite_append_only_file_background())
+        server.propagate(SET_FOO)
+        while server.has_aof_child():
+            time.sleep(0.01)
+            server.check_aof_child_done()
+        self.assertTrue(server.aof_lastbgrewrite_ok)
+        with open(self.path, "rb") as aof_file:
+            self.assertEqual(
+                aof_file.read(),
+                b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$1\r\n3\r\n" + SET_FOO,
+            )
+
+    def test_rewrite_without_preamble_keeps_collections(self):
+        server = self.create_server(aof_use_rdb_preamble=False)
+        list_obj = RedisObject(OBJ_LIST, [b"a", b"b"])
+        server.store.set_object(b"list", list_obj, 4102444800000)
+        server.set_data(b"foo", b"bar")
+        self.assertTrue(server.rewrite_append_only_file_background())
+        while server.has_aof_child():
+            time.sleep(0.01)
+            server.check_aof_child_done()
+        self.assertTrue(server.aof_lastbgrewrite_ok)
+        restarted = self.create_server(aof_use_rdb_preamble=False)
+        self.assertEqual(restarted.store.data[b"list"].get_elements(), [b"a", b"b"])
+        self.assertEqual(restarted.store.get_expiry(b"list"), 4102444800000)
+        self.assertEqual(restarted.get_data(b"foo"), b"bar")
+
+    def test_info_during_background_rewrite(self):
+        server = self.create_server()
+        self.assertTrue(server.rewrite_append_only_file_background())
+        data = server.create_connection_data(("test",))
+        data.inb = b"*2\r\n$4\r\nINFO\r\n$11\r\npersistence\r\n"
+        info = server.command_handler.handle_message(data, None)
+        self.assertIn(b"aof_rewrite_in_progress:1", info)
+        self.assertIn(b"rdb_bgsave_in_progress:0", info)
+        self.assertIn(b"rdb_current_bgsave_time_sec:-1", info)
+        while server.has_aof_child():
+            time.sleep(0.01)
+            server.check_aof_child_done()
+
+    def test_rewrite_with_rdb_preamble(self):
+        server = self.create_server()
+        hash_obj = RedisObject(OBJ_HASH, {b"field": b"value"})
+        server.store.set_object(b"hash", hash_obj, None)
+        self.assertTrue(server.rewrite_append_only_file_background())
+        server.propagate(SET_FOO)
+        while server.has_aof_child():
+            time.sleep(0.01)
+            server.check_aof_child_done()
+        with open(self.path, "rb") as aof_file:
+            contents = aof_file.read()
+        self.assertTrue(contents.startswith(b"REDIS"))
+        self.assertTrue(contents.endswith(SET_FOO))
+        restarted = self.create_server()
+        self.assertEqual(restarted.store.data[b"hash"], hash_obj)
+        self.assertEqual(restarted.get_data(b"foo"), b"bar")
+
+
+if __name__ == "__main__":
+    unittest.main()
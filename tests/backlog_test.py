@@ -0,0 +1,81 @@
+import unittest
+
+from app.backlog import REPL_BUFFER_BLOCK_SIZE, ReplicationBacklog, ReplicationBuffer
+
+
+class TestReplicationBacklog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.backlog = ReplicationBacklog(size=8)
+
+    def test_empty_backlog_serves_current_offset(self):
+        self.assertTrue(self.backlog.can_serve(0))
+        self.assertEqual(self.backlog.read_from(0), b"")
+        self.assertFalse(self.backlog.can_serve(1))
+
+    def test_read_from_offset(self):
+        self.backlog.feed(b"abcde")
+        self.assertEqual(self.backlog.read_from(0), b"abcde")
+        self.assertEqual(self.backlog.read_from(3), b"de")
+        self.assertEqual(self.backlog.end_offset, 5)
+
+    def test_wraps_around_and_drops_oldest_bytes(self):
+        self.backlog.feed(b"abcde")
+        self.backlog.feed(b"fghij")
+        self.assertEqual(self.backlog.histlen, 8)
+        self.assertEqual(self.backlog.start_offset, 2)
+        self.assertFalse(self.backlog.can_serve(1))
+        self.assertEqual(self.backlog.read_from(2), b"cdefghij")
+        self.assertEqual(self.backlog.read_from(6), b"ghij")
+
+    def test_feed_larger_than_backlog(self):
+        self.backlog.feed(b"ab")
+        self.backlog.feed(b"0123456789")
+        self.assertEqual(self.backlog.start_offset, 4)
+        self.assertEqual(self.backlog.read_from(4), b"23456789")
+
+    def test_starts_at_given_offset(self):
+        backlog = ReplicationBacklog(size=8, offset=100)
+        backlog.feed(b"xyz")
+        self.assertFalse(backlog.can_serve(99))
+        self.assertEqual(backlog.read_from(101), b"yz")
+        with self.assertRaises(ValueError):
+            backlog.read_from(104)
+
+
+class TestReplicationBuffer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.buffer = ReplicationBuffer(offset=10)
+
+    def read_from(self, offset):
+        views = self.buffer.get_views(offset, 1024)
+        data = b"".join(bytes(view) for view in views)
+        for view in views:
+            view.release()
+        return data
+
+    def test_views_from_offset(self):
+        self.buffer.feed(b"abc")
+        self.buffer.feed(b"def")
+        self.assertEqual(self.read_from(10), b"abcdef")
+        self.assertEqual(self.read_from(14), b"ef")
+        self.assertEqual(self.read_from(16), b"")
+        # Released views don't keep the buffer from growing.
+        self.buffer.feed(b"g")
+        self.assertEqual(self.buffer.end_offset, 17)
+
+    def test_trim_drops_whole_blocks(self):
+        block = b"x" * REPL_BUFFER_BLOCK_SIZE
+        self.buffer.feed(block)
+        self.buffer.feed(b"abc")
+        self.assertEqual(len(self.buffer.blocks), 2)
+        self.buffer.trim(12)
+        self.assertEqual(self.buffer.start_offset, 10)
+        self.buffer.trim(10 + REPL_BUFFER_BLOCK_SIZE + 1)
+        self.assertEqual(self.buffer.start_offset, 10 + REPL_BUFFER_BLOCK_SIZE)
+        self.assertEqual(self.read_from(11 + REPL_BUFFER_BLOCK_SIZE), b"bc")
+        self.buffer.trim(self.buffer.end_offset)
+        self.assertEqual(len(self.buffer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from app.blocking import BlockedClient, BlockingRegistry, Waiter, WaitingClients
+
+
+class TestBlockingRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = BlockingRegistry()
+
+    def test_clients_are_indexed_by_key(self):
+        first = BlockedClient("sock1", {"a": 0, "b": 0})
+        second = BlockedClient("sock2", {"b": 5})
+        self.registry.add(first)
+        self.registry.add(second)
+        self.assertEqual(self.registry.get_clients("a"), [first])
+        self.assertEqual(self.registry.get_clients("b"), [first, second])
+        self.assertEqual(self.registry.get_clients("c"), [])
+        self.assertEqual(len(self.registry), 2)
+
+    def test_remove_drops_client_from_every_key(self):
+        self.registry.add(BlockedClient("sock1", {"a": 0, "b": 0}))
+        client = self.registry.remove("sock1")
+        self.assertEqual(client.sock, "sock1")
+        self.assertEqual(self.registry.keys, {})
+        self.assertFalse(self.registry.is_blocked("sock1"))
+        self.assertIsNone(self.registry.remove("sock1"))
+
+
+class TestWaitingClients(unittest.TestCase):
+    def setUp(self) -> None:
+        self.waiting = WaitingClients()
+
+    def test_waiters_resolve_by_offset_and_replica_count(self):
+        one_early = Waiter("sock1", 1, 10)
+        one_late = Waiter("sock2", 1, 50)
+        two_early = Waiter("sock3", 2, 10)
+        for waiter in (one_late, one_early, two_early):
+            self.waiting.add(waiter)
+        self.assertEqual(self.waiting.pop_satisfied([20]), [one_early])
+        self.assertEqual(self.waiting.pop_satisfied([20, 5]), [])
+        satisfied = self.waiting.pop_satisfied([60, 30])
+        self.assertEqual(set(satisfied), {one_late, two_early})
+        self.assertEqual(len(self.waiting), 0)
+        self.assertEqual(self.waiting.queues, {})
+
+    def test_removed_waiter_is_not_resolved(self):
+        self.waiting.add(Waiter("sock1", 1, 10))
+        self.assertIsNotNone(self.waiting.remove("sock1"))
+        self.assertEqual(self.waiting.pop_satisfied([20]), [])
+        self.assertEqual(self.waiting.queues, {})
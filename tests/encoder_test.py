@@ -29,3 +29,38 @@ class TestEncoder(unittest.TestCase):
         print("Res", res)
         expected = b"*1\r\n*2\r\n$10\r\nstream_key\r\n*1\r\n*2\r\n$3\r\n0-2\r\n*2\r\n$11\r\ntemperature\r\n$2\r\n96\r\n"
         self.assertEqual(res, expected)
+
+    def test_bulk_length_is_in_bytes(self):
+        encoder = Encoder()
+        self.assertEqual(encoder.generate_bulkstring("é"), b"$2\r\n\xc3\xa9\r\n")
+        res = encoder.generate_bulkstring(b"\xff\x00")
+        self.assertEqual(res, b"$2\r\n\xff\x00\r\n")
+        # Bytes decoded with surrogateescape get their original value back.
+        value = b"\xff".decode("utf-8", "surrogateescape")
+        self.assertEqual(encoder.generate_bulkstring(value), b"$1\r\n\xff\r\n")
+
+    def test_mixed_array_encoding(self):
+        encoder = Encoder()
+        res = encoder.generate_array_string([b"a", 1, -2, None, ("b",)])
+        expected = b"*5\r\n$1\r\na\r\n:1\r\n:-2\r\n$-1\r\n*1\r\n$1\r\nb\r\n"
+        self.assertEqual(res, expected)
+
+    def test_long_array_and_large_integer(self):
+        encoder = Encoder()
+        res = encoder.generate_array_string(["x"] * 40)
+        self.assertEqual(res, b"*40\r\n" + b"$1\r\nx\r\n" * 40)
+        self.assertEqual(encoder.generate_integer_string(123456), b":123456\r\n")
+
+    def test_shared_replies(self):
+        encoder = Encoder()
+        ok = encoder.generate_success_string()
+        self.assertIs(ok, encoder.generate_simple_string("OK"))
+        one = encoder.generate_integer_string(42)
+        self.assertIs(one, encoder.generate_integer_string(42))
+        self.assertEqual(encoder.generate_array_string([]), b"*0\r\n")
+
+    def test_write_appends_to_buffer(self):
+        encoder = Encoder()
+        out = bytearray(b"+OK\r\n")
+        encoder.write_value(out, ["a", 3])
+        self.assertEqual(out, b"+OK\r\n*2\r\n$1\r\na\r\n:3\r\n")
@@ -2,21 +2,30 @@ import unittest
 from collections import namedtuple
 from unittest.mock import patch
 
+from app.commands import populate_command_table
 from app.handler import CommandHandler
 from app.encoder import Encoder
 from app.store import KeyValueStore
+from app.parser import RespParser
+from app.stream import pack_stream_id
 
-DataBuffer = namedtuple("DataBuffer", ["outb"])
+DataBuffer = namedtuple("DataBuffer", ["inb", "parser"])
 
 
 class DummyServer:
     def __init__(self) -> None:
         self.encoder = Encoder()
+        self.loading = False
+        self.commands = populate_command_table()
+        self.propagated = []
 
     def set_data(self, key, value, expiry):
         pass
 
-    def is_write_command(self, command):
+    def propagate(self, message):
+        self.propagated.append(message)
+
+    def is_replica(self):
         return False
 
     def get_rdb_dir(self):
@@ -25,6 +34,15 @@ class DummyServer:
     def get_rdb_filename(self):
         return "rdbfile"
 
+    def get_hz(self):
+        return 10
+
+    def signal_key_as_ready(self, key):
+        pass
+
+    def block_client_on_streams(self, sock, stream_ids, count, timeout):
+        self.blocked = (sock, stream_ids, count, timeout)
+
 
 class TestCommandHandler(unittest.TestCase):
 
@@ -34,7 +52,7 @@ class TestCommandHandler(unittest.TestCase):
         self.sock = None
 
     def create_data(self, msg):
-        return DataBuffer(outb=msg)
+        return DataBuffer(inb=msg, parser=RespParser())
 
     def test_handle_set(self):
         msg = b"*3\r\n$3\r\nSET\r\n$5\r\nmykey\r\n$7\r\nmyvalue\r\n"
@@ -49,7 +67,12 @@ class TestCommandHandler(unittest.TestCase):
     def test_handle_ping(self):
         msg = b"*1\r\n$4\r\nPING\r\n"
         res = self.handler.handle_message(self.create_data(msg), self.sock)
-        self.assertEqual(res, b"$4\r\nPONG\r\n")
+        self.assertEqual(res, b"+PONG\r\n")
+
+    def test_handle_ping_with_message(self):
+        msg = b"*2\r\n$4\r\nPING\r\n$5\r\nhello\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        self.assertEqual(res, b"$5\r\nhello\r\n")
 
     def test_handle_ok(self):
         msg = b"+OK\r\n"
@@ -66,6 +89,11 @@ class TestCommandHandler(unittest.TestCase):
         res = self.handler.handle_message(self.create_data(msg), self.sock)
         self.assertEqual(res, b"*2\r\n$10\r\ndbfilename\r\n$7\r\nrdbfile\r\n")
 
+    def test_handle_config_hz(self):
+        msg = b"*3\r\n$6\r\nCONFIG\r\n$3\r\nGET\r\n$2\r\nhz\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        self.assertEqual(res, b"*2\r\n$2\r\nhz\r\n$2\r\n10\r\n")
+
     def test_handle_empty_keys(self):
         msg = b"*2\r\n$4\r\nKEYS\r\n$1\r\n*\r\n"
         res = self.handler.handle_message(self.create_data(msg), self.sock)
@@ -73,11 +101,64 @@ class TestCommandHandler(unittest.TestCase):
 
     def test_handle_keys(self):
         msg = b"*2\r\n$4\r\nKEYS\r\n$1\r\n*\r\n"
-        self.store.set("foo", "bar")
+        self.store.set(b"foo", "bar")
         res = self.handler.handle_message(self.create_data(msg), self.sock)
         self.assertEqual(res, b"*1\r\n$3\r\nfoo\r\n")
 
 
+class HandleExpiryTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = KeyValueStore()
+        self.handler = CommandHandler(DummyServer(), store=self.store)
+        self.sock = None
+
+    def create_data(self, msg):
+        return DataBuffer(inb=msg, parser=RespParser())
+
+    def send(self, *args):
+        msg = self.handler.encoder.generate_array_string(list(args))
+        return self.handler.handle_message(self.create_data(msg), self.sock)
+
+    def test_set_with_invalid_expire_time(self):
+        res = self.send("SET", "foo", "bar", "EX", "0")
+        self.assertEqual(res, b"-ERR invalid expire time in 'set' command\r\n")
+
+    def test_set_with_non_integer_expire_time(self):
+        res = self.send("SET", "foo", "bar", "PX", "soon")
+        self.assertEqual(res, b"-ERR value is not an integer or out of range\r\n")
+
+    def test_set_with_conflicting_options(self):
+        res = self.send("SET", "foo", "bar", "EX", "10", "PX", "100")
+        self.assertEqual(res, b"-ERR syntax error\r\n")
+        res = self.send("SET", "foo", "bar", "EX", "10", "KEEPTTL")
+        self.assertEqual(res, b"-ERR syntax error\r\n")
+
+    def test_expiry_time_from_options(self):
+        now = self.store.get_current_millis()
+        self.assertGreaterEqual(self.handler.get_expiry_time(b"EX", 10), now + 10000)
+        self.assertGreaterEqual(self.handler.get_expiry_time(b"PX", 10), now + 10)
+        self.assertEqual(self.handler.get_expiry_time(b"EXAT", 10), 10000)
+        self.assertEqual(self.handler.get_expiry_time(b"PXAT", 10), 10)
+
+    def test_ttl(self):
+        self.store.set(b"foo", "bar", 10000)
+        self.store.set(b"baz", "qux")
+        self.assertEqual(self.send("TTL", "foo"), b":10\r\n")
+        self.assertEqual(self.send("TTL", "baz"), b":-1\r\n")
+        self.assertEqual(self.send("TTL", "missing"), b":-2\r\n")
+
+    def test_pttl(self):
+        self.store.set(b"foo", "bar", 10000)
+        res = self.send("PTTL", "foo")
+        self.assertTrue(9900 < int(res[1:-2]) <= 10000)
+
+    def test_persist(self):
+        self.store.set(b"foo", "bar", 10000)
+        self.assertEqual(self.send("PERSIST", "foo"), b":1\r\n")
+        self.assertEqual(self.send("PERSIST", "foo"), b":0\r\n")
+        self.assertEqual(self.send("TTL", "foo"), b":-1\r\n")
+
+
 class HandleStreamTestCase(unittest.TestCase):
     def setUp(self) -> None:
         self.store = KeyValueStore()
@@ -85,12 +166,12 @@ class HandleStreamTestCase(unittest.TestCase):
         self.sock = None
 
     def create_data(self, msg):
-        return DataBuffer(outb=msg)
+        return DataBuffer(inb=msg, parser=RespParser())
 
     def test_xrange_returns_correct_values(self):
-        self.store.add_stream_data("stream1", ["value1"], identifier="0-1")
-        self.store.add_stream_data("stream1", ["value2"], identifier="0-2")
-        self.store.add_stream_data("stream1", ["value3"], identifier="0-3")
+        self.store.add_stream_data(b"stream1", ["value1"], identifier="0-1")
+        self.store.add_stream_data(b"stream1", ["value2"], identifier="0-2")
+        self.store.add_stream_data(b"stream1", ["value3"], identifier="0-3")
         msg = b"*4\r\n$6\r\nxrange\r\n$7\r\nstream1\r\n$3\r\n0-2\r\n$3\r\n0-4\r\n"
         res = self.handler.handle_message(self.create_data(msg), self.sock)
         expected = b"*2\r\n*2\r\n$3\r\n0-2\r\n*1\r\n$6\r\nvalue2\r\n*2\r\n$3\r\n0-3\r\n*1\r\n$6\r\nvalue3\r\n"
@@ -98,10 +179,10 @@ class HandleStreamTestCase(unittest.TestCase):
 
     def test_xread_returns_correct_values(self):
         self.store.add_stream_data(
-            "somekey", ["temperature", "36", "humidity", "95"], "1526985054069-0"
+            b"somekey", ["temperature", "36", "humidity", "95"], "1526985054069-0"
         )
         self.store.add_stream_data(
-            "somekey",
+            b"somekey",
             ["temperature", "37", "humidity", "94"],
             "1526985054079-0",
         )
@@ -113,26 +194,246 @@ class HandleStreamTestCase(unittest.TestCase):
 
     def test_xread_returns_correct_values_multiple_streams(self):
         self.store.add_stream_data(
-            "somekey", ["temperature", "36", "humidity", "95"], "1526985054069-0"
+            b"somekey", ["temperature", "36", "humidity", "95"], "1526985054069-0"
         )
         self.store.add_stream_data(
-            "somekey",
+            b"somekey",
             ["temperature", "37", "humidity", "94"],
             "1526985054079-0",
         )
         self.store.add_stream_data(
-            "anotherkey", ["temperature", "38", "humidity", "93"], "1526985054089-0"
+            b"anotherkey", ["temperature", "38", "humidity", "93"], "1526985054089-0"
         )
         self.store.add_stream_data(
-            "anotherkey",
+            b"anotherkey",
             ["temperature", "39", "humidity", "92"],
             "1526985054099-0",
         )
-        self.store.add_stream_data("grape", ["temperature", "72"], "0-1")
-        self.store.add_stream_data("grape", ["humidity", "97"], "0-2")
+        self.store.add_stream_data(b"grape", ["temperature", "72"], "0-1")
+        self.store.add_stream_data(b"grape", ["humidity", "97"], "0-2")
         msg = b"*6\r\n$5\r\nxread\r\n$7\r\nstreams\r\n$5\r\ngrape\r\n$9\r\nraspberry\r\n$3\r\n0-0\r\n$3\r\n0-1\r\n"
-        with patch.object(self.store, "get_stream_read") as mock:
+        with patch.object(self.store, "get_stream_read", return_value=[]) as mock:
             self.handler.handle_message(self.create_data(msg), self.sock)
-            mock.assert_any_call("raspberry", "0-1")
-            mock.assert_any_call("grape", "0-0")
+            mock.assert_any_call(b"raspberry", "0-1", None)
+            mock.assert_any_call(b"grape", "0-0", None)
             assert 2 == mock.call_count
+
+    def test_xrange_with_count(self):
+        for i in range(1, 6):
+            self.store.add_stream_data(b"stream1", [f"value{i}"], identifier=f"0-{i}")
+        msg = b"*6\r\n$6\r\nXRANGE\r\n$7\r\nstream1\r\n$1\r\n-\r\n$1\r\n+\r\n$5\r\nCOUNT\r\n$1\r\n2\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        expected = b"*2\r\n*2\r\n$3\r\n0-1\r\n*1\r\n$6\r\nvalue1\r\n*2\r\n$3\r\n0-2\r\n*1\r\n$6\r\nvalue2\r\n"
+        self.assertEqual(res, expected)
+
+    def test_xread_with_count(self):
+        for i in range(1, 6):
+            self.store.add_stream_data(b"stream1", [f"value{i}"], identifier=f"0-{i}")
+        msg = b"*6\r\n$5\r\nXREAD\r\n$5\r\nCOUNT\r\n$1\r\n1\r\n$7\r\nSTREAMS\r\n$7\r\nstream1\r\n$3\r\n0-3\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        expected = b"*1\r\n*2\r\n$7\r\nstream1\r\n*1\r\n*2\r\n$3\r\n0-4\r\n*1\r\n$6\r\nvalue4\r\n"
+        self.assertEqual(res, expected)
+
+    def test_xread_unbalanced_streams(self):
+        msg = b"*5\r\n$5\r\nXREAD\r\n$7\r\nstreams\r\n$2\r\ns1\r\n$2\r\ns2\r\n$1\r\n0\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        self.assertTrue(res.startswith(b"-ERR Unbalanced 'xread' list of streams"))
+
+    def test_xread_block_returns_available_data(self):
+        self.store.add_stream_data(b"stream1", ["foo", "bar"], identifier="0-1")
+        msg = b"*6\r\n$5\r\nXREAD\r\n$5\r\nBLOCK\r\n$1\r\n0\r\n$7\r\nSTREAMS\r\n$7\r\nstream1\r\n$3\r\n0-0\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        expected = b"*1\r\n*2\r\n$7\r\nstream1\r\n*1\r\n*2\r\n$3\r\n0-1\r\n*2\r\n$3\r\nfoo\r\n$3\r\nbar\r\n"
+        self.assertEqual(res, expected)
+
+    def test_xread_block_on_multiple_streams(self):
+        self.store.add_stream_data(b"stream1", ["foo", "bar"], identifier="0-1")
+        msg = b"*8\r\n$5\r\nXREAD\r\n$5\r\nBLOCK\r\n$3\r\n100\r\n$7\r\nSTREAMS\r\n$7\r\nstream1\r\n$7\r\nstream2\r\n$1\r\n$\r\n$3\r\n0-5\r\n"
+        res = self.handler.handle_message(self.create_data(msg), self.sock)
+        self.assertEqual(res, b"")
+        stream_ids = {
+            b"stream1": pack_stream_id(0, 1),
+            b"stream2": pack_stream_id(0, 5),
+        }
+        self.assertEqual(self.handler.server.blocked, (None, stream_ids, None, 100))
+
+
+class TestCommandTable(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = KeyValueStore()
+        self.server = DummyServer()
+        self.handler = CommandHandler(self.server, store=self.store)
+
+    def send(self, *args):
+        msg = self.handler.encoder.generate_array_string(list(args))
+        data = DataBuffer(inb=msg, parser=RespParser())
+        return self.handler.handle_message(data, None)
+
+    def test_dispatch_ignores_case(self):
+        for name in ["PING", "ping", "PiNg"]:
+            self.assertEqual(self.send(name), b"+PONG\r\n")
+
+    def test_unknown_command(self):
+        self.assertEqual(
+            self.send("FOO", "bar"),
+            b"-ERR unknown command 'FOO', with args beginning with: 'bar'\r\n",
+        )
+
+    def test_wrong_number_of_arguments(self):
+        self.assertEqual(
+            self.send("GET", "a", "b"),
+            b"-ERR wrong number of arguments for 'get' command\r\n",
+        )
+        self.assertEqual(
+            self.send("XADD", "s", "*", "field"),
+            b"-ERR wrong number of arguments for 'xadd' command\r\n",
+        )
+        self.assertEqual(self.server.commands["get"].rejected_calls, 1)
+
+    def test_command_count_and_info(self):
+        count = len(self.server.commands)
+        self.assertEqual(self.send("COMMAND", "COUNT"), b":%d\r\n" % count)
+        self.assertEqual(
+            self.send("COMMAND", "INFO", "get", "nosuchcommand"),
+            b"*2\r\n*6\r\n$3\r\nget\r\n:2\r\n*2\r\n$4\r\nfast\r\n$8\r\nreadonly\r\n"
+            b":1\r\n:1\r\n:1\r\n$-1\r\n",
+        )
+
+    def test_only_successful_writes_are_propagated(self):
+        self.send("XADD", "s", "5-*", "f", "v")
+        self.send("XADD", "s", "1-1", "f", "v")
+        self.send("XRANGE", "s", "-", "+")
+        self.assertEqual(
+            self.server.propagated,
+            [b"*5\r\n$4\r\nXADD\r\n$1\r\ns\r\n$3\r\n5-0\r\n$1\r\nf\r\n$1\r\nv\r\n"],
+        )
+
+    def test_replconf_rejects_invalid_arguments(self):
+        self.assertEqual(
+            self.send("REPLCONF", "listening-port", "abc"),
+            b"-ERR value is not an integer or out of range\r\n",
+        )
+        self.assertEqual(
+            self.send("REPLCONF", "listening-port"), b"-ERR syntax error\r\n"
+        )
+        self.assertEqual(self.send("REPLCONF"), b"-ERR syntax error\r\n")
+
+    def test_replconf_ack_rejects_non_integers(self):
+        self.assertEqual(
+            self.send("REPLCONF", "ACK", "x"),
+            b"-ERR value is not an integer or out of range\r\n",
+        )
+
+    def test_command_errors_are_replied(self):
+        bug = RuntimeError("bug")
+        with patch.object(self.server, "get_data", create=True, side_effect=bug):
+            with self.assertLogs("app.logger", level="ERROR"):
+                res = self.send("GET", "foo")
+        self.assertEqual(res, b"-ERR internal error running 'get'\r\n")
+        self.assertEqual(self.server.commands["get"].failed_calls, 1)
+        self.assertEqual(self.send("PING"), b"+PONG\r\n")
+
+    def test_xadd_invalid_id(self):
+        error = b"-ERR Invalid stream ID specified as stream command argument\r\n"
+        for identifier in ["18446744073709551616-1", "1-2-3", "1-x"]:
+            self.assertEqual(self.send("XADD", "s", identifier, "f", "v"), error)
+        self.assertEqual(self.send("TYPE", "s"), b"$4\r\nnone\r\n")
+        self.assertEqual(self.server.propagated, [])
+
+    def test_command_stats(self):
+        self.send("PING")
+        self.send("XADD", "s", "1-1", "f", "v")
+        self.send("XADD", "s", "1-1", "f", "v")
+        xadd = self.server.commands["xadd"]
+        self.assertEqual((xadd.calls, xadd.failed_calls), (2, 1))
+        stats = self.send("INFO", "commandstats")
+        self.assertIn(b"cmdstat_ping:calls=1,", stats)
+        self.assertIn(b"rejected_calls=0,failed_calls=1", stats)
+        self.assertEqual(self.send("CONFIG", "RESETSTAT"), b"+OK\r\n")
+        self.assertEqual(xadd.calls, 0)
+
+
+class TestMultiKeyCommands(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = KeyValueStore()
+        self.server = DummyServer()
+        self.handler = CommandHandler(self.server, store=self.store)
+
+    def send(self, *args):
+        msg = self.handler.encoder.generate_array_string(list(args))
+        data = DataBuffer(inb=msg, parser=RespParser())
+        return self.handler.handle_message(data, None)
+
+    def test_mset_and_mget(self):
+        self.assertEqual(self.send("MSET", "a", "1", "b", "2"), b"+OK\r\n")
+        self.assertEqual(
+            self.send("MGET", "a", "missing", "b"),
+            b"*3\r\n$1\r\n1\r\n$-1\r\n$1\r\n2\r\n",
+        )
+        self.assertEqual(
+            self.send("MSET", "a", "1", "b"),
+            b"-ERR wrong number of arguments for 'mset' command\r\n",
+        )
+        # The whole batch is replicated as one command.
+        self.assertEqual(
+            self.server.propagated,
+            [b"*5\r\n$4\r\nMSET\r\n$1\r\na\r\n$1\r\n1\r\n$1\r\nb\r\n$1\r\n2\r\n"],
+        )
+
+    def test_msetnx(self):
+        self.assertEqual(self.send("MSETNX", "a", "1", "b", "2"), b":1\r\n")
+        self.assertEqual(self.send("MSETNX", "c", "3", "a", "4"), b":0\r\n")
+        self.assertEqual(self.send("MGET", "a", "c"), b"*2\r\n$1\r\n1\r\n$-1\r\n")
+        self.assertEqual(len(self.server.propagated), 1)
+
+    def test_del_exists_and_unlink(self):
+        self.send("MSET", "a", "1", "b", "2", "c", "3")
+        self.assertEqual(self.send("EXISTS", "a", "a", "missing"), b":2\r\n")
+        self.assertEqual(self.send("DEL", "a", "b", "missing"), b":2\r\n")
+        self.assertEqual(self.send("UNLINK", "c"), b":1\r\n")
+        self.assertEqual(self.send("DEL", "a"), b":0\r\n")
+        self.assertEqual(self.send("EXISTS", "a", "b", "c"), b":0\r\n")
+        self.assertEqual(len(self.server.propagated), 3)
+
+    def test_counters(self):
+        self.assertEqual(self.send("INCR", "n"), b":1\r\n")
+        self.assertEqual(self.send("INCRBY", "n", "41"), b":42\r\n")
+        self.assertEqual(self.send("DECRBY", "n", "50"), b":-8\r\n")
+        self.assertEqual(self.send("DECR", "n"), b":-9\r\n")
+        self.assertEqual(self.send("MGET", "n"), b"*1\r\n$2\r\n-9\r\n")
+        self.assertEqual(
+            self.send("INCRBY", "n", "1.5"),
+            b"-ERR value is not an integer or out of range\r\n",
+        )
+        self.assertEqual(
+            self.send("DECRBY", "n", "-9223372036854775808"),
+            b"-ERR decrement would overflow\r\n",
+        )
+        self.send("MSET", "text", "abc")
+        self.assertEqual(
+            self.send("INCR", "text"),
+            b"-ERR value is not an integer or out of range\r\n",
+        )
+        self.assertEqual(len(self.server.propagated), 5)
+
+    def test_incrbyfloat(self):
+        self.assertEqual(self.send("INCRBYFLOAT", "f", "1.25"), b"$4\r\n1.25\r\n")
+        self.assertEqual(
+            self.send("INCRBYFLOAT", "f", "nan"),
+            b"-ERR value is not a valid float\r\n",
+        )
+        # Propagated as a SET of the result.
+        self.assertEqual(
+            self.server.propagated,
+            [b"*4\r\n$3\r\nSET\r\n$1\r\nf\r\n$4\r\n1.25\r\n$7\r\nKEEPTTL\r\n"],
+        )
+
+    def test_object_encoding(self):
+        self.send("MSET", "n", "123", "s", "abc", "big", "x" * 45)
+        self.assertEqual(self.send("OBJECT", "ENCODING", "n"), b"$3\r\nint\r\n")
+        self.assertEqual(self.send("OBJECT", "ENCODING", "s"), b"$6\r\nembstr\r\n")
+        self.assertEqual(self.send("OBJECT", "ENCODING", "big"), b"$3\r\nraw\r\n")
+        self.assertEqual(self.send("OBJECT", "ENCODING", "missing"), b"$-1\r\n")
+        self.assertTrue(self.send("OBJECT", "FREQ", "n").startswith(b"-ERR"))
+        self.assertTrue(self.send("OBJECT", b"\xff", "n").startswith(b"-ERR"))
+
@@ -1,6 +1,12 @@
 import unittest
 
-from app.parser import RespParser, Command
+from app.parser import (
+    PROTO_MAX_BULK_LEN,
+    PROTO_MAX_MULTIBULK_LEN,
+    RespParser,
+    Command,
+    ProtocolError,
+)
 
 
 class TestRespParser(unittest.TestCase):
@@ -99,3 +105,89 @@ class TestRespParser(unittest.TestCase):
         msg = b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n"
         resp = RespParser().parse(msg)
         self.assertEqual(resp[0].get_raw(), msg)
+
+    def test_parse_partial_command(self):
+        parser = RespParser()
+        resp = parser.parse(b"*3\r\n$3\r\nSET\r\n$5\r\nmyk")
+        self.assertEqual(resp, [])
+        resp = parser.parse(b"ey\r\n$7\r\nmyvalue\r\n*1\r\n$4\r\nPI")
+        self.assertEqual(resp, [Command("SET", [b"mykey", b"myvalue"])])
+        resp = parser.parse(b"NG\r\n")
+        self.assertEqual(resp, [Command("PING")])
+        self.assertEqual(parser.buffer, b"")
+
+    def test_parse_split_before_crlf(self):
+        parser = RespParser()
+        msg = b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n"
+        self.assertEqual(parser.parse(msg[:-1]), [])
+        resp = parser.parse(msg[-1:])
+        self.assertEqual(resp, [Command("GET", [b"foo"])])
+        self.assertEqual(resp[0].get_raw(), msg)
+
+    def test_parse_large_binary_value(self):
+        value = b"\r\n*$" * 100000
+        msg = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$%d\r\n%s\r\n" % (len(value), value)
+        parser = RespParser()
+        commands = []
+        for i in range(0, len(msg), 1024):
+            commands.extend(parser.parse(msg[i : i + 1024]))
+        self.assertEqual(commands, [Command("SET", [b"foo", value])])
+        self.assertEqual(commands[0].get_size(), len(msg))
+
+    def test_parse_partial_rdb(self):
+        msg = b"$9\r\nREDIS0011*1\r\n$4\r\nPING\r\n"
+        parser = RespParser()
+        self.assertEqual(parser.parse(msg[:8]), [])
+        resp = parser.parse(msg[8:])
+        self.assertEqual(resp, [Command("RDB", [b"REDIS0011"]), Command("PING")])
+
+    def test_stream_rdb(self):
+        msg = b"+FULLRESYNC id 0\r\n$9\r\nREDIS0011*1\r\n$4\r\nPING\r\n"
+        parser = RespParser(stream_rdb=True)
+        commands = []
+        for i in range(0, len(msg), 5):
+            commands.extend(parser.parse(msg[i : i + 5]))
+        self.assertEqual(commands[1], Command("RDBSTART", [b"9"]))
+        payload = b"".join(i.data[0] for i in commands if i.command == "RDBDATA")
+        self.assertEqual(payload, b"REDIS0011")
+        self.assertEqual(commands[-1], Command("PING"))
+        self.assertEqual(commands[-1].get_size(), 14)
+
+    def test_stream_rdb_ended_by_mark(self):
+        mark = b"0123456789" * 4
+        msg = b"$EOF:%s\r\nREDIS0011%s*1\r\n$4\r\nPING\r\n" % (mark, mark)
+        parser = RespParser(stream_rdb=True)
+        commands = []
+        for i in range(0, len(msg), 5):
+            commands.extend(parser.parse(msg[i : i + 5]))
+        self.assertEqual(commands[0], Command("RDBSTART"))
+        payload = b"".join(i.data[0] for i in commands if i.command == "RDBDATA")
+        self.assertEqual(payload, b"REDIS0011")
+        self.assertEqual(commands[-2:], [Command("RDBEND"), Command("PING")])
+
+    def test_parse_invalid_array(self):
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"*1\r\n+PING\r\n")
+
+    def test_parse_negative_bulk_length(self):
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"*1\r\n$-11\r\n")
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"$-5\r\n")
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"*-2\r\n")
+        # A null bulk string is a reply, not a command.
+        resp = RespParser().parse(b"$-1\r\n*1\r\n$4\r\nPING\r\n")
+        self.assertEqual(resp, [Command("PING")])
+
+    def test_parse_length_over_limit(self):
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"*1\r\n$%d\r\n" % (PROTO_MAX_BULK_LEN + 1))
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"*%d\r\n" % (PROTO_MAX_MULTIBULK_LEN + 1))
+
+    def test_parse_invalid_command_name(self):
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"*1\r\n$1\r\n\xff\r\n")
+        with self.assertRaises(ProtocolError):
+            RespParser().parse(b"+\xff\r\n")
@@ -1,6 +1,42 @@
+import os
+import tempfile
 import unittest
 
-from app.rdb.parser import RdbParser, InvalidRdbFileException
+from app.rdb.crc64 import crc64
+from app.rdb.listpack import encode_listpack
+from app.rdb.lzf import LzfError, lzf_decompress
+from app.rdb.parser import RdbParser, RdbStreamLoader, InvalidRdbFileException
+from app.rdb.writer import RdbWriter
+from app.store import (
+    OBJ_ENCODING_INTSET,
+    OBJ_ENCODING_LISTPACK,
+    OBJ_HASH,
+    OBJ_LIST,
+    OBJ_SET,
+    OBJ_STRING,
+    OBJ_ZSET,
+    KeyValueStore,
+    RedisObject,
+)
+
+
+def make_rdb(body, checksum=True):
+    contents = b"REDIS0011\xfe\x00" + body + b"\xff"
+    crc = crc64(0, contents) if checksum else 0
+    return contents + crc.to_bytes(8, "little")
+
+
+def make_ziplist(entries):
+    body = b"".join(entries)
+    total = 10 + len(body) + 1
+    header = total.to_bytes(4, "little") + bytes(4) + len(entries).to_bytes(2, "little")
+    return header + body + b"\xff"
+
+
+def load(body):
+    store = KeyValueStore()
+    RdbParser().load(make_rdb(body), store)
+    return store
 
 
 class RDBParserTest(unittest.TestCase):
@@ -42,8 +78,8 @@ class RDBParserTest(unittest.TestCase):
     def test_read_key_with_expiry(self):
         parser = RdbParser()
         cursor, kv = parser.read_key_value(11, self.sample_rdb_data)
-        self.assertEqual(kv.key, "expires_ms_precision")
-        self.assertEqual(kv.value, "2022-12-25 10:11:12.573 UTC")
+        self.assertEqual(kv.key, b"expires_ms_precision")
+        self.assertEqual(kv.value, b"2022-12-25 10:11:12.573 UTC")
         self.assertEqual(kv.data_type, 0)
         # self.assertEqual(kv.expiry, 0)
         self.assertEqual(cursor, 70)
@@ -57,7 +93,7 @@ class RDBParserTest(unittest.TestCase):
     def test_read_string_encoding(self):
         parser = RdbParser()
         cursor, value = parser.read_string_encoding(21, self.sample_rdb_data)
-        self.assertEqual(value, "expires_ms_precision")
+        self.assertEqual(value, b"expires_ms_precision")
         self.assertEqual(cursor, 42)
 
     def test_parse(self):
@@ -65,8 +101,8 @@ class RDBParserTest(unittest.TestCase):
         rdb = parser.parse(self.sample_rdb_data)
         self.assertEqual(rdb.version, 4)
         kv = rdb.data[0][0]
-        self.assertEqual(kv.key, "expires_ms_precision")
-        self.assertEqual(kv.value, "2022-12-25 10:11:12.573 UTC")
+        self.assertEqual(kv.key, b"expires_ms_precision")
+        self.assertEqual(kv.value, b"2022-12-25 10:11:12.573 UTC")
         self.assertEqual(kv.data_type, 0)
         self.assertEqual(len(rdb.data), 1)
 
@@ -76,8 +112,8 @@ class RDBParserTest(unittest.TestCase):
         rdb = parser.parse(sample)
         self.assertEqual(rdb.version, 3)
         kv = rdb.data[0][0]
-        self.assertEqual(kv.key, "raspberry")
-        self.assertEqual(kv.value, "strawberry")
+        self.assertEqual(kv.key, b"raspberry")
+        self.assertEqual(kv.value, b"strawberry")
         self.assertEqual(kv.data_type, 0)
         self.assertEqual(len(rdb.data), 1)
 
@@ -87,26 +123,248 @@ class RDBParserTest(unittest.TestCase):
         rdb = parser.parse(sample)
         self.assertEqual(rdb.version, 3)
         kv = rdb.data[0][0]
-        self.assertEqual(kv.key, "grape")
-        self.assertEqual(kv.value, "apple")
+        self.assertEqual(kv.key, b"grape")
+        self.assertEqual(kv.value, b"apple")
         self.assertEqual(kv.expiry, 1956528000000)
 
         kv = rdb.data[0][1]
-        self.assertEqual(kv.key, "blueberry")
-        self.assertEqual(kv.value, "raspberry")
+        self.assertEqual(kv.key, b"blueberry")
+        self.assertEqual(kv.value, b"raspberry")
         self.assertEqual(kv.expiry, 1640995200000)
 
         kv = rdb.data[0][2]
-        self.assertEqual(kv.key, "strawberry")
-        self.assertEqual(kv.value, "banana")
+        self.assertEqual(kv.key, b"strawberry")
+        self.assertEqual(kv.value, b"banana")
         self.assertEqual(kv.expiry, 1956528000000)
 
         kv = rdb.data[0][3]
-        self.assertEqual(kv.key, "raspberry")
-        self.assertEqual(kv.value, "grape")
+        self.assertEqual(kv.key, b"raspberry")
+        self.assertEqual(kv.value, b"grape")
         self.assertEqual(kv.expiry, 1956528000000)
 
         kv = rdb.data[0][4]
-        self.assertEqual(kv.key, "pear")
-        self.assertEqual(kv.value, "orange")
+        self.assertEqual(kv.key, b"pear")
+        self.assertEqual(kv.value, b"orange")
         self.assertEqual(kv.expiry, 1956528000000)
+
+    def test_read_key_with_seconds_expiry(self):
+        sample = b"\xfd\x00\x9c\xef\x12\x00\x03foo\x03bar"
+        parser = RdbParser()
+        cursor, kv = parser.read_key_value(0, sample)
+        self.assertEqual(kv.key, b"foo")
+        self.assertEqual(kv.value, b"bar")
+        self.assertEqual(kv.expiry, 0x12EF9C00 * 1000)
+        self.assertEqual(cursor, len(sample))
+
+
+class TestLzf(unittest.TestCase):
+    def test_back_reference(self):
+        self.assertEqual(lzf_decompress(b"\x02abc\x80\x02", 9), b"abcabcabc")
+
+    def test_extended_back_reference(self):
+        self.assertEqual(lzf_decompress(b"\x00a\xe0\x03\x00", 13), b"a" * 13)
+
+    def test_wrong_length(self):
+        self.assertRaises(LzfError, lzf_decompress, b"\x02abc", 4)
+
+    def test_reference_before_start(self):
+        self.assertRaises(LzfError, lzf_decompress, b"\x00a\x20\x05", 4)
+
+
+class TestRdbLoader(unittest.TestCase):
+    def test_string_encodings(self):
+        contents = make_rdb(
+            b"\x00\x01a\xc0\xfb"
+            b"\x00\x01b\xc1\x39\x30"
+            b"\x00\x01c\xc2\x00\x00\x00\x80"
+            b"\x00\x01d\xc3\x06\x09\x02abc\x80\x02"
+            b"\x00\x01e\x80\x00\x00\x00\x03xyz"
+        )
+        store = KeyValueStore()
+        self.assertEqual(RdbParser().load(contents, store), 5)
+        self.assertEqual(store.get(b"a"), b"-5")
+        self.assertEqual(store.get(b"b"), b"12345")
+        self.assertEqual(store.get(b"c"), b"%d" % -(2**31))
+        self.assertEqual(store.get(b"d"), b"abcabcabc")
+        self.assertEqual(store.get(b"e"), b"xyz")
+        self.assertEqual(store.dirty, 0)
+
+    def test_wrong_checksum(self):
+        contents = bytearray(make_rdb(b"\x00\x01a\x01b"))
+        contents[-1] ^= 1
+        self.assertRaises(
+            InvalidRdbFileException, RdbParser().load, contents, KeyValueStore()
+        )
+        store = KeyValueStore()
+        RdbParser(verify_checksum=False).load(contents, store)
+        self.assertEqual(store.get(b"a"), b"b")
+
+    def test_zero_checksum_is_not_verified(self):
+        contents = make_rdb(b"\x00\x01a\x01b", checksum=False)
+        store = KeyValueStore()
+        RdbParser().load(contents, store)
+        self.assertEqual(store.get(b"a"), b"b")
+
+    def test_skips_expired_keys(self):
+        store = KeyValueStore()
+        expiry = store.get_current_millis() + 100000
+        contents = make_rdb(
+            b"\xfc" + (1000).to_bytes(8, "little") + b"\x00\x03old\x01x"
+            b"\xfc" + expiry.to_bytes(8, "little") + b"\x00\x03new\x01y"
+        )
+        self.assertEqual(RdbParser().load(contents, store), 1)
+        self.assertIsNone(store.get(b"old"))
+        self.assertEqual(store.get_expiry(b"new"), expiry)
+
+    def test_truncated_file(self):
+        source = KeyValueStore()
+        source.set(b"foo", b"bar")
+        source.set_object(b"list", RedisObject(OBJ_LIST, [b"a", b"b"]), None)
+        source.add_stream_data(b"stream", [b"temperature", b"36"], "1-1")
+        contents = RdbWriter().write({0: source.snapshot()})
+        # Up to the end opcode, the checksum trailer is optional.
+        for size in range(9, len(contents) - 9):
+            with self.assertRaises(InvalidRdbFileException):
+                RdbParser().load(contents[:size], KeyValueStore())
+
+    def test_load_file(self):
+        source = KeyValueStore()
+        source.set(b"foo", "bar")
+        source.add_stream_data(b"stream", [b"temperature", b"36"], "1-1")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dump.rdb")
+            RdbWriter().save(path, {0: source.snapshot()})
+            store = KeyValueStore()
+            self.assertEqual(RdbParser().load_file(path, store), 2)
+            open(os.path.join(tmpdir, "empty.rdb"), "wb").close()
+            self.assertRaises(
+                InvalidRdbFileException,
+                RdbParser().load_file,
+                os.path.join(tmpdir, "empty.rdb"),
+                store,
+            )
+        self.assertEqual(store.get(b"foo"), b"bar")
+        self.assertEqual(
+            store.get_stream_range(b"stream", "-", "+"),
+            source.get_stream_range(b"stream", "-", "+"),
+        )
+
+
+class TestRdbAggregateTypes(unittest.TestCase):
+    def test_plain_encodings(self):
+        store = load(
+            b"\x01\x01l\x02\x01a\x01b"
+            b"\x02\x01s\x02\x01a\x01b"
+            b"\x04\x01h\x01\x01f\x01v"
+            b"\x03\x01z\x02\x01m\x031.5\x01n\xfe"
+            b"\x05\x02z2\x01\x01m\x00\x00\x00\x00\x00\x00\x04\xc0"
+        )
+        self.assertEqual(store.data[b"l"], RedisObject(OBJ_LIST, [b"a", b"b"]))
+        self.assertEqual(store.data[b"s"], RedisObject(OBJ_SET, {b"a", b"b"}))
+        self.assertEqual(store.data[b"h"], RedisObject(OBJ_HASH, {b"f": b"v"}))
+        self.assertEqual(
+            store.data[b"z"], RedisObject(OBJ_ZSET, {b"m": 1.5, b"n": float("inf")})
+        )
+        self.assertEqual(store.data[b"z2"], RedisObject(OBJ_ZSET, {b"m": -2.5}))
+        self.assertEqual(store.get_type(b"z"), "zset")
+
+    def test_ziplists_become_listpacks(self):
+        ziplist = make_ziplist(
+            [b"\x00\x01f", b"\x03\x01v", b"\x03\x01n", b"\x03\xc0\x39\x30"]
+        )
+        store = load(b"\x0d\x01h" + bytes([len(ziplist)]) + ziplist)
+        obj = store.data[b"h"]
+        self.assertEqual(obj.encoding, OBJ_ENCODING_LISTPACK)
+        self.assertEqual(obj.get_elements(), {b"f": b"v", b"n": b"12345"})
+
+    def test_compact_encodings_are_kept(self):
+        intset = b"\x02\x00\x00\x00\x03\x00\x00\x00\x01\x00\x02\x00\xfd\xff"
+        listpack = encode_listpack(["m", "1.5", "n", 2])
+        store = load(
+            b"\x0b\x01s" + bytes([len(intset)]) + intset
+            + b"\x11\x01z" + bytes([len(listpack)]) + listpack
+        )
+        self.assertEqual(store.data[b"s"].encoding, OBJ_ENCODING_INTSET)
+        self.assertEqual(store.data[b"s"].value, intset)
+        self.assertEqual(store.data[b"s"].get_elements(), {b"1", b"2", b"-3"})
+        self.assertEqual(store.data[b"z"].value, listpack)
+        self.assertEqual(store.data[b"z"].get_elements(), {b"m": 1.5, b"n": 2.0})
+
+    def test_quicklist(self):
+        listpack = encode_listpack(["a", "b"])
+        store = load(
+            b"\x12\x01l\x02\x02" + bytes([len(listpack)]) + listpack + b"\x01\x01c"
+        )
+        self.assertEqual(store.data[b"l"], RedisObject(OBJ_LIST, [b"a", b"b", b"c"]))
+        store = load(b"\x12\x01l\x01\x02" + bytes([len(listpack)]) + listpack)
+        self.assertEqual(store.data[b"l"].encoding, OBJ_ENCODING_LISTPACK)
+        self.assertEqual(store.data[b"l"].get_elements(), [b"a", b"b"])
+
+    def test_invalid_intset(self):
+        body = b"\x0b\x01s\x09\x02\x00\x00\x00\x03\x00\x00\x00\x01"
+        self.assertRaises(InvalidRdbFileException, load, body)
+
+    def test_writer_roundtrip(self):
+        source = KeyValueStore()
+        objects = {
+            b"list": RedisObject(OBJ_LIST, [b"%d" % i for i in range(300)]),
+            b"set": RedisObject(OBJ_SET, {b"a", b"b"}),
+            b"hash": RedisObject(OBJ_HASH, {b"f": b"v"}),
+            b"zset": RedisObject(OBJ_ZSET, {b"m": 1.5}),
+            b"packed": RedisObject(
+                OBJ_HASH, encode_listpack(["f", "v"]), OBJ_ENCODING_LISTPACK
+            ),
+        }
+        for key, obj in objects.items():
+            source.set_object(key, obj, None)
+        store = KeyValueStore()
+        RdbParser().load(RdbWriter().write({0: source.snapshot()}), store)
+        self.assertEqual(store.data, objects)
+        self.assertEqual(store.data[b"packed"].encoding, OBJ_ENCODING_LISTPACK)
+
+
+class TestRdbStreamLoader(unittest.TestCase):
+    def setUp(self):
+        source = KeyValueStore()
+        for i in range(200):
+            value = RedisObject(OBJ_STRING, b"%d" % i * (i % 7))
+            source.set_object(b"key%d" % i, value, None)
+        source.set_object(b"big", RedisObject(OBJ_STRING, b"x" * 50000 + b"y"), None)
+        source.set_object(b"list", RedisObject(OBJ_LIST, [b"a"] * 500), 4102444800000)
+        self.source = source
+        self.rdb = RdbWriter().write({0: source.snapshot()})
+
+    def stream(self, data, chunk_size, length=None):
+        store = KeyValueStore()
+        loader = RdbStreamLoader(RdbParser(), store, length or len(data))
+        for i in range(0, len(data), chunk_size):
+            self.assertFalse(loader.finished)
+            loader.feed(data[i : i + chunk_size])
+        return loader, store
+
+    def test_loads_in_chunks(self):
+        for chunk_size in (1, 7, 1024, len(self.rdb)):
+            loader, store = self.stream(self.rdb, chunk_size)
+            self.assertTrue(loader.finished)
+            self.assertEqual(store.data, self.source.data)
+            self.assertEqual(store.expires, self.source.expires)
+            self.assertEqual(loader.get_loaded_bytes(), len(self.rdb))
+
+    def test_keys_are_loaded_as_they_arrive(self):
+        small = {key: obj for key, obj in self.source.data.items() if key != b"big"}
+        del small[b"list"]
+        rdb = RdbWriter().write({0: (small, {})})
+        loader, store = self.stream(rdb[: len(rdb) // 2], 512, len(rdb))
+        self.assertFalse(loader.finished)
+        self.assertTrue(0 < len(store.data) < len(small))
+        # Only the incomplete entry is buffered.
+        self.assertLess(len(loader.buffer), 16)
+
+    def test_wrong_checksum(self):
+        rdb = self.rdb[:-1] + bytes([self.rdb[-1] ^ 1])
+        with self.assertRaises(InvalidRdbFileException):
+            self.stream(rdb, 1024)
+
+    def test_truncated_file(self):
+        with self.assertRaises(InvalidRdbFileException):
+            self.stream(self.rdb[:-20], 1024)
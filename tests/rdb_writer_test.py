@@ -0,0 +1,127 @@
+import unittest
+
+from app.rdb.crc64 import crc64, crc64_python
+from app.rdb.listpack import decode_listpack, encode_listpack
+from app.rdb.parser import RdbParser
+from app.rdb.writer import RdbWriter
+from app.store import KeyValueStore
+
+
+class TestCrc64(unittest.TestCase):
+    def test_check_value(self):
+        self.assertEqual(crc64(0, b"123456789"), 0xE9C6D914C4B8D9CA)
+
+    def test_incremental_update(self):
+        self.assertEqual(crc64(crc64(0, b"1234"), b"56789"), 0xE9C6D914C4B8D9CA)
+
+    def test_python_fallback(self):
+        data = bytes(range(256)) * 10 + b"tail"
+        self.assertEqual(crc64_python(0, b"123456789"), 0xE9C6D914C4B8D9CA)
+        self.assertEqual(crc64_python(0, data), crc64(0, data))
+        self.assertEqual(crc64(0, memoryview(data)[3:]), crc64_python(0, data[3:]))
+
+
+class TestListpack(unittest.TestCase):
+    def test_roundtrip(self):
+        elements = [0, 127, 128, -1, 4095, -4096, 40000, -(1 << 40), b"", b"field"]
+        elements.append(b"x" * 100)
+        elements.append(b"y" * 5000)
+        self.assertEqual(decode_listpack(encode_listpack(elements)), elements)
+
+    def test_strings_are_returned_as_bytes(self):
+        self.assertEqual(decode_listpack(encode_listpack(["a", 1])), [b"a", 1])
+
+
+class TestRdbWriter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = KeyValueStore()
+        self.store.set(b"foo", b"bar")
+        self.store.set(b"long", b"x" * 20000)
+        self.expiry = self.store.get_current_millis() + 100000
+        self.store.set_with_expiry_time(b"volatile", b"1", self.expiry)
+        self.store.add_stream_data(b"stream", [b"temperature", b"36"], "1-1")
+        self.store.add_stream_data(b"stream", [b"temperature", b"37"], "1-2")
+        self.store.add_stream_data(b"stream", [b"humidity", b"90", b"x", b"y"], "5-0")
+
+    def write_and_load(self, databases):
+        contents = RdbWriter().write(databases)
+        loaded = KeyValueStore()
+        loaded.load_data_from_rdb(RdbParser().parse(contents))
+        return contents, loaded
+
+    def test_checksum_trailer(self):
+        contents = RdbWriter().write({0: self.store.snapshot()})
+        self.assertTrue(contents.startswith(b"REDIS0011"))
+        checksum = int.from_bytes(contents[-8:], "little")
+        self.assertEqual(checksum, crc64(0, contents[:-8]))
+        self.assertEqual(contents[-9], RdbWriter.RDB_FILE_END)
+
+    def test_roundtrip(self):
+        _, loaded = self.write_and_load({0: self.store.snapshot()})
+        self.assertEqual(loaded.get(b"foo"), b"bar")
+        self.assertEqual(loaded.get(b"long"), b"x" * 20000)
+        self.assertEqual(loaded.get_expiry(b"volatile"), self.expiry)
+        self.assertEqual(loaded.get_type(b"stream"), "stream")
+        self.assertEqual(
+            loaded.get_stream_range(b"stream", "-", "+"),
+            self.store.get_stream_range(b"stream", "-", "+"),
+        )
+        self.assertEqual(loaded.get_last_stream_id(b"stream"), (5, 0))
+
+    def test_int_encoded_strings(self):
+        for value in [b"-5", b"300", b"70000", b"9223372036854775807"]:
+            self.store.set(value, value)
+        _, loaded = self.write_and_load({0: self.store.snapshot()})
+        for value in [b"-5", b"300", b"70000", b"9223372036854775807"]:
+            self.assertEqual(loaded.get(value), value)
+            self.assertEqual(loaded.get_encoding(value), "int")
+        self.assertEqual(loaded.get_encoding(b"foo"), "embstr")
+
+    def test_multiple_databases(self):
+        other = KeyValueStore()
+        other.set(b"other", b"value")
+        contents = RdbWriter().write({0: self.store.snapshot(), 3: other.snapshot()})
+        rdb = RdbParser().parse(contents)
+        self.assertEqual(sorted(rdb.data), [0, 3])
+        self.assertEqual([kv.key for kv in rdb.data[3]], [b"other"])
+
+    def test_empty_keyspace(self):
+        contents, loaded = self.write_and_load({0: KeyValueStore().snapshot()})
+        self.assertEqual(loaded.get_keys(), [])
+        self.assertNotIn(bytes([RdbWriter.DATABASE_SELECTOR]), contents[:-9])
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_snapshot_is_not_changed_by_writes(self):
+        store = KeyValueStore()
+        store.set(b"foo", b"bar")
+        store.add_stream_data(b"stream", [b"a", b"1"], "1-1")
+        data, expires = store.snapshot()
+        store.set(b"foo", b"baz")
+        store.add_stream_data(b"stream", [b"a", b"2"], "1-2")
+        store.set_expiry(b"foo", store.get_current_millis() + 1000)
+        self.assertEqual(data[b"foo"].value, b"bar")
+        self.assertEqual(len(data[b"stream"].value), 1)
+        self.assertEqual(len(store.get_stream(b"stream")), 2)
+        self.assertEqual(expires, {})
+        store.release_snapshot()
+        self.assertEqual(store.snapshots, 0)
+
+    def test_stream_is_copied_once_per_snapshot(self):
+        store = KeyValueStore()
+        store.add_stream_data(b"stream", [b"a", b"1"], "1-1")
+        data, _ = store.snapshot()
+        store.add_stream_data(b"stream", [b"a", b"2"], "1-2")
+        copy = store.data[b"stream"]
+        store.add_stream_data(b"stream", [b"a", b"3"], "1-3")
+        self.assertIs(store.data[b"stream"], copy)
+        self.assertEqual(len(data[b"stream"].value), 1)
+        newer, _ = store.snapshot()
+        store.add_stream_data(b"stream", [b"a", b"4"], "1-4")
+        self.assertIsNot(store.data[b"stream"], copy)
+        self.assertEqual(len(newer[b"stream"].value), 3)
+        self.assertEqual(len(store.get_stream(b"stream")), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
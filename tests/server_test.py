@@ -1,7 +1,17 @@
 import io
+import os
+import selectors
+import socket
+import tempfile
+import time
 import unittest
 
-from app.server import RedisServer
+from app.master_connection import MasterConnection
+from app.rdb.writer import RdbWriter
+from app.replica import ReplicaState
+from app.server import RDB_TRANSFER_MAX_PENDING, RedisServer, sel
+from app.store import KeyValueStore
+from app.timer import NO_MORE, monotonic_millis
 
 
 class TestServer(unittest.TestCase):
@@ -14,3 +24,632 @@ class TestServer(unittest.TestCase):
 
     # def test_init_filename(self):
     #     self.assertEqual(self.server.get_rdb_filename(), "dump.rdb")
+
+
+class TestReplyBuffer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RedisServer(port=0)
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.data = self.server.create_connection_data(("test",))
+        sel.register(self.sock, selectors.EVENT_READ, data=self.data)
+
+    def tearDown(self) -> None:
+        self.server.close_connection(self.sock)
+        self.peer.close()
+
+    def test_replies_are_written_in_one_flush(self):
+        self.server.add_reply(b"+OK\r\n", self.sock)
+        self.server.add_reply(b":1\r\n", self.sock)
+        self.server.handle_clients_with_pending_writes()
+        self.assertEqual(self.peer.recv(1024), b"+OK\r\n:1\r\n")
+        self.assertEqual(self.data.outb_size, 0)
+        self.assertFalse(self.data.write_registered)
+        self.assertFalse(self.server.clients_pending_write)
+
+    def test_partial_write_registers_write_interest(self):
+        payload = b"x" * (8 * 1024 * 1024)
+        self.server.add_reply(payload, self.sock)
+        self.server.handle_clients_with_pending_writes()
+        self.assertTrue(self.data.write_registered)
+        self.assertTrue(0 < self.data.outb_size < len(payload))
+        self.assertTrue(sel.get_key(self.sock).events & selectors.EVENT_WRITE)
+
+        received = b""
+        self.peer.setblocking(False)
+        while len(received) < len(payload):
+            try:
+                received += self.peer.recv(1024 * 1024)
+            except BlockingIOError:
+                self.server.write_to_client(self.sock, self.data)
+        self.assertEqual(received, payload)
+        self.assertFalse(self.data.write_registered)
+        self.assertEqual(sel.get_key(self.sock).events, selectors.EVENT_READ)
+
+
+class TestServerCron(unittest.TestCase):
+    def test_cron_is_scheduled_at_hz(self):
+        server = RedisServer(port=0, hz=20)
+        self.assertAlmostEqual(server.timers.get_timeout(), 0.05, delta=0.002)
+        self.assertEqual(server.server_cron(), 50)
+        self.assertEqual(server.cronloops, 1)
+
+    def test_waiter_times_out_without_traffic(self):
+        server = RedisServer(port=0)
+        sock, peer = socket.socketpair()
+        data = server.create_connection_data(("test",))
+        sel.register(sock, selectors.EVENT_READ, data=data)
+        self.addCleanup(peer.close)
+        self.addCleanup(server.close_connection, sock)
+        self.assertIsNone(server.wait_for_replicas(sock, 1, 20))
+        self.assertLessEqual(server.timers.get_timeout(), 0.02)
+        time.sleep(0.03)
+        server.timers.process_timers()
+        self.assertEqual(len(server.waiting_clients), 0)
+        server.handle_clients_with_pending_writes()
+        self.assertEqual(peer.recv(1024), b":0\r\n")
+
+
+class TestStreamBlocking(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RedisServer(port=0)
+        self.sock, self.peer = socket.socketpair()
+        data = self.server.create_connection_data(("test",))
+        sel.register(self.sock, selectors.EVENT_READ, data=data)
+        self.addCleanup(self.peer.close)
+        self.addCleanup(self.server.close_connection, self.sock)
+
+    def read_reply(self):
+        self.server.handle_clients_with_pending_writes()
+        return self.peer.recv(1024)
+
+    def test_client_is_served_once_and_removed(self):
+        self.server.store.add_stream_data("other", ["c", "d"], "1-0")
+        stream_ids = {"s1": 0, "other": 1 << 64}
+        self.server.block_client_on_streams(self.sock, stream_ids, None, 0)
+        self.server.store.add_stream_data("s1", ["a", "b"], "1-1")
+        self.server.signal_key_as_ready("s1")
+        self.assertEqual(
+            self.read_reply(),
+            b"*1\r\n*2\r\n$2\r\ns1\r\n*1\r\n*2\r\n$3\r\n1-1\r\n*2\r\n$1\r\na\r\n$1\r\nb\r\n",
+        )
+        self.assertEqual(len(self.server.stream_blocking_clients), 0)
+        self.server.store.add_stream_data("other", ["e", "f"], "2-0")
+        self.server.signal_key_as_ready("other")
+        self.assertFalse(self.server.clients_pending_write)
+
+    def test_client_times_out(self):
+        self.server.block_client_on_streams(self.sock, {"s1": 0}, None, 10)
+        time.sleep(0.02)
+        self.server.timers.process_timers()
+        self.assertEqual(self.read_reply(), b"$-1\r\n")
+        self.assertEqual(len(self.server.stream_blocking_clients), 0)
+
+    def test_disconnect_unblocks_client(self):
+        self.server.block_client_on_streams(self.sock, {"s1": 0}, None, 1000)
+        client = self.server.stream_blocking_clients.clients[self.sock]
+        self.server.close_connection(self.sock)
+        self.assertEqual(len(self.server.stream_blocking_clients), 0)
+        self.assertTrue(client.timer.cancelled)
+
+
+class TestWait(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RedisServer(port=0)
+        self.sockets = []
+        for addr in ["client", "replica1", "replica2"]:
+            sock, peer = socket.socketpair()
+            data = self.server.create_connection_data((addr,))
+            sel.register(sock, selectors.EVENT_READ, data=data)
+            self.addCleanup(peer.close)
+            self.addCleanup(self.server.close_connection, sock)
+            self.sockets.append((sock, peer))
+        self.client, self.client_peer = self.sockets[0]
+        for sock, _ in self.sockets[1:]:
+            self.server.add_replica(sock.getsockname(), b"?", b"-1", sock)
+
+    def test_wait_returns_immediately_without_writes(self):
+        self.assertEqual(self.server.wait_for_replicas(self.client, 2, 100), 2)
+
+    def test_wait_resolves_on_acks(self):
+        self.server.propagate(b"*1\r\n$4\r\nPING\r\n")
+        self.assertEqual(self.server.repl_offset, 14)
+        self.assertIsNone(self.server.wait_for_replicas(self.client, 2, 0))
+        self.assertTrue(self.server.get_ack_from_replicas)
+        replica1, replica2 = self.sockets[1][0], self.sockets[2][0]
+        self.server.received_replica_offset(14, replica1)
+        self.assertEqual(len(self.server.waiting_clients), 1)
+        self.server.received_replica_offset(14, replica2)
+        self.assertEqual(len(self.server.waiting_clients), 0)
+        self.server.handle_clients_with_pending_writes()
+        self.assertEqual(self.client_peer.recv(1024), b":2\r\n")
+
+    def test_wait_ignores_replicas_in_full_sync(self):
+        self.server.propagate(b"*1\r\n$4\r\nPING\r\n")
+        self.assertIsNone(self.server.wait_for_replicas(self.client, 2, 0))
+        syncing = self.server.replicas[1]
+        syncing.state = ReplicaState.WAIT_BGSAVE_END
+        syncing.ack_offset = 14
+        self.server.received_replica_offset(14, self.sockets[1][0])
+        self.assertEqual(len(self.server.waiting_clients), 1)
+
+    def test_wait_timeout_reports_acked_replicas(self):
+        self.server.propagate(b"*1\r\n$4\r\nPING\r\n")
+        self.assertIsNone(self.server.wait_for_replicas(self.client, 2, 10))
+        self.server.received_replica_offset(14, self.sockets[1][0])
+        time.sleep(0.02)
+        self.server.timers.process_timers()
+        self.server.handle_clients_with_pending_writes()
+        self.assertEqual(self.client_peer.recv(1024), b":1\r\n")
+
+    def test_wait_rejects_invalid_arguments(self):
+        data = sel.get_key(self.client).data
+        error = b"-ERR value is not an integer or out of range\r\n"
+        for args, reply in [
+            ([b"a", b"0"], error),
+            ([b"0", b"soon"], error),
+            ([b"0", b"-1"], b"-ERR timeout is negative\r\n"),
+        ]:
+            data.inb = self.server.encoder.generate_array_string([b"WAIT", *args])
+            res = self.server.command_handler.handle_message(data, self.client)
+            self.assertEqual(res, reply)
+
+    def test_disconnected_replica_is_removed(self):
+        self.server.close_connection(self.sockets[1][0])
+        self.assertEqual(self.server.get_replica_count(), 1)
+
+
+class TestPartialResync(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RedisServer(port=0, repl_backlog_size=64)
+        self.command = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n"
+
+    def test_missing_bytes_are_served_from_backlog(self):
+        self.server.propagate(self.command)
+        self.server.propagate(self.command)
+        replid = self.server.get_replid()
+        missing = self.server.try_partial_resync(replid, len(self.command) + 1)
+        self.assertEqual(missing, self.command)
+        self.assertEqual(self.server.try_partial_resync(replid, 2 * 31 + 1), b"")
+
+    def test_full_resync_for_unknown_replid_or_offset(self):
+        self.server.propagate(self.command)
+        self.assertIsNone(self.server.try_partial_resync("?", -1))
+        self.assertIsNone(self.server.try_partial_resync("other", 1))
+        for _ in range(3):
+            self.server.propagate(self.command)
+        self.assertIsNone(self.server.try_partial_resync(self.server.get_replid(), 1))
+
+
+class TestFullResync(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RedisServer(port=0)
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.peer.setblocking(False)
+        data = self.server.create_connection_data(("replica",))
+        sel.register(self.sock, selectors.EVENT_READ, data=data)
+        self.addCleanup(self.peer.close)
+        self.addCleanup(self.server.close_connection, self.sock)
+        self.replica = self.server.add_replica(("replica",), "?", "-1", self.sock)
+
+    def receive(self):
+        self.server.handle_clients_with_pending_writes()
+        data = sel.get_key(self.sock).data
+        received = b""
+        while True:
+            try:
+                received += self.peer.recv(1024 * 1024)
+            except BlockingIOError:
+                if not data.outb:
+                    return received
+                # Stand in for the event loop flushing a writable socket.
+                self.server.write_to_client(self.sock, data)
+
+    def test_rdb_is_followed_by_writes_made_during_sync(self):
+        self.server.set_data(b"foo", b"bar")
+        self.server.start_full_resync(self.replica)
+        write = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbaz\r\n"
+        self.server.propagate(write)
+        self.assertFalse(self.replica.has_acknowledged(0))
+        self.assertEqual(self.receive(), b"")
+
+        self.server.timers.process_timers()
+        self.assertEqual(self.server.store.snapshots, 0)
+        received = self.receive()
+        header, _, rest = received.partition(b"\r\n")
+        size = int(header[1:])
+        rdb = self.server.parse_rdb_file(rest[:size])
+        self.assertEqual([kv.value for kv in rdb.data[0]], [b"bar"])
+        self.assertEqual(rest[size:], write)
+        self.assertTrue(self.replica.has_acknowledged(0))
+
+    def test_rdb_is_streamed_to_replicas_with_eof_capability(self):
+        self.server.set_data(b"foo", b"bar")
+        self.replica.capa_eof = True
+        self.server.start_full_resync(self.replica)
+        write = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbaz\r\n"
+        self.server.propagate(write)
+        self.server.timers.process_timers()
+        self.assertEqual(self.server.store.snapshots, 0)
+        received = self.receive()
+        header, _, rest = received.partition(b"\r\n")
+        self.assertTrue(header.startswith(b"$EOF:"))
+        mark = header[5:]
+        self.assertEqual(len(mark), 40)
+        rdb, _, stream = rest.partition(mark)
+        rdb = self.server.parse_rdb_file(rdb)
+        self.assertEqual([kv.value for kv in rdb.data[0]], [b"bar"])
+        self.assertEqual(stream, write)
+        self.assertTrue(self.replica.has_acknowledged(0))
+
+    def test_transfer_waits_for_a_slow_replica(self):
+        for i in range(2000):
+            self.server.set_data(b"key%d" % i, b"x" * 1000)
+        self.replica.capa_eof = True
+        self.server.start_full_resync(self.replica)
+        self.server.timers.process_timers()
+        data = sel.get_key(self.sock).data
+        self.assertLess(data.outb_size, 2 * RDB_TRANSFER_MAX_PENDING)
+        self.assertFalse(self.replica.has_acknowledged(0))
+        while not self.replica.has_acknowledged(0):
+            self.receive()
+            time.sleep(0.002)
+            self.server.timers.process_timers()
+
+    def test_snapshot_is_released_if_replica_disconnects(self):
+        self.server.start_full_resync(self.replica)
+        self.server.close_connection(self.sock)
+        self.server.timers.process_timers()
+        self.assertEqual(self.server.store.snapshots, 0)
+
+
+class TestPersistence(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.server = RedisServer(
+            port=0, rdb_dir=self.tempdir.name, rdb_filename="dump.rdb"
+        )
+        self.path = os.path.join(self.tempdir.name, "dump.rdb")
+
+    def load_saved(self):
+        with open(self.path, "rb") as rdb_file:
+            rdb = self.server.parse_rdb_file(rdb_file.read())
+        return {kv.key: kv.value for kv in rdb.data[0]}
+
+    def wait_for_child(self):
+        while self.server.has_active_child():
+            time.sleep(0.01)
+            self.server.check_rdb_child_done()
+
+    def test_save(self):
+        self.server.set_data(b"foo", b"bar")
+        self.assertEqual(self.server.store.dirty, 1)
+        self.assertTrue(self.server.rdb_save())
+        self.assertEqual(self.load_saved(), {b"foo": b"bar"})
+        self.assertEqual(self.server.store.dirty, 0)
+        self.assertEqual(os.listdir(self.tempdir.name), ["dump.rdb"])
+
+    def test_background_save(self):
+        self.server.set_data(b"foo", b"bar")
+        self.assertTrue(self.server.rdb_background_save())
+        self.assertFalse(self.server.rdb_background_save())
+        # Writes made meanwhile are not in the child's snapshot.
+        self.server.set_data(b"foo", b"baz")
+        self.wait_for_child()
+        self.assertEqual(self.load_saved(), {b"foo": b"bar"})
+        self.assertTrue(self.server.lastbgsave_ok)
+        self.assertEqual(self.server.store.dirty, 1)
+        self.assertEqual(self.server.stat_rdb_saves, 1)
+        self.assertGreater(self.server.stat_fork_time_usec, 0)
+
+    def test_save_policy_triggers_background_save(self):
+        self.server.save_params = [(0, 2)]
+        self.server.set_data(b"foo", b"bar")
+        self.server.lastsave -= 1
+        self.assertFalse(self.server.should_background_save())
+        self.server.set_data(b"baz", b"qux")
+        self.assertTrue(self.server.should_background_save())
+        self.server.server_cron()
+        self.assertTrue(self.server.has_active_child())
+        self.wait_for_child()
+        self.assertEqual(self.load_saved(), {b"foo": b"bar", b"baz": b"qux"})
+        self.assertFalse(self.server.should_background_save())
+
+    def test_failed_save_is_reported(self):
+        self.server.rdb_dir = os.path.join(self.tempdir.name, "missing")
+        self.server.set_data(b"foo", b"bar")
+        self.assertFalse(self.server.rdb_save())
+        self.assertFalse(self.server.lastbgsave_ok)
+        self.assertEqual(self.server.store.dirty, 1)
+
+
+class TestLoading(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        source = RedisServer(port=0, rdb_dir=self.tempdir.name)
+        for i in range(100):
+            source.set_data(b"key%d" % i, b"%d" % i)
+        source.rdb_save()
+        self.server = RedisServer(port=0, rdb_dir=self.tempdir.name)
+
+    def send(self, message):
+        data = self.server.create_connection_data(("test",))
+        data.inb = message
+        return self.server.command_handler.handle_message(data, None)
+
+    def test_commands_during_loading(self):
+        self.assertTrue(self.server.start_loading())
+        self.assertEqual(
+            self.send(b"*2\r\n$3\r\nGET\r\n$4\r\nkey1\r\n"),
+            b"-LOADING Redis is loading the dataset in memory\r\n",
+        )
+        self.assertEqual(self.send(b"*1\r\n$4\r\nPING\r\n"), b"+PONG\r\n")
+        info = self.send(b"*2\r\n$4\r\nINFO\r\n$11\r\npersistence\r\n")
+        self.assertIn(b"loading:1", info)
+        self.assertIn(b"loading_total_bytes:", info)
+        while self.server.loading_step() != NO_MORE:
+            pass
+        self.assertFalse(self.server.loading)
+        self.assertEqual(self.server.store.dirty, 0)
+        self.assertEqual(
+            self.send(b"*2\r\n$3\r\nGET\r\n$4\r\nkey1\r\n"), b"$1\r\n1\r\n"
+        )
+
+    def test_loading_progress(self):
+        self.server.start_loading()
+        next(self.server.loading_job)
+        self.assertGreater(self.server.loading_loaded_bytes, 0)
+        self.assertLess(
+            self.server.loading_loaded_bytes, self.server.loading_total_bytes
+        )
+        self.assertIsNotNone(self.server.get_loading_eta())
+
+    def chdir(self, path):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(path)
+
+    def test_nothing_to_load(self):
+        with tempfile.TemporaryDirectory() as empty:
+            self.chdir(empty)
+            server = RedisServer(port=0)
+            self.assertFalse(server.start_loading())
+            self.assertFalse(server.loading)
+
+    def test_default_save_path_is_loaded(self):
+        self.chdir(self.tempdir.name)
+        source = RedisServer(port=0)
+        source.set_data(b"foo", b"bar")
+        self.assertTrue(source.rdb_save())
+        server = RedisServer(port=0)
+        self.assertTrue(server.start_loading())
+        while server.loading_step() != NO_MORE:
+            pass
+        self.assertEqual(server.get_data(b"foo"), b"bar")
+
+
+class TestBinaryValues(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.server = RedisServer(port=0, rdb_dir=self.tempdir.name)
+
+    def send(self, *args):
+        data = self.server.create_connection_data(("test",))
+        data.inb = self.server.encoder.generate_array_string(list(args))
+        return self.server.command_handler.handle_message(data, None)
+
+    def test_keys_and_values_are_kept_as_sent(self):
+        key, value = b"\xff\x00key", "café \U0001f600".encode() + b"\x80"
+        self.assertEqual(self.send(b"SET", key, value), b"+OK\r\n")
+        self.assertEqual(self.send(b"SET", b"empty", b""), b"+OK\r\n")
+        self.assertEqual(self.server.store.data[key].value, value)
+        self.assertEqual(self.send(b"GET", key), b"$11\r\n%s\r\n" % value)
+        self.assertEqual(self.send(b"GET", b"empty"), b"$0\r\n\r\n")
+        self.assertEqual(
+            self.send(b"KEYS", b"*"), b"*2\r\n$5\r\n%s\r\n$5\r\nempty\r\n" % key
+        )
+
+    def test_binary_values_survive_a_save(self):
+        self.send(b"SET", b"\xfe", b"\xc3\x28")
+        self.send(b"XADD", b"s\xff", b"1-1", b"f\x80", b"\x00")
+        self.server.rdb_save()
+        server = RedisServer(port=0, rdb_dir=self.tempdir.name)
+        server.load_initial_data()
+        self.assertEqual(server.get_data(b"\xfe"), b"\xc3\x28")
+        self.assertEqual(
+            server.store.get_stream_range(b"s\xff", "-", "+"),
+            [["1-1", [b"f\x80", b"\x00"]]],
+        )
+
+
+class TestReplicationStream(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RedisServer(port=0)
+        self.replicas = []
+        for addr in ["replica1", "replica2"]:
+            sock, peer = socket.socketpair()
+            sock.setblocking(False)
+            peer.setblocking(False)
+            data = self.server.create_connection_data((addr,))
+            sel.register(sock, selectors.EVENT_READ, data=data)
+            self.addCleanup(peer.close)
+            self.addCleanup(self.server.close_connection, sock)
+            replica = self.server.add_replica((addr,), "?", "-1", sock)
+            self.replicas.append((replica, peer))
+        self.command = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n"
+
+    def test_writes_are_sent_once_per_loop(self):
+        for _ in range(3):
+            self.server.propagate(self.command)
+        self.server.handle_clients_with_pending_writes()
+        for replica, peer in self.replicas:
+            self.assertEqual(peer.recv(1024), self.command * 3)
+            self.assertEqual(replica.sent_offset, self.server.repl_offset)
+        self.assertEqual(len(self.server.repl_buffer), 0)
+
+    def test_lagging_replica_is_disconnected(self):
+        self.server.replica_output_limits = (2 * len(self.command), 0, 0)
+        slow, _ = self.replicas[1]
+        slow.start_full_sync()
+        self.server.propagate(self.command)
+        self.server.handle_clients_with_pending_writes()
+        self.assertEqual(len(self.server.replicas), 2)
+        self.server.propagate(self.command)
+        self.server.handle_clients_with_pending_writes()
+        self.assertEqual(self.server.replicas, [self.replicas[0][0]])
+        self.assertEqual(len(self.server.repl_buffer), 0)
+
+
+
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # Nothing listens on port 1, the link to the master is faked below.
+        self.server = RedisServer(port=0, master_server="localhost", master_port=1)
+        self.sock, self.peer = self.add_socket(("master",), master_connection=True)
+        self.connection = MasterConnection(self.server, 0, self.sock)
+        self.server.master_connection = self.connection
+        handler = self.connection.command_handler
+        handler.state = handler.State.WAITING_FOR_FULLRESYNC
+        self.replid = "a" * 40
+        self.command = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n"
+
+    def add_socket(self, addr, master_connection=False):
+        sock, peer = socket.socketpair()
+        sock.setblocking(False)
+        peer.setblocking(False)
+        data = self.server.create_connection_data(addr, master_connection)
+        sel.register(sock, selectors.EVENT_READ, data=data)
+        self.addCleanup(peer.close)
+        self.addCleanup(self.server.close_connection, sock)
+        return sock, peer
+
+    def receive_from_master(self, message):
+        data = sel.get_key(self.sock).data
+        data.inb = message
+        self.connection.handle_incoming_data(data, self.sock)
+
+    def full_sync(self):
+        rdb = RdbWriter().write({0: ({}, {})})
+        self.receive_from_master(
+            b"+FULLRESYNC %s 100\r\n$%d\r\n%s"
+            % (self.replid.encode(), len(rdb), rdb)
+        )
+
+    def psync(self, sock, replid, offset):
+        data = sel.get_key(sock).data
+        data.inb = b"*3\r\n$5\r\nPSYNC\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n" % (
+            len(replid),
+            replid.encode(),
+            len(offset),
+            offset.encode(),
+        )
+        return self.server.command_handler.handle_message(data, sock)
+
+
+class TestCascadingReplication(ReplicaTestCase):
+    def test_no_sync_before_the_master_link_is_up(self):
+        sock, _ = self.add_socket(("sub",))
+        self.assertTrue(self.psync(sock, "?", "-1").startswith(b"-NOMASTERLINK"))
+        self.assertEqual(self.server.get_replica_count(), 0)
+
+    def test_master_stream_is_relayed(self):
+        self.full_sync()
+        self.assertEqual(self.server.get_replid(), self.replid)
+        self.assertEqual(self.server.get_repl_offset(), 100)
+        sock, peer = self.add_socket(("sub",))
+        self.assertTrue(self.psync(sock, "?", "-1").startswith(b"+FULLRESYNC"))
+        self.server.timers.process_timers()
+        self.server.handle_clients_with_pending_writes()
+        peer.recv(1024 * 1024)
+
+        self.receive_from_master(self.command)
+        self.assertEqual(self.server.get_data(b"foo"), b"bar")
+        self.assertEqual(self.server.get_repl_offset(), 100 + len(self.command))
+        self.server.handle_clients_with_pending_writes()
+        self.assertEqual(peer.recv(1024), self.command)
+        # A sub-replica resuming at an offset of the master is served too.
+        missing = self.server.try_partial_resync(self.replid, 101)
+        self.assertEqual(missing, self.command)
+
+    def test_rdb_ended_by_mark_is_loaded(self):
+        store = KeyValueStore()
+        store.set(b"loaded", b"1")
+        rdb = RdbWriter().write({0: store.snapshot()})
+        mark = b"m" * 40
+        message = b"+FULLRESYNC %s 100\r\n$EOF:%s\r\n%s%s" % (
+            self.replid.encode(),
+            mark,
+            rdb,
+            mark,
+        )
+        for i in range(0, len(message), 7):
+            self.receive_from_master(message[i : i + 7])
+        self.assertTrue(self.connection.is_synced())
+        self.assertEqual(self.server.get_data(b"loaded"), b"1")
+        self.receive_from_master(self.command)
+        self.assertEqual(self.server.get_data(b"foo"), b"bar")
+        self.assertEqual(self.server.get_repl_offset(), 100 + len(self.command))
+
+    def test_writes_on_the_replica_are_not_relayed(self):
+        self.full_sync()
+        self.server.propagate(self.command)
+        self.assertEqual(self.server.get_repl_offset(), 100)
+
+    def test_resync_with_master_disconnects_sub_replicas(self):
+        self.full_sync()
+        sock, _ = self.add_socket(("sub",))
+        self.psync(sock, "?", "-1")
+        self.assertEqual(self.server.get_replica_count(), 1)
+        self.connection.command_handler.state = (
+            self.connection.command_handler.State.WAITING_FOR_FULLRESYNC
+        )
+        self.full_sync()
+        self.assertEqual(self.server.get_replica_count(), 0)
+
+
+class TestReplicaReads(ReplicaTestCase):
+    def client_command(self, *args):
+        sock, _ = self.add_socket(("client",))
+        data = sel.get_key(sock).data
+        data.inb = self.server.encoder.generate_array_string(list(args))
+        return self.server.command_handler.handle_message(data, sock)
+
+    def test_writes_are_refused(self):
+        self.full_sync()
+        error = self.client_command("SET", "foo", "bar")
+        self.assertTrue(error.startswith(b"-READONLY"))
+        self.server.replica_read_only = False
+        self.assertEqual(self.client_command("SET", "foo", "bar"), b"+OK\r\n")
+
+    def test_stale_reads_are_refused(self):
+        self.server.replica_max_staleness = 5
+        self.server.master_link_down_since -= 5000
+        self.assertTrue(self.client_command("GET", "foo").startswith(b"-MASTERDOWN"))
+        self.full_sync()
+        self.server.master_last_io = monotonic_millis()
+        self.assertEqual(self.client_command("GET", "foo"), b"$-1\r\n")
+        self.server.master_last_io -= 5000
+        self.assertTrue(self.client_command("GET", "foo").startswith(b"-MASTERDOWN"))
+        self.assertEqual(self.client_command("PING"), b"+PONG\r\n")
+
+    def test_master_link_info(self):
+        info = self.client_command("INFO", "replication")
+        self.assertIn(b"master_link_status:down", info)
+        self.full_sync()
+        info = self.client_command("INFO", "replication")
+        self.assertIn(b"master_link_status:up", info)
+        self.assertIn(b"master_sync_in_progress:0", info)
+        self.assertIn(b"slave_repl_offset:100", info)
+
+    def test_master_pings_replicas(self):
+        master = RedisServer(port=0, hz=10, repl_ping_replica_period=1)
+        sock, peer = socket.socketpair()
+        master.add_replica(("replica",), "?", "-1", sock)
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        for _ in range(10):
+            master.server_cron()
+        self.assertEqual(master.repl_buffer.end_offset, 14)
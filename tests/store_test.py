@@ -1,6 +1,22 @@
+import time
 import unittest
 
-from app.store import KeyValueStore, ZeroIdentifier
+from app.store import (
+    KeyValueStore,
+    ZeroIdentifier,
+    RedisObject,
+    InvalidStreamId,
+    InvalidValue,
+    WrongType,
+    OBJ_ENCODING_EMBSTR,
+    OBJ_ENCODING_INT,
+    OBJ_ENCODING_RAW,
+    OBJ_HASH,
+    OBJ_STRING,
+    create_string_object,
+    format_double,
+)
+from app.stream import MIN_STREAM_ID, MAX_STREAM_ID, pack_stream_id
 from app.rdb.parser import RdbData, KeyValue
 
 
@@ -11,6 +27,25 @@ class TestKeyValueStore(unittest.TestCase):
         store.set("foo", "bar", 1000)
         self.assertEqual(store.get_keys(), ["key1", "foo"])
 
+    def test_stream_entry_type(self):
+        store = KeyValueStore()
+        store.set("foo", "bar")
+        store.add_stream_data("stream1", ["a", "b"], identifier="1-1")
+        self.assertEqual(store.get_type("foo"), "string")
+        self.assertEqual(store.get_type("stream1"), "stream")
+        stream = store.data["stream1"].value
+        self.assertEqual(
+            stream.range(MIN_STREAM_ID, MAX_STREAM_ID),
+            [(pack_stream_id(1, 1), ["a", "b"])],
+        )
+
+    def test_wrong_type(self):
+        store = KeyValueStore()
+        store.set_object("hash", RedisObject(OBJ_HASH, {"f": "v"}), None)
+        self.assertEqual(store.get_type("hash"), "hash")
+        self.assertRaises(WrongType, store.get, "hash")
+        self.assertRaises(WrongType, store.add_stream_data, "hash", ["a", "b"], "1-1")
+
     def test_loading_from_rdb(self):
         rdb = RdbData()
         rdb.add_database(0)
@@ -30,6 +65,151 @@ class TestKeyValueStore(unittest.TestCase):
         self.assertEqual(store.get("key1"), None)
 
 
+class TestExpiry(unittest.TestCase):
+    def test_get_expires_lazily(self):
+        store = KeyValueStore()
+        store.set("foo", "bar", 10)
+        self.assertEqual(store.get("foo"), "bar")
+        time.sleep(0.02)
+        self.assertIsNone(store.get("foo"))
+        self.assertNotIn("foo", store.data)
+
+    def test_active_expire_cycle_removes_due_keys(self):
+        store = KeyValueStore()
+        store.set("short", "1", 10)
+        store.set("long", "2", 100000)
+        store.set("persistent", "3")
+        time.sleep(0.02)
+        self.assertEqual(store.active_expire_cycle(25), 1)
+        self.assertEqual(sorted(store.data), ["long", "persistent"])
+        self.assertEqual(len(store.expiry_index), 1)
+
+    def test_expiry_index_stays_bounded(self):
+        store = KeyValueStore()
+        store.set(b"other", b"1", 100000)
+        for i in range(1000):
+            store.set(b"foo", b"bar", 100000 + i)
+            store.set(b"tmp", b"1", 100000)
+            store.delete(b"tmp")
+        self.assertLessEqual(len(store.expiry_index), 2 * len(store.expires) + 1)
+        self.assertIn((store.get_expiry(b"foo"), b"foo"), store.expiry_index)
+
+    def test_expiry_is_kept_in_milliseconds(self):
+        store = KeyValueStore()
+        store.set_with_expiry_time("foo", "bar", 1956528000000)
+        self.assertEqual(store.get_expiry("foo"), 1956528000000)
+        self.assertEqual(store.data["foo"], RedisObject(OBJ_STRING, "bar"))
+
+    def test_set_without_expiry_clears_ttl(self):
+        store = KeyValueStore()
+        store.set("foo", "bar", 10000)
+        store.set("foo", "baz")
+        self.assertIsNone(store.get_expiry("foo"))
+        self.assertEqual(store.get_ttl_millis("foo"), -1)
+
+    def test_active_expire_cycle_skips_overwritten_keys(self):
+        store = KeyValueStore()
+        store.set("foo", "old", 10)
+        store.set("foo", "new")
+        time.sleep(0.02)
+        self.assertEqual(store.active_expire_cycle(25), 0)
+        self.assertEqual(store.get("foo"), "new")
+        self.assertEqual(store.expiry_index, [])
+
+
+class TestBatchOperations(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = KeyValueStore()
+        self.store.set(b"a", b"1")
+        self.store.set(b"expired", b"2", 10)
+        self.store.add_stream_data(b"stream", [b"f", b"v"], "1-1")
+        time.sleep(0.02)
+
+    def test_get_many(self):
+        keys = [b"a", b"expired", b"stream", b"missing", b"a"]
+        self.assertEqual(self.store.get_many(keys), [b"1", None, None, None, b"1"])
+        self.assertNotIn(b"expired", self.store.data)
+
+    def test_set_many(self):
+        self.store.set(b"volatile", b"x", 10000)
+        dirty = self.store.dirty
+        self.store.set_many([(b"a", b"3"), (b"volatile", b"4"), (b"b", b"5")])
+        values = self.store.get_many([b"a", b"volatile", b"b"])
+        self.assertEqual(values, [b"3", b"4", b"5"])
+        self.assertIsNone(self.store.get_expiry(b"volatile"))
+        self.assertEqual(self.store.dirty, dirty + 3)
+
+    def test_set_many_if_none_exist(self):
+        pairs = [(b"b", b"1"), (b"a", b"2")]
+        self.assertFalse(self.store.set_many_if_none_exist(pairs))
+        self.assertIsNone(self.store.get(b"b"))
+        pairs = [(b"b", b"1"), (b"expired", b"2")]
+        self.assertTrue(self.store.set_many_if_none_exist(pairs))
+        self.assertEqual(self.store.get_many([b"b", b"expired"]), [b"1", b"2"])
+
+    def test_count_existing_and_delete_many(self):
+        keys = [b"a", b"a", b"expired", b"stream", b"missing"]
+        self.assertEqual(self.store.count_existing(keys), 3)
+        self.assertEqual(self.store.delete_many(keys), 2)
+        self.assertEqual(self.store.data, {})
+
+
+class TestCounters(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = KeyValueStore()
+
+    def test_string_encodings(self):
+        self.assertEqual(create_string_object(b"-42").encoding, OBJ_ENCODING_INT)
+        self.assertEqual(create_string_object(b"-42").value, -42)
+        # Shared objects for small values.
+        self.assertIs(create_string_object(b"7"), create_string_object(b"7"))
+        for value in [b"007", b"+1", b" 1", b"1.5", b"", b"9223372036854775808"]:
+            obj = create_string_object(value)
+            self.assertEqual(obj.encoding, OBJ_ENCODING_EMBSTR)
+            self.assertEqual(obj.get_string(), value)
+        self.assertEqual(create_string_object(b"x" * 45).encoding, OBJ_ENCODING_RAW)
+
+    def test_increment(self):
+        self.assertEqual(self.store.increment(b"n", 5), 5)
+        self.assertEqual(self.store.increment(b"n", -15), -10)
+        self.assertEqual(self.store.data[b"n"].value, -10)
+        self.assertEqual(self.store.get(b"n"), b"-10")
+        self.store.set(b"text", b"12")
+        self.assertEqual(self.store.increment(b"text", 1), 13)
+        self.assertEqual(self.store.dirty, 4)
+
+    def test_increment_keeps_expiry(self):
+        self.store.set(b"n", b"1", 10000)
+        expiry = self.store.get_expiry(b"n")
+        self.store.increment(b"n", 1)
+        self.assertEqual(self.store.get_expiry(b"n"), expiry)
+
+    def test_increment_errors(self):
+        self.store.set(b"text", b"abc")
+        with self.assertRaises(InvalidValue):
+            self.store.increment(b"text", 1)
+        self.store.set(b"max", b"9223372036854775807")
+        with self.assertRaisesRegex(InvalidValue, "overflow"):
+            self.store.increment(b"max", 1)
+        self.store.add_stream_data(b"stream", [b"f", b"v"], "1-1")
+        with self.assertRaises(WrongType):
+            self.store.increment(b"stream", 1)
+
+    def test_increment_float(self):
+        self.assertEqual(self.store.increment_float(b"f", 10.5), b"10.5")
+        self.assertEqual(self.store.increment_float(b"f", 0.1), b"10.6")
+        self.assertEqual(self.store.increment_float(b"f", -0.6), b"10")
+        self.assertEqual(self.store.data[b"f"].encoding, OBJ_ENCODING_INT)
+        self.store.set(b"text", b"abc")
+        with self.assertRaises(InvalidValue):
+            self.store.increment_float(b"text", 1.0)
+
+    def test_format_double(self):
+        self.assertEqual(format_double(3.0), b"3")
+        self.assertEqual(format_double(1e20), b"100000000000000000000")
+        self.assertEqual(format_double(5e-05), b"0.00005")
+
+
 class TestStreamInKVStore(unittest.TestCase):
     def test_milliseconds_part_greater(self):
         store = KeyValueStore()
@@ -65,6 +245,13 @@ class TestStreamInKVStore(unittest.TestCase):
         with self.assertRaises(ValueError):
             store.add_stream_data("stream1", ["value2"], identifier="11232323")
 
+    def test_out_of_range_identifier_creates_no_stream(self):
+        store = KeyValueStore()
+        with self.assertRaises(InvalidStreamId):
+            store.add_stream_data("stream1", ["f", "v"], "18446744073709551616-1")
+        self.assertNotIn("stream1", store.data)
+        self.assertEqual(store.dirty, 0)
+
     def test_identifier_is_valid_zero_id(self):
         store = KeyValueStore()
         with self.assertRaises(ZeroIdentifier):
@@ -0,0 +1,69 @@
+import unittest
+
+from app.stream import (
+    Stream,
+    STREAM_NODE_MAX_ENTRIES,
+    MAX_STREAM_ID,
+    SEQ_MASK,
+    format_stream_id,
+    pack_stream_id,
+    parse_stream_id,
+)
+
+
+class TestStreamId(unittest.TestCase):
+    def test_pack_keeps_ordering(self):
+        self.assertLess(pack_stream_id(1, SEQ_MASK), pack_stream_id(2, 0))
+        self.assertLess(pack_stream_id(5, 1), pack_stream_id(5, 2))
+
+    def test_parse_and_format(self):
+        stream_id = parse_stream_id("1526985054069-3")
+        self.assertEqual(format_stream_id(stream_id), "1526985054069-3")
+        self.assertEqual(parse_stream_id("123"), pack_stream_id(123, 0))
+        self.assertEqual(
+            parse_stream_id("123", missing_seq=SEQ_MASK),
+            pack_stream_id(123, SEQ_MASK),
+        )
+        self.assertEqual(parse_stream_id("-"), 0)
+        self.assertEqual(parse_stream_id("+"), MAX_STREAM_ID)
+
+    def test_parse_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_stream_id("abc")
+        with self.assertRaises(ValueError):
+            parse_stream_id("1-2-3")
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self) -> None:
+        self.stream = Stream()
+        self.count = STREAM_NODE_MAX_ENTRIES * 3 + 7
+        for i in range(1, self.count + 1):
+            self.stream.append(pack_stream_id(i // 2, i % 2), [str(i)])
+
+    def test_entries_are_split_in_nodes(self):
+        self.assertEqual(len(self.stream), self.count)
+        self.assertEqual(len(self.stream.nodes), 4)
+        self.assertEqual(self.stream.first_ids[1], pack_stream_id(50, 1))
+
+    def test_append_rejects_smaller_id(self):
+        with self.assertRaises(ValueError):
+            self.stream.append(pack_stream_id(1, 0), ["x"])
+
+    def test_range_across_nodes(self):
+        result = self.stream.range(pack_stream_id(49, 0), pack_stream_id(51, 0))
+        self.assertEqual(
+            [values[0] for _, values in result], [str(i) for i in range(98, 103)]
+        )
+
+    def test_range_with_count(self):
+        result = self.stream.range(pack_stream_id(100, 0), MAX_STREAM_ID, count=3)
+        self.assertEqual([values[0] for _, values in result], ["200", "201", "202"])
+
+    def test_read_after_tail(self):
+        result = self.stream.read_after(pack_stream_id(self.count // 2, 0))
+        self.assertEqual([values[0] for _, values in result], [str(self.count)])
+        self.assertEqual(self.stream.read_after(self.stream.last_id), [])
+
+    def test_empty_stream(self):
+        self.assertEqual(Stream().range(0, MAX_STREAM_ID), [])
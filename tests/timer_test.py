@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from app.timer import TimerQueue, NO_MORE
+
+
+class TestTimerQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 1000
+        patcher = patch("app.timer.monotonic_millis", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.timers = TimerQueue()
+
+    def test_empty_queue_has_no_timeout(self):
+        self.assertIsNone(self.timers.get_timeout())
+
+    def test_timeout_is_nearest_deadline(self):
+        self.timers.add_timer(500, lambda: None)
+        self.timers.add_timer(200, lambda: None)
+        self.assertEqual(self.timers.get_timeout(), 0.2)
+        self.now += 300
+        self.assertEqual(self.timers.get_timeout(), 0)
+
+    def test_timers_run_in_deadline_order(self):
+        calls = []
+        self.timers.add_timer(20, calls.append, "second")
+        self.timers.add_timer(10, calls.append, "first")
+        self.timers.add_timer(30, calls.append, "not due")
+        self.now += 20
+        self.assertEqual(self.timers.process_timers(), 2)
+        self.assertEqual(calls, ["first", "second"])
+        self.assertEqual(len(self.timers), 1)
+
+    def test_cancelled_timer_is_skipped(self):
+        calls = []
+        timer = self.timers.add_timer(10, calls.append, "cancelled")
+        timer.cancel()
+        self.assertIsNone(self.timers.get_timeout())
+        self.now += 10
+        self.timers.process_timers()
+        self.assertEqual(calls, [])
+
+    def test_periodic_timer_is_rescheduled(self):
+        calls = []
+
+        def cron():
+            calls.append(self.now)
+            return 100 if len(calls) < 3 else NO_MORE
+
+        self.timers.add_timer(100, cron)
+        for _ in range(5):
+            self.now += 100
+            self.timers.process_timers()
+        self.assertEqual(calls, [1100, 1200, 1300])
+        self.assertIsNone(self.timers.get_timeout())